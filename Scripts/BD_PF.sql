@@ -57,6 +57,19 @@ CREATE TABLE dbo.EmailCredentials (
 );
 GO
 
+-- Marcadores de cambio para la sincronización incremental de cuentas del watcher
+IF COL_LENGTH('dbo.AppUsers', 'RowVer') IS NULL
+    ALTER TABLE dbo.AppUsers ADD RowVer ROWVERSION;
+IF COL_LENGTH('dbo.EmailCredentials', 'RowVer') IS NULL
+    ALTER TABLE dbo.EmailCredentials ADD RowVer ROWVERSION;
+GO
+
+IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'IX_AppUsers_RowVer')
+    CREATE INDEX IX_AppUsers_RowVer ON dbo.AppUsers(RowVer);
+IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'IX_EmailCredentials_RowVer')
+    CREATE INDEX IX_EmailCredentials_RowVer ON dbo.EmailCredentials(RowVer);
+GO
+
 -- Tabla de Categorías (Transporte, Comida, Servicios...)
 IF OBJECT_ID('dbo.Categories', 'U') IS NULL
 CREATE TABLE dbo.Categories (
@@ -107,6 +120,19 @@ CREATE TABLE dbo.ComercioReglaUsuario (
 );
 GO
 
+-- Marcadores de cambio para el catálogo de comercios del watcher (comercios.py)
+IF COL_LENGTH('dbo.Comercio', 'RowVer') IS NULL
+    ALTER TABLE dbo.Comercio ADD RowVer ROWVERSION;
+IF COL_LENGTH('dbo.ComercioReglaUsuario', 'RowVer') IS NULL
+    ALTER TABLE dbo.ComercioReglaUsuario ADD RowVer ROWVERSION;
+GO
+
+IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'IX_Comercio_RowVer')
+    CREATE INDEX IX_Comercio_RowVer ON dbo.Comercio(RowVer);
+IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'IX_ComercioReglaUsuario_RowVer')
+    CREATE INDEX IX_ComercioReglaUsuario_RowVer ON dbo.ComercioReglaUsuario(RowVer);
+GO
+
 -- Tabla de transacciones
 IF OBJECT_ID('dbo.Transactions', 'U') IS NULL
 CREATE TABLE dbo.Transactions (
@@ -128,6 +154,95 @@ CREATE INDEX IX_Transactions_ComercioMonth ON dbo.Transactions(ComercioId, Trans
 CREATE INDEX IX_Transactions_CardLast4Month ON dbo.Transactions(CardLast4, TransactionAt);
 GO
 
+-- Historial por usuario (/recientes): paginación por keyset sobre (TransactionAt, Id)
+IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'IX_Transactions_UserCard_TransactionAt')
+    CREATE INDEX IX_Transactions_UserCard_TransactionAt
+        ON dbo.Transactions(UserCardId, TransactionAt DESC, Id DESC)
+        INCLUDE (ComercioId, AmountUSD, Points, Multiplicador);
+GO
+
+-- Checkpoint de sincronización IMAP por usuario (UIDVALIDITY + último UID procesado)
+IF OBJECT_ID('dbo.MailboxSyncState', 'U') IS NULL
+CREATE TABLE dbo.MailboxSyncState (
+    AppUserId   INT NOT NULL PRIMARY KEY,
+    Email       NVARCHAR(256) NOT NULL,
+    UidValidity BIGINT NOT NULL,
+    LastUid     BIGINT NOT NULL,
+    UpdatedAt   DATETIME2(0) NOT NULL DEFAULT SYSUTCDATETIME(),
+    CONSTRAINT FK_SyncState_User FOREIGN KEY (AppUserId) REFERENCES dbo.AppUsers(UserId)
+);
+GO
+
+-- Correos ya registrados por usuario: la clave única impide contar dos veces la misma
+-- compra aunque el watcher reprocese un correo (caída antes de guardar el checkpoint,
+-- cambio de shard, recarga del buzón). MessageKey = SHA-256 truncado del Message-ID.
+IF OBJECT_ID('dbo.ProcessedMessages', 'U') IS NULL
+CREATE TABLE dbo.ProcessedMessages (
+    AppUserId     INT NOT NULL,
+    MessageKey    BINARY(16) NOT NULL,
+    TransactionId BIGINT NULL,
+    ProcessedAt   DATETIME2(0) NOT NULL DEFAULT SYSUTCDATETIME(),
+    CONSTRAINT PK_ProcessedMessages PRIMARY KEY (AppUserId, MessageKey),
+    CONSTRAINT FK_Processed_User FOREIGN KEY (AppUserId) REFERENCES dbo.AppUsers(UserId)
+);
+GO
+
+-- Modo por shards del watcher: cada AppUser pertenece al shard UserId % TotalShards
+-- y cada shard lo atiende el trabajador que tiene su arriendo (lease) vigente.
+IF OBJECT_ID('dbo.WatcherWorkers', 'U') IS NULL
+CREATE TABLE dbo.WatcherWorkers (
+    WorkerId    NVARCHAR(128) NOT NULL PRIMARY KEY,
+    HeartbeatAt DATETIME2(3) NOT NULL DEFAULT SYSUTCDATETIME()
+);
+GO
+
+IF OBJECT_ID('dbo.WatcherShardLease', 'U') IS NULL
+CREATE TABLE dbo.WatcherShardLease (
+    ShardId     INT NOT NULL PRIMARY KEY,
+    WorkerId    NVARCHAR(128) NULL,          -- NULL = libre
+    LeaseUntil  DATETIME2(3) NULL,           -- vencido = lo puede tomar otro trabajador
+    HeartbeatAt DATETIME2(3) NULL
+);
+GO
+
+-- Totales por usuario, mes y categoría para /resumen (se mantienen en los SPs de escritura).
+-- CategoryId = 0 agrupa los comercios que aún no tienen categoría.
+IF OBJECT_ID('dbo.MonthlyPointsRollup', 'U') IS NULL
+BEGIN
+    CREATE TABLE dbo.MonthlyPointsRollup (
+        AppUserId   INT NOT NULL,
+        MonthStart  DATE NOT NULL,
+        CategoryId  INT NOT NULL,
+        TotalUSD    DECIMAL(14,2) NOT NULL,
+        TotalPoints INT NOT NULL,
+        TxCount     INT NOT NULL,
+        CONSTRAINT PK_MonthlyPointsRollup PRIMARY KEY (AppUserId, MonthStart, CategoryId),
+        CONSTRAINT FK_Rollup_User FOREIGN KEY (AppUserId) REFERENCES dbo.AppUsers(UserId)
+    );
+
+    -- Carga inicial con el historial existente
+    INSERT INTO dbo.MonthlyPointsRollup (AppUserId, MonthStart, CategoryId, TotalUSD, TotalPoints, TxCount)
+    SELECT uc.AppUserId,
+           DATEFROMPARTS(YEAR(t.TransactionAt), MONTH(t.TransactionAt), 1),
+           ISNULL(m.CategoryId, 0),
+           SUM(t.AmountUSD), SUM(t.Points), COUNT(*)
+    FROM dbo.Transactions t
+    INNER JOIN dbo.UserCards uc ON t.UserCardId = uc.Id
+    INNER JOIN dbo.Comercio m ON t.ComercioId = m.Id
+    GROUP BY uc.AppUserId, DATEFROMPARTS(YEAR(t.TransactionAt), MONTH(t.TransactionAt), 1), ISNULL(m.CategoryId, 0);
+END
+GO
+
+-- Versión de los datos de cada usuario: los SPs de escritura la incrementan y el bot
+-- la compara antes de usar su cache de /recientes, /tarjetas y /resumen.
+IF OBJECT_ID('dbo.UserDataVersion', 'U') IS NULL
+CREATE TABLE dbo.UserDataVersion (
+    AppUserId INT NOT NULL PRIMARY KEY,
+    Version   BIGINT NOT NULL,
+    CONSTRAINT FK_UserDataVersion_User FOREIGN KEY (AppUserId) REFERENCES dbo.AppUsers(UserId)
+);
+GO
+
 -- Tabla de Auditoría de Validaciones (Bot)
 IF OBJECT_ID('dbo.AuditoriaValidaciones', 'U') IS NULL
 CREATE TABLE dbo.AuditoriaValidaciones (
@@ -148,6 +263,34 @@ CREATE TABLE dbo.ErrorLog (
 );
 GO
 
+-- Tipo tabla para insertar transacciones en lote.
+-- Un tipo en uso no se puede alterar: si viene de una versión anterior (sin TransactionAt) se recrea.
+IF TYPE_ID('dbo.EmailTransactionList') IS NOT NULL
+   AND NOT EXISTS (
+       SELECT 1 FROM sys.table_types tt
+       INNER JOIN sys.columns c ON c.object_id = tt.type_table_object_id
+       WHERE tt.name = 'EmailTransactionList' AND c.name = 'TransactionAt'
+   )
+BEGIN
+    IF OBJECT_ID('dbo.sp_InsertTransactionsFromEmailBulk', 'P') IS NOT NULL
+        DROP PROCEDURE dbo.sp_InsertTransactionsFromEmailBulk;
+    DROP TYPE dbo.EmailTransactionList;
+END
+GO
+
+IF TYPE_ID('dbo.EmailTransactionList') IS NULL
+CREATE TYPE dbo.EmailTransactionList AS TABLE (
+    RowNum           INT NOT NULL PRIMARY KEY, -- Posición en el lote enviado por Python
+    AppUserId        INT NOT NULL,
+    RawComercioTexto NVARCHAR(200) NOT NULL,
+    CardLast4        CHAR(4) NOT NULL,
+    BankName         NVARCHAR(100) NOT NULL,
+    AmountUSD        DECIMAL(12,2) NOT NULL,
+    MessageKey       BINARY(16) NULL,       -- NULL = sin control de duplicados
+    TransactionAt    DATETIME2(0) NULL      -- Fecha del correo (UTC); NULL = ahora
+);
+GO
+
 -- Procedimiento para Registrar/Login
 CREATE OR ALTER PROCEDURE dbo.sp_RegisterUser
     @ChatId BIGINT,
@@ -245,6 +388,7 @@ BEGIN
         );
 
         SET @CardId = SCOPE_IDENTITY();
+        EXEC dbo.sp_MarcarCambioUsuario @AppUserId;
     END
 
     -- 3. Devolvemos el ID para que lo uses en la transacción
@@ -271,6 +415,48 @@ BEGIN
 END;
 GO
 
+-- Suma (o resta, con deltas negativos) una transacción al acumulado mensual
+CREATE OR ALTER PROCEDURE dbo.sp_AjustarRollupMensual
+    @AppUserId INT,
+    @TransactionAt DATETIME2(0),
+    @CategoryId INT,               -- NULL = sin categoría
+    @DeltaUSD DECIMAL(14,2),
+    @DeltaPoints INT,
+    @DeltaCount INT
+AS
+BEGIN
+    SET NOCOUNT ON;
+    DECLARE @MonthStart DATE = DATEFROMPARTS(YEAR(@TransactionAt), MONTH(@TransactionAt), 1);
+
+    MERGE dbo.MonthlyPointsRollup WITH (HOLDLOCK) AS target
+    USING (SELECT @AppUserId AS AppUserId, @MonthStart AS MonthStart, ISNULL(@CategoryId, 0) AS CategoryId) AS source
+    ON (target.AppUserId = source.AppUserId AND target.MonthStart = source.MonthStart AND target.CategoryId = source.CategoryId)
+    WHEN MATCHED THEN
+        UPDATE SET TotalUSD = target.TotalUSD + @DeltaUSD,
+                   TotalPoints = target.TotalPoints + @DeltaPoints,
+                   TxCount = target.TxCount + @DeltaCount
+    WHEN NOT MATCHED THEN
+        INSERT (AppUserId, MonthStart, CategoryId, TotalUSD, TotalPoints, TxCount)
+        VALUES (source.AppUserId, source.MonthStart, source.CategoryId, @DeltaUSD, @DeltaPoints, @DeltaCount);
+END;
+GO
+
+-- Marca que cambiaron los datos del usuario (invalida la cache del bot)
+CREATE OR ALTER PROCEDURE dbo.sp_MarcarCambioUsuario
+    @AppUserId INT
+AS
+BEGIN
+    SET NOCOUNT ON;
+    MERGE dbo.UserDataVersion WITH (HOLDLOCK) AS target
+    USING (SELECT @AppUserId AS AppUserId) AS source
+    ON (target.AppUserId = source.AppUserId)
+    WHEN MATCHED THEN
+        UPDATE SET Version = target.Version + 1
+    WHEN NOT MATCHED THEN
+        INSERT (AppUserId, Version) VALUES (source.AppUserId, 1);
+END;
+GO
+
 -- Procedimiento para insertar transacción 
 CREATE OR ALTER PROCEDURE dbo.sp_InsertTransactionFromEmail
     @AppUserId INT,                 -- ID del usuario (dueño del correo)
@@ -280,8 +466,10 @@ CREATE OR ALTER PROCEDURE dbo.sp_InsertTransactionFromEmail
     @BankName NVARCHAR(100),        -- "Global Bank" (por si hay que crear la tarjeta nueva)
     -- Salidas para Bot
     @TransactionId INT OUTPUT,
-    @BotAction VARCHAR(20) OUTPUT, -- 'AUTO', 'ASK_MULT', 'ASK_CAT', 'ASK_BOTH'
-    @MessageText NVARCHAR(MAX) OUTPUT
+    @BotAction VARCHAR(20) OUTPUT, -- 'AUTO', 'ASK_MULT', 'ASK_CAT', 'ASK_BOTH', 'DUPLICATE'
+    @MessageText NVARCHAR(MAX) OUTPUT,
+    @MessageKey BINARY(16) = NULL,  -- Clave del correo (dbo.ProcessedMessages)
+    @TransactionAt DATETIME2(0) = NULL -- Fecha del correo (UTC); NULL = ahora (backfill usa la original)
 AS
 BEGIN
     SET NOCOUNT ON;
@@ -289,9 +477,26 @@ BEGIN
     DECLARE @StoredMultiplier DECIMAL(4,2);
     DECLARE @RawComercioLimpio NVARCHAR(200) = LTRIM(RTRIM(@RawComercioTexto));
     DECLARE @Points INT;
+    DECLARE @Now DATETIME2(0) = ISNULL(@TransactionAt, SYSUTCDATETIME());
 
     BEGIN TRANSACTION;
 
+    -- 0. Correo ya registrado: no se vuelve a contar
+    IF @MessageKey IS NOT NULL
+    BEGIN
+        SELECT @TransactionId = TransactionId
+        FROM dbo.ProcessedMessages WITH (UPDLOCK, HOLDLOCK)
+        WHERE AppUserId = @AppUserId AND MessageKey = @MessageKey;
+
+        IF @@ROWCOUNT > 0
+        BEGIN
+            SET @BotAction = 'DUPLICATE';
+            SET @MessageText = NULL;
+            COMMIT TRANSACTION;
+            RETURN;
+        END
+    END
+
     -- 1. Gestionar Comercio
     SELECT @ComercioId = Id, @CategoryId = CategoryId FROM dbo.Comercio WHERE Name = @RawComercioLimpio;
 
@@ -324,7 +529,7 @@ BEGIN
         SET @Points = CAST((@AmountUSD * @StoredMultiplier) AS INT);
         
         INSERT INTO dbo.Transactions (UserCardId, ComercioId, CardLast4, AmountUSD, Points, TransactionAt, Multiplicador)
-        VALUES (@UserCardId, @ComercioId, @CardLast4, @AmountUSD, @Points, SYSUTCDATETIME(), @StoredMultiplier);
+        VALUES (@UserCardId, @ComercioId, @CardLast4, @AmountUSD, @Points, @Now, @StoredMultiplier);
         
         SET @TransactionId = SCOPE_IDENTITY();
         
@@ -345,9 +550,10 @@ BEGIN
         --- ESCENARIO: NUEVO / MANUAL ---
         -- Insertamos pendiente (0 puntos)
         INSERT INTO dbo.Transactions (UserCardId, ComercioId, CardLast4, AmountUSD, Points, TransactionAt)
-        VALUES (@UserCardId, @ComercioId, @CardLast4, @AmountUSD, 0, SYSUTCDATETIME());
+        VALUES (@UserCardId, @ComercioId, @CardLast4, @AmountUSD, 0, @Now);
         
         SET @TransactionId = SCOPE_IDENTITY();
+        SET @Points = 0;
         
         IF @CategoryId IS NULL
              SET @BotAction = 'ASK_BOTH'; -- No sé ni puntos ni categoría
@@ -357,7 +563,175 @@ BEGIN
         SET @MessageText = CONCAT('❓ Nueva compra en ', @RawComercioLimpio, ' ($', @AmountUSD, '). Configuración requerida.');
     END
 
+    -- 5. Acumulado mensual para /resumen
+    EXEC dbo.sp_AjustarRollupMensual @AppUserId, @Now, @CategoryId, @AmountUSD, @Points, 1;
+
+    -- 6. Marcar el correo como procesado
+    IF @MessageKey IS NOT NULL
+        INSERT INTO dbo.ProcessedMessages (AppUserId, MessageKey, TransactionId)
+        VALUES (@AppUserId, @MessageKey, @TransactionId);
+
+    -- 7. Nueva versión de los datos del usuario
+    EXEC dbo.sp_MarcarCambioUsuario @AppUserId;
+
+    COMMIT TRANSACTION;
+END;
+GO
+
+-- Versión por lotes de sp_InsertTransactionFromEmail (misma lógica, basada en conjuntos)
+CREATE OR ALTER PROCEDURE dbo.sp_InsertTransactionsFromEmailBulk
+    @Items dbo.EmailTransactionList READONLY
+AS
+BEGIN
+    SET NOCOUNT ON;
+    SET XACT_ABORT ON;
+
+    DECLARE @Rows TABLE (
+        RowNum INT PRIMARY KEY,
+        AppUserId INT NOT NULL,
+        ComercioName NVARCHAR(200) NOT NULL,
+        CardLast4 CHAR(4) NOT NULL,
+        BankName NVARCHAR(100) NOT NULL,
+        AmountUSD DECIMAL(12,2) NOT NULL,
+        ComercioId INT NULL,
+        CategoryId INT NULL,        -- NULL si el comercio es nuevo (igual que el SP individual)
+        UserCardId INT NULL,
+        StoredMultiplier DECIMAL(4,2) NULL,
+        Points INT NOT NULL DEFAULT 0,
+        MessageKey BINARY(16) NULL,
+        TransactionAt DATETIME2(0) NOT NULL
+    );
+    DECLARE @Ids TABLE (RowNum INT PRIMARY KEY, TransactionId BIGINT NOT NULL);
+    DECLARE @Dups TABLE (RowNum INT PRIMARY KEY, TransactionId BIGINT NULL);
+    DECLARE @Now DATETIME2(0) = SYSUTCDATETIME();
+
+    INSERT INTO @Rows (RowNum, AppUserId, ComercioName, CardLast4, BankName, AmountUSD, MessageKey, TransactionAt)
+    SELECT RowNum, AppUserId, LTRIM(RTRIM(RawComercioTexto)), CardLast4, BankName, AmountUSD, MessageKey,
+           ISNULL(TransactionAt, @Now)
+    FROM @Items;
+
+    BEGIN TRANSACTION;
+
+    -- 0. Correos ya registrados (o repetidos dentro del lote): se apartan y no se cuentan
+    INSERT INTO @Dups (RowNum, TransactionId)
+    SELECT r.RowNum, p.TransactionId
+    FROM @Rows r
+    INNER JOIN dbo.ProcessedMessages p WITH (UPDLOCK, HOLDLOCK)
+        ON p.AppUserId = r.AppUserId AND p.MessageKey = r.MessageKey;
+
+    INSERT INTO @Dups (RowNum, TransactionId)
+    SELECT r.RowNum, NULL
+    FROM @Rows r
+    WHERE r.MessageKey IS NOT NULL
+      AND NOT EXISTS (SELECT 1 FROM @Dups d WHERE d.RowNum = r.RowNum)
+      AND EXISTS (SELECT 1 FROM @Rows r2
+                  WHERE r2.AppUserId = r.AppUserId AND r2.MessageKey = r.MessageKey AND r2.RowNum < r.RowNum);
+
+    DELETE r FROM @Rows r INNER JOIN @Dups d ON d.RowNum = r.RowNum;
+
+    -- 1. Comercios existentes y luego los nuevos en un solo INSERT
+    UPDATE r SET ComercioId = m.Id, CategoryId = m.CategoryId
+    FROM @Rows r
+    INNER JOIN dbo.Comercio m WITH (UPDLOCK, HOLDLOCK) ON m.Name = r.ComercioName;
+
+    INSERT INTO dbo.Comercio (Name)
+    SELECT DISTINCT ComercioName FROM @Rows WHERE ComercioId IS NULL;
+
+    UPDATE r SET ComercioId = m.Id
+    FROM @Rows r
+    INNER JOIN dbo.Comercio m ON m.Name = r.ComercioName
+    WHERE r.ComercioId IS NULL;
+
+    -- 2. Tarjetas: crear las que falten (el banco y alias salen de la primera fila del lote)
+    INSERT INTO dbo.UserCards (AppUserId, CardLast4, Bank, Alias)
+    SELECT n.AppUserId, n.CardLast4, n.BankName, CONCAT(n.BankName, ' *', n.CardLast4)
+    FROM (
+        SELECT AppUserId, CardLast4, BankName,
+               ROW_NUMBER() OVER (PARTITION BY AppUserId, CardLast4 ORDER BY RowNum) AS Rn
+        FROM @Rows
+    ) n
+    WHERE n.Rn = 1
+      AND NOT EXISTS (
+          SELECT 1 FROM dbo.UserCards uc WITH (UPDLOCK, HOLDLOCK)
+          WHERE uc.AppUserId = n.AppUserId AND uc.CardLast4 = n.CardLast4
+      );
+
+    UPDATE r SET UserCardId = uc.Id
+    FROM @Rows r
+    INNER JOIN dbo.UserCards uc ON uc.AppUserId = r.AppUserId AND uc.CardLast4 = r.CardLast4;
+
+    -- 3. Reglas de acumulación
+    UPDATE r SET StoredMultiplier = cr.Multiplicador,
+                 Points = CAST((r.AmountUSD * cr.Multiplicador) AS INT)
+    FROM @Rows r
+    INNER JOIN dbo.ComercioReglaUsuario cr ON cr.ComercioId = r.ComercioId AND cr.UserCardId = r.UserCardId;
+
+    -- 4. Insertar transacciones; MERGE permite mapear RowNum -> Id insertado
+    MERGE dbo.Transactions AS target
+    USING @Rows AS r ON 1 = 0
+    WHEN NOT MATCHED THEN
+        INSERT (UserCardId, ComercioId, CardLast4, AmountUSD, Points, TransactionAt, Multiplicador)
+        VALUES (r.UserCardId, r.ComercioId, r.CardLast4, r.AmountUSD, r.Points, r.TransactionAt, r.StoredMultiplier)
+    OUTPUT r.RowNum, inserted.Id INTO @Ids (RowNum, TransactionId);
+
+    -- 5. Acumulado mensual: una fila por (usuario, mes, categoría) del lote
+    MERGE dbo.MonthlyPointsRollup WITH (HOLDLOCK) AS target
+    USING (
+        SELECT AppUserId, DATEFROMPARTS(YEAR(TransactionAt), MONTH(TransactionAt), 1) AS MonthStart, ISNULL(CategoryId, 0) AS CategoryId,
+               SUM(AmountUSD) AS DeltaUSD, SUM(Points) AS DeltaPoints, COUNT(*) AS DeltaCount
+        FROM @Rows
+        GROUP BY AppUserId, DATEFROMPARTS(YEAR(TransactionAt), MONTH(TransactionAt), 1), ISNULL(CategoryId, 0)
+    ) AS source
+    ON (target.AppUserId = source.AppUserId AND target.MonthStart = source.MonthStart AND target.CategoryId = source.CategoryId)
+    WHEN MATCHED THEN
+        UPDATE SET TotalUSD = target.TotalUSD + source.DeltaUSD,
+                   TotalPoints = target.TotalPoints + source.DeltaPoints,
+                   TxCount = target.TxCount + source.DeltaCount
+    WHEN NOT MATCHED THEN
+        INSERT (AppUserId, MonthStart, CategoryId, TotalUSD, TotalPoints, TxCount)
+        VALUES (source.AppUserId, source.MonthStart, source.CategoryId, source.DeltaUSD, source.DeltaPoints, source.DeltaCount);
+
+    -- 6. Marcar los correos como procesados
+    INSERT INTO dbo.ProcessedMessages (AppUserId, MessageKey, TransactionId)
+    SELECT r.AppUserId, r.MessageKey, i.TransactionId
+    FROM @Rows r
+    INNER JOIN @Ids i ON i.RowNum = r.RowNum
+    WHERE r.MessageKey IS NOT NULL;
+
+    -- 7. Nueva versión de los datos de cada usuario del lote
+    MERGE dbo.UserDataVersion WITH (HOLDLOCK) AS target
+    USING (SELECT DISTINCT AppUserId FROM @Rows) AS source
+    ON (target.AppUserId = source.AppUserId)
+    WHEN MATCHED THEN
+        UPDATE SET Version = target.Version + 1
+    WHEN NOT MATCHED THEN
+        INSERT (AppUserId, Version) VALUES (source.AppUserId, 1);
+
     COMMIT TRANSACTION;
+
+    -- 8. Una fila por entrada con la acción y el mensaje para el Bot
+    SELECT
+        r.RowNum,
+        i.TransactionId,
+        CASE
+            WHEN r.StoredMultiplier IS NOT NULL AND r.CategoryId IS NULL THEN 'ASK_CAT'
+            WHEN r.StoredMultiplier IS NOT NULL THEN 'AUTO'
+            WHEN r.CategoryId IS NULL THEN 'ASK_BOTH'
+            ELSE 'ASK_MULT'
+        END AS BotAction,
+        CASE
+            WHEN r.StoredMultiplier IS NOT NULL AND r.CategoryId IS NULL
+                THEN CONCAT(N'✅ ', r.Points, N' pts agregados (x', r.StoredMultiplier, N'). Pero, ¿qué categoría es ', r.ComercioName, N'?')
+            WHEN r.StoredMultiplier IS NOT NULL
+                THEN CONCAT(N'✅ ', r.Points, N' pts agregados en ', r.ComercioName, N' (x', r.StoredMultiplier, N').')
+            ELSE CONCAT(N'❓ Nueva compra en ', r.ComercioName, N' ($', r.AmountUSD, N'). Configuración requerida.')
+        END AS MessageText
+    FROM @Rows r
+    INNER JOIN @Ids i ON i.RowNum = r.RowNum
+    UNION ALL
+    SELECT d.RowNum, d.TransactionId, 'DUPLICATE', NULL
+    FROM @Dups d
+    ORDER BY RowNum;
 END;
 GO
 
@@ -369,12 +743,20 @@ AS
 BEGIN
     SET NOCOUNT ON;
     DECLARE @ComercioId INT, @UserCardId INT, @AmountUSD DECIMAL(12,2);
-    DECLARE @NewCategoryId INT;
+    DECLARE @NewCategoryId INT, @OldCategoryId INT;
+    DECLARE @AppUserId INT, @TransactionAt DATETIME2(0), @OldPoints INT, @NewPoints INT;
+    -- Totales por usuario y mes de las transacciones del comercio (si cambia su categoría)
+    DECLARE @Mov TABLE (AppUserId INT, MonthStart DATE, USD DECIMAL(14,2), Pts INT, Cnt INT);
 
     BEGIN TRANSACTION;
 
-    SELECT @ComercioId = ComercioId, @UserCardId = UserCardId, @AmountUSD = AmountUSD
-    FROM dbo.Transactions WHERE Id = @TransactionId;
+    SELECT @ComercioId = t.ComercioId, @UserCardId = t.UserCardId, @AmountUSD = t.AmountUSD,
+           @TransactionAt = t.TransactionAt, @OldPoints = t.Points, @AppUserId = uc.AppUserId,
+           @OldCategoryId = m.CategoryId
+    FROM dbo.Transactions t
+    INNER JOIN dbo.UserCards uc ON t.UserCardId = uc.Id
+    INNER JOIN dbo.Comercio m ON t.ComercioId = m.Id
+    WHERE t.Id = @TransactionId;
 
     -- 1. Actualizar Categoría (Si el usuario la envió)
     IF @SelectedCategoryName IS NOT NULL
@@ -388,17 +770,60 @@ BEGIN
         END
 
         UPDATE dbo.Comercio SET CategoryId = @NewCategoryId WHERE Id = @ComercioId;
+
+        -- La categoría es del comercio: todas sus transacciones (de todos los usuarios)
+        -- pasan de la categoría anterior a la nueva en el acumulado mensual.
+        IF ISNULL(@OldCategoryId, 0) <> @NewCategoryId
+        BEGIN
+            INSERT INTO @Mov (AppUserId, MonthStart, USD, Pts, Cnt)
+            SELECT uc.AppUserId, DATEFROMPARTS(YEAR(t.TransactionAt), MONTH(t.TransactionAt), 1),
+                   SUM(t.AmountUSD), SUM(t.Points), COUNT(*)
+            FROM dbo.Transactions t
+            INNER JOIN dbo.UserCards uc ON t.UserCardId = uc.Id
+            WHERE t.ComercioId = @ComercioId
+            GROUP BY uc.AppUserId, DATEFROMPARTS(YEAR(t.TransactionAt), MONTH(t.TransactionAt), 1);
+
+            MERGE dbo.MonthlyPointsRollup WITH (HOLDLOCK) AS target
+            USING (
+                SELECT AppUserId, MonthStart, ISNULL(@OldCategoryId, 0) AS CategoryId, -USD AS DeltaUSD, -Pts AS DeltaPoints, -Cnt AS DeltaCount FROM @Mov
+                UNION ALL
+                SELECT AppUserId, MonthStart, @NewCategoryId, USD, Pts, Cnt FROM @Mov
+            ) AS source
+            ON (target.AppUserId = source.AppUserId AND target.MonthStart = source.MonthStart AND target.CategoryId = source.CategoryId)
+            WHEN MATCHED THEN
+                UPDATE SET TotalUSD = target.TotalUSD + source.DeltaUSD,
+                           TotalPoints = target.TotalPoints + source.DeltaPoints,
+                           TxCount = target.TxCount + source.DeltaCount
+            WHEN NOT MATCHED THEN
+                INSERT (AppUserId, MonthStart, CategoryId, TotalUSD, TotalPoints, TxCount)
+                VALUES (source.AppUserId, source.MonthStart, source.CategoryId, source.DeltaUSD, source.DeltaPoints, source.DeltaCount);
+
+            DELETE r
+            FROM dbo.MonthlyPointsRollup r
+            INNER JOIN @Mov mv ON mv.AppUserId = r.AppUserId AND mv.MonthStart = r.MonthStart
+            WHERE r.CategoryId = ISNULL(@OldCategoryId, 0) AND r.TxCount = 0;
+        END
     END
 
     -- 2. Actualizar Puntos y Regla (Si el usuario envió multiplicador)
     IF @SelectedMultiplier IS NOT NULL
     BEGIN
         -- 1. Actualizar Transacción Actual
+        SET @NewPoints = CAST((@AmountUSD * @SelectedMultiplier) AS INT);
+
         UPDATE dbo.Transactions
         SET Multiplicador = @SelectedMultiplier,
-            Points = CAST((AmountUSD * @SelectedMultiplier) AS INT)
+            Points = @NewPoints
         WHERE Id = @TransactionId;
 
+        -- Diferencia de puntos en el acumulado (categoría vigente, ya movida si cambió)
+        IF @NewPoints <> @OldPoints
+        BEGIN
+            DECLARE @CurrentCategoryId INT = ISNULL(@NewCategoryId, @OldCategoryId);
+            DECLARE @DeltaPoints INT = @NewPoints - @OldPoints;
+            EXEC dbo.sp_AjustarRollupMensual @AppUserId, @TransactionAt, @CurrentCategoryId, 0, @DeltaPoints, 0;
+        END
+
         MERGE dbo.ComercioReglaUsuario AS target
         USING (SELECT @ComercioId AS CId, @UserCardId AS UId) AS source
         ON (target.ComercioId = source.CId AND target.UserCardId = source.UId)
@@ -410,6 +835,17 @@ BEGIN
 
     END
 
+    -- 3. Nueva versión de los datos del usuario y de los clientes del comercio recategorizado
+    MERGE dbo.UserDataVersion WITH (HOLDLOCK) AS target
+    USING (SELECT @AppUserId AS AppUserId WHERE @AppUserId IS NOT NULL
+           UNION
+           SELECT AppUserId FROM @Mov) AS source
+    ON (target.AppUserId = source.AppUserId)
+    WHEN MATCHED THEN
+        UPDATE SET Version = target.Version + 1
+    WHEN NOT MATCHED THEN
+        INSERT (AppUserId, Version) VALUES (source.AppUserId, 1);
+
     COMMIT TRANSACTION;
 END;
 GO
@@ -484,11 +920,100 @@ BEGIN
 END;
 GO
 
+-- Latido de un trabajador del watcher: renueva sus shards y rebalancea.
+-- Cada trabajador vivo aspira a CEILING(TotalShards / trabajadores vivos) shards:
+-- si tiene de más cede los sobrantes (con un período de gracia para que termine
+-- lo que tenga en curso) y si tiene de menos toma shards libres o vencidos,
+-- que es como se reparten los de un trabajador caído.
+CREATE OR ALTER PROCEDURE dbo.sp_ClaimWatcherShards
+    @WorkerId NVARCHAR(128),
+    @TotalShards INT,
+    @LeaseSeconds INT,
+    @ReleaseGraceSeconds INT
+AS
+BEGIN
+    SET NOCOUNT ON;
+    SET XACT_ABORT ON;
+
+    DECLARE @Now DATETIME2(3) = SYSUTCDATETIME();
+    DECLARE @Until DATETIME2(3) = DATEADD(SECOND, @LeaseSeconds, @Now);
+    DECLARE @Workers INT, @Target INT, @Owned INT;
+
+    BEGIN TRANSACTION;
+
+    -- Un reparto a la vez: dos trabajadores no deben tomar el mismo shard libre
+    EXEC sp_getapplock @Resource = 'WatcherShardLease', @LockMode = 'Exclusive', @LockOwner = 'Transaction';
+
+    -- 1. Latido del trabajador y limpieza de los que dejaron de latir
+    MERGE dbo.WatcherWorkers AS t
+    USING (SELECT @WorkerId AS WorkerId) AS s ON t.WorkerId = s.WorkerId
+    WHEN MATCHED THEN UPDATE SET HeartbeatAt = @Now
+    WHEN NOT MATCHED THEN INSERT (WorkerId, HeartbeatAt) VALUES (s.WorkerId, @Now);
+
+    DELETE FROM dbo.WatcherWorkers WHERE HeartbeatAt < DATEADD(SECOND, -@LeaseSeconds, @Now);
+
+    -- 2. Filas de shards que falten (primera vez o TotalShards mayor)
+    ;WITH N AS (
+        SELECT TOP (@TotalShards) ROW_NUMBER() OVER (ORDER BY (SELECT NULL)) - 1 AS ShardId
+        FROM sys.all_objects a CROSS JOIN sys.all_objects b
+    )
+    INSERT INTO dbo.WatcherShardLease (ShardId)
+    SELECT n.ShardId FROM N n
+    WHERE NOT EXISTS (SELECT 1 FROM dbo.WatcherShardLease l WHERE l.ShardId = n.ShardId);
+
+    -- 3. Renovar los propios
+    UPDATE dbo.WatcherShardLease
+    SET LeaseUntil = @Until, HeartbeatAt = @Now
+    WHERE WorkerId = @WorkerId AND ShardId < @TotalShards;
+
+    SELECT @Workers = COUNT(*) FROM dbo.WatcherWorkers;
+    SET @Target = CEILING(@TotalShards * 1.0 / @Workers);
+    SELECT @Owned = COUNT(*) FROM dbo.WatcherShardLease WHERE WorkerId = @WorkerId AND ShardId < @TotalShards;
+
+    -- 4a. Sobran: se ceden los de mayor Id, bloqueados durante el período de gracia
+    IF @Owned > @Target
+        UPDATE dbo.WatcherShardLease
+        SET WorkerId = NULL, LeaseUntil = DATEADD(SECOND, @ReleaseGraceSeconds, @Now), HeartbeatAt = @Now
+        WHERE ShardId IN (
+            SELECT TOP (@Owned - @Target) ShardId FROM dbo.WatcherShardLease
+            WHERE WorkerId = @WorkerId AND ShardId < @TotalShards
+            ORDER BY ShardId DESC
+        );
+    -- 4b. Faltan: tomar libres o vencidos (incluye los de trabajadores caídos)
+    ELSE IF @Owned < @Target
+        UPDATE dbo.WatcherShardLease
+        SET WorkerId = @WorkerId, LeaseUntil = @Until, HeartbeatAt = @Now
+        WHERE ShardId IN (
+            SELECT TOP (@Target - @Owned) ShardId FROM dbo.WatcherShardLease
+            WHERE ShardId < @TotalShards AND (LeaseUntil IS NULL OR LeaseUntil <= @Now)
+            ORDER BY ShardId
+        );
+
+    COMMIT TRANSACTION;
+
+    SELECT ShardId FROM dbo.WatcherShardLease
+    WHERE WorkerId = @WorkerId AND ShardId < @TotalShards
+    ORDER BY ShardId;
+END;
+GO
+
+-- Salida ordenada de un trabajador: sus shards quedan libres de inmediato
+CREATE OR ALTER PROCEDURE dbo.sp_ReleaseWatcherShards
+    @WorkerId NVARCHAR(128)
+AS
+BEGIN
+    SET NOCOUNT ON;
+    UPDATE dbo.WatcherShardLease SET WorkerId = NULL, LeaseUntil = NULL WHERE WorkerId = @WorkerId;
+    DELETE FROM dbo.WatcherWorkers WHERE WorkerId = @WorkerId;
+END;
+GO
+
 -- 7) Resumen mensual por tarjeta
 CREATE OR ALTER PROCEDURE dbo.sp_MonthlyPointsSummary
     @TelegramChatId BIGINT,
     @Month INT = NULL, -- NULL = Mes Actual
-    @Year INT = NULL   -- NULL = Año Actual
+    @Year INT = NULL,  -- NULL = Año Actual
+    @AppUserId INT = NULL -- Opcional: evita buscar el usuario por ChatId
 AS
 BEGIN
     SET NOCOUNT ON;
@@ -497,8 +1022,11 @@ BEGIN
     IF @Month IS NULL SET @Month = MONTH(GETDATE());
     IF @Year IS NULL SET @Year = YEAR(GETDATE());
 
-    DECLARE @UserId INT;
-    SELECT @UserId = UserId FROM dbo.AppUsers WHERE TelegramChatId = @TelegramChatId;
+    DECLARE @UserId INT = @AppUserId;
+    IF @UserId IS NULL
+        SELECT @UserId = UserId FROM dbo.AppUsers WHERE TelegramChatId = @TelegramChatId;
+
+    DECLARE @MonthStart DATE = DATEFROMPARTS(@Year, @Month, 1);
 
     -- Variables para resultados
     DECLARE @TotalSpent DECIMAL(12,2) = 0;
@@ -506,35 +1034,30 @@ BEGIN
     DECLARE @TxCount INT = 0;
     DECLARE @TopCategory NVARCHAR(50) = 'Sin datos';
 
-    -- 1. Calcular Totales
+    -- 1. Calcular Totales (una fila por categoría del mes, no todo el historial)
     SELECT 
-        @TotalSpent = ISNULL(SUM(t.AmountUSD), 0),
-        @TotalPoints = ISNULL(SUM(t.Points), 0),
-        @TxCount = COUNT(*)
-    FROM dbo.Transactions t
-    INNER JOIN dbo.UserCards c ON t.UserCardId = c.Id
-    WHERE c.AppUserId = @UserId
-      AND MONTH(t.TransactionAt) = @Month 
-      AND YEAR(t.TransactionAt) = @Year;
+        @TotalSpent = ISNULL(SUM(r.TotalUSD), 0),
+        @TotalPoints = ISNULL(SUM(r.TotalPoints), 0),
+        @TxCount = ISNULL(SUM(r.TxCount), 0)
+    FROM dbo.MonthlyPointsRollup r
+    WHERE r.AppUserId = @UserId
+      AND r.MonthStart = @MonthStart;
 
     -- 2. Calcular Categoría Favorita
     SELECT TOP 1 @TopCategory = cat.Name
-    FROM dbo.Transactions t
-    INNER JOIN dbo.UserCards uc ON t.UserCardId = uc.Id
-    INNER JOIN dbo.Comercio m ON t.ComercioId = m.Id
-    INNER JOIN dbo.Categories cat ON m.CategoryId = cat.Id
-    WHERE uc.AppUserId = @UserId
-      AND MONTH(t.TransactionAt) = @Month 
-      AND YEAR(t.TransactionAt) = @Year
-    GROUP BY cat.Name
-    ORDER BY SUM(t.AmountUSD) DESC;
+    FROM dbo.MonthlyPointsRollup r
+    INNER JOIN dbo.Categories cat ON r.CategoryId = cat.Id
+    WHERE r.AppUserId = @UserId
+      AND r.MonthStart = @MonthStart
+      AND r.TxCount > 0
+    ORDER BY r.TotalUSD DESC;
 
     SELECT 
         @TotalSpent AS TotalUSD,
         @TotalPoints AS TotalPoints,
         @TxCount AS TxCount,
         ISNULL(@TopCategory, 'Sin movimientos') AS TopCategory,
-        DATENAME(MONTH, DATEFROMPARTS(@Year, @Month, 1)) AS MonthName;
+        DATENAME(MONTH, @MonthStart) AS MonthName;
 END;
 GO
 
@@ -0,0 +1,68 @@
+import threading
+import time
+
+from logger_helper import AppLogger
+
+log = AppLogger("AccountRegistry")
+
+
+class AccountRegistry:
+    """
+    Caché en memoria de las cuentas a monitorear.
+    Cada sincronización trae solo las filas de AppUsers/EmailCredentials que
+    cambiaron desde la última (ROWVERSION); la recarga completa se hace cada
+    `full_reload_interval` segundos.
+    """
+
+    def __init__(self, db, full_reload_interval=3600):
+        self.db = db
+        self.full_reload_interval = full_reload_interval
+        self._cuentas = {}   # user_id -> account
+        self._version = None
+        self._ultima_recarga = 0.0
+        self._lock = threading.Lock()
+
+    def sincronizar(self):
+        """Aplica los cambios pendientes y devuelve la lista de cuentas activas."""
+        with self._lock:
+            completa = self._version is None or time.monotonic() - self._ultima_recarga > self.full_reload_interval
+            resultado = self.db.get_monitored_accounts_changes(None if completa else self._version)
+            if resultado is None:
+                # Error de BD: seguimos con lo que ya teníamos
+                return list(self._cuentas.values())
+
+            filas, version = resultado
+            if completa:
+                anteriores = set(self._cuentas)
+                self._cuentas = {f['user_id']: self._cuenta(f) for f in filas if f['active']}
+                self._ultima_recarga = time.monotonic()
+                altas = len(set(self._cuentas) - anteriores)
+                bajas = len(anteriores - set(self._cuentas))
+            else:
+                altas = bajas = 0
+                for fila in filas:
+                    if fila['active']:
+                        altas += fila['user_id'] not in self._cuentas
+                        self._cuentas[fila['user_id']] = self._cuenta(fila)
+                    elif self._cuentas.pop(fila['user_id'], None) is not None:
+                        bajas += 1
+
+            self._version = version
+            if altas or bajas:
+                log.info("Cuentas monitoreadas: %s (+%s / -%s)", len(self._cuentas), altas, bajas)
+            elif completa and not self._cuentas:
+                log.info("No hay cuentas activas para monitorear. Esperando...")
+            return list(self._cuentas.values())
+
+    def cuentas(self):
+        with self._lock:
+            return list(self._cuentas.values())
+
+    @staticmethod
+    def _cuenta(fila):
+        return {
+            "user_id": fila['user_id'],
+            "chat_id": fila['chat_id'],
+            "email": fila['email'],
+            "password": fila['password']
+        }
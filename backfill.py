@@ -0,0 +1,263 @@
+"""
+Carga offline de compras desde archivos de correo (.mbox o carpetas con .eml).
+
+Pasa cada correo por el mismo filtro de remitentes, extracción del text/plain
+y `extraer_datos_regex` que usa el watcher, y registra las compras en lotes
+con la fecha original del correo. Los correos ya registrados (mismo Message-ID)
+se descartan en la BD, así que se puede repetir sin duplicar puntos.
+
+Uso (desde la raíz del repo):
+    python backfill.py --email usuario@gmail.com respaldo.mbox carpeta_eml/ [--procesos 4]
+                       [--lote 500] [--sin-notificar] [--solo-parsear]
+
+La memoria no depende del tamaño del archivo: los correos se leen de a uno,
+el pool tiene un número fijo de grupos en vuelo y a la BD van lotes acotados.
+"""
+import argparse
+import hashlib
+import itertools
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime, timezone
+from email.parser import BytesHeaderParser, BytesParser
+
+import gmail_watcher as watcher
+import imap_fetch
+from indice_mensajes import clave_mensaje
+from logger_helper import AppLogger
+
+log = AppLogger("Backfill")
+
+# Correos por tarea del pool (amortiza el envío entre procesos)
+CORREOS_POR_TAREA = 50
+# Notificaciones en cola antes de frenar la lectura (Telegram limita a ~1 msg/s por chat)
+MAX_NOTIFICACIONES_EN_COLA = 500
+
+_encabezados = BytesHeaderParser()
+_completo = BytesParser()
+
+
+# --- Lectura en streaming ---
+def leer_mbox(ruta):
+    """Correos de un .mbox, uno a la vez (sin cargar el archivo ni un índice en memoria)."""
+    with open(ruta, "rb") as f:
+        actual = []
+        for linea in f:
+            if linea.startswith(b"From "):
+                # Separador mbox: cierra el correo anterior y no forma parte del siguiente
+                if actual:
+                    yield b"".join(actual)
+                    actual = []
+                continue
+            if linea.startswith(b">From "):
+                linea = linea[1:]
+            actual.append(linea)
+        if actual:
+            yield b"".join(actual)
+
+
+def leer_correos(rutas):
+    """Recorre archivos .mbox, archivos .eml y carpetas (recursivas) con .eml."""
+    for ruta in rutas:
+        if os.path.isdir(ruta):
+            for raiz, carpetas, archivos in os.walk(ruta):
+                carpetas.sort()
+                for nombre in sorted(archivos):
+                    if nombre.lower().endswith(".eml"):
+                        with open(os.path.join(raiz, nombre), "rb") as f:
+                            yield f.read()
+        elif ruta.lower().endswith(".eml"):
+            with open(ruta, "rb") as f:
+                yield f.read()
+        else:
+            yield from leer_mbox(ruta)
+
+
+def agrupar(iterable, n):
+    iterador = iter(iterable)
+    while True:
+        grupo = list(itertools.islice(iterador, n))
+        if not grupo:
+            return
+        yield grupo
+
+
+# --- Proceso del pool ---
+def analizar_grupo(crudos):
+    """
+    Filtra y extrae un grupo de correos (corre en un proceso del pool).
+    :return: (correos leídos, correos de bancos, lista de compras)
+    """
+    compras = []
+    de_banco = 0
+    for crudo in crudos:
+        # Primero solo encabezados: la mayoría de los correos no son de bancos
+        correo = imap_fetch.datos_encabezados(_encabezados.parsebytes(crudo))
+        if not watcher.es_correo_banco(correo):
+            continue
+        de_banco += 1
+        texto = imap_fetch.texto_plano_mensaje(_completo.parsebytes(crudo))
+        if texto is None:
+            continue
+        datos = watcher.extraer_datos_regex(texto, correo['remitente'])
+        if not datos:
+            continue
+        datos['recibido_en'] = watcher.fecha_correo(correo['fecha'])
+        # Misma clave que el watcher; sin Message-ID se usa el contenido del correo
+        datos['clave'] = clave_mensaje(correo['message_id'], "sha256", hashlib.sha256(crudo).hexdigest())
+        compras.append(datos)
+    return len(crudos), de_banco, compras
+
+
+# --- Registro en BD ---
+class Progreso:
+    def __init__(self, cada=5):
+        self.cada = cada
+        self.inicio = time.monotonic()
+        self._ultimo = self.inicio
+        self.leidos = self.de_banco = self.compras = 0
+        self.registradas = self.duplicadas = self.fallidas = 0
+
+    def mostrar(self, forzar=False):
+        ahora = time.monotonic()
+        if not forzar and ahora - self._ultimo < self.cada:
+            return
+        self._ultimo = ahora
+        duracion = max(ahora - self.inicio, 1e-9)
+        log.info(
+            "%d correos (%.0f/s), %d de bancos, %d compras (%.1f/s) | registradas %d, duplicadas %d, fallidas %d",
+            self.leidos, self.leidos / duracion, self.de_banco, self.compras, self.compras / duracion,
+            self.registradas, self.duplicadas, self.fallidas
+        )
+
+
+def fecha_utc(epoch):
+    """Epoch -> DATETIME2 (UTC, sin zona) para TransactionAt."""
+    if epoch is None:
+        return None
+    return datetime.fromtimestamp(epoch, tz=timezone.utc).replace(tzinfo=None)
+
+
+def registrar(db, cuenta, lote, progreso, notificar):
+    compras = [{
+        "app_user_id": cuenta['user_id'],
+        "merchant_text": watcher.nombre_comercio(cuenta['user_id'], datos),
+        "card_last4": datos['last4'],
+        "bank_name": datos['banco'],
+        "amount": datos['monto'],
+        "message_key": datos['clave'],
+        "transaction_at": fecha_utc(datos['recibido_en']),
+    } for datos in lote]
+
+    resultados = db.process_transactions_bulk(compras)
+    # BD caída: se espera a que el interruptor deje probar de nuevo en vez de perder el lote
+    while resultados is None and not db.disponible():
+        time.sleep(5)
+        resultados = db.process_transactions_bulk(compras)
+    if resultados is None:
+        log.warning("Falló el lote de %d compras, reintentando una por una.", len(compras))
+        resultados = [db.process_transaction(**compra) for compra in compras]
+
+    for res in resultados:
+        if res is None:
+            progreso.fallidas += 1
+        elif res['bot_action'] == 'DUPLICATE':
+            progreso.duplicadas += 1
+        else:
+            progreso.registradas += 1
+            if notificar:
+                # Sin `origen`: la latencia correo -> Telegram de un backfill no es representativa
+                watcher.notificar_compra(cuenta['chat_id'], cuenta['email'], res)
+
+    if notificar:
+        while watcher.notificador.pendientes() > MAX_NOTIFICACIONES_EN_COLA:
+            time.sleep(0.5)
+
+
+def backfill(rutas, cuenta=None, db=None, procesos=None, lote=500, notificar=True):
+    """
+    :param cuenta: {user_id, chat_id, email}; None junto con db=None solo parsea.
+    """
+    procesos = procesos or os.cpu_count() or 1
+    progreso = Progreso()
+    pendientes = []
+
+    # spawn: el proceso padre ya tiene hilos (logging, notificador) y fork los copiaría a medias
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=procesos, mp_context=ctx) as pool:
+        grupos = agrupar(leer_correos(rutas), CORREOS_POR_TAREA)
+        en_vuelo = set()
+        agotado = False
+        while True:
+            # Ventana fija de tareas: la lectura nunca se adelanta más de 2 grupos por proceso
+            while not agotado and len(en_vuelo) < procesos * 2:
+                grupo = next(grupos, None)
+                if grupo is None:
+                    agotado = True
+                    break
+                en_vuelo.add(pool.submit(analizar_grupo, grupo))
+            if not en_vuelo:
+                break
+
+            listos, en_vuelo = wait(en_vuelo, return_when=FIRST_COMPLETED)
+            for futuro in listos:
+                leidos, de_banco, compras = futuro.result()
+                progreso.leidos += leidos
+                progreso.de_banco += de_banco
+                progreso.compras += len(compras)
+                if db is not None:
+                    pendientes.extend(compras)
+            while len(pendientes) >= lote:
+                registrar(db, cuenta, pendientes[:lote], progreso, notificar)
+                del pendientes[:lote]
+            progreso.mostrar()
+
+    if pendientes:
+        registrar(db, cuenta, pendientes, progreso, notificar)
+    progreso.mostrar(forzar=True)
+    return progreso
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("rutas", nargs="+", help="Archivos .mbox/.eml o carpetas con .eml")
+    parser.add_argument("--email", help="Correo registrado del usuario dueño de las compras")
+    parser.add_argument("--procesos", type=int, default=None, help="Procesos de parseo (por defecto, uno por CPU)")
+    parser.add_argument("--lote", type=int, default=500, help="Compras por llamada a la BD")
+    parser.add_argument("--sin-notificar", action="store_true", help="No enviar mensajes de Telegram")
+    parser.add_argument("--solo-parsear", action="store_true", help="Solo filtrar y extraer, sin tocar la BD")
+    args = parser.parse_args()
+
+    if args.solo_parsear:
+        backfill(args.rutas, procesos=args.procesos)
+        return
+    if not args.email:
+        parser.error("--email es obligatorio salvo con --solo-parsear")
+
+    try:
+        db = watcher.GlobalPointsDB()
+    except Exception as e:
+        log.error("Error crítico conectando a BD: %s", e)
+        return
+    usuario = db.get_user_data_by_email(args.email)
+    if not usuario:
+        log.error("No hay un usuario registrado con el correo %s.", args.email)
+        return
+    cuenta = dict(usuario, email=args.email)
+    if watcher.CANONICALIZAR_COMERCIOS:
+        watcher.catalogo.sincronizar(db)
+
+    notificar = not args.sin_notificar
+    if notificar:
+        watcher.notificador.iniciar()
+    try:
+        backfill(args.rutas, cuenta, db, procesos=args.procesos, lote=args.lote, notificar=notificar)
+    finally:
+        if notificar:
+            watcher.notificador.detener(timeout=60)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,310 @@
+"""
+Prueba de carga de los handlers de telegram_bot.
+
+Arma la Application real con `telegram_bot.build_application` (mismos
+handlers y ConversationHandler que en producción) sobre una Bot API local en
+proceso (`BotApiLocal`, sin red) y la BD de benchmarks/fake_db.py, y le
+entrega miles de Updates sintéticos por la update_queue, como lo haría el
+polling: comandos (/recientes, /resumen, /tarjetas, /registro con su
+conversación) y clics en botones (paginación, edición y configuración
+multiplicador + categoría) desde muchos chats simulados.
+
+Uso (desde la raíz del repo):
+    python benchmarks/bench_bot.py [--chats 1000] [--sesiones-por-chat 3] [--duracion 10]
+                                   [--latencia-bd 0.005] [--latencia-resumen 0.2] [--latencia-api 0.02]
+                                   [--concurrencia 32]
+
+Reporta por handler la latencia desde que el update entra a la cola hasta
+que termina su handler (p50/p95/p99/máx) y el tiempo propio del handler, el
+retraso máximo del event loop, updates/s, los chats cuyos updates se
+procesaron fuera de orden y las llamadas a la Bot API.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+sys.path.insert(0, os.path.join(RAIZ, "benchmarks"))
+
+from telegram import Update  # noqa: E402
+from telegram.ext import TypeHandler  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+from fake_db import FakeDB  # noqa: E402
+import botones  # noqa: E402
+
+BOT_ID = 1
+TEXTO_COMPRA = "💳 Compra en SUPER 99 por $20.13\nPuntos: 20"
+
+
+class BotApiLocal(BaseRequest):
+    """Bot API dentro del proceso: responde como Telegram, sin red, con latencia opcional."""
+
+    def __init__(self, latencia=0.0):
+        self.latencia = latencia
+        self.llamadas = {}
+        self._message_id = 0
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        metodo = url.rsplit("/", 1)[-1]
+        self.llamadas[metodo] = self.llamadas.get(metodo, 0) + 1
+        if self.latencia:
+            await asyncio.sleep(self.latencia)
+        parametros = request_data.parameters if request_data else {}
+
+        if metodo == "getMe":
+            resultado = {"id": BOT_ID, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif metodo in ("sendMessage", "editMessageText"):
+            self._message_id += 1
+            chat_id = parametros.get("chat_id")
+            resultado = {
+                "message_id": parametros.get("message_id") or self._message_id, "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": BOT_ID, "is_bot": True, "first_name": "Bench"},
+                "text": parametros.get("text", ""),
+            }
+        else:
+            resultado = True
+        return 200, json.dumps({"ok": True, "result": resultado}).encode()
+
+
+# --- Updates sintéticos ---
+class Escenarios:
+    """Secuencias de updates de un chat, como las produce un usuario real."""
+
+    def __init__(self, bot, azar):
+        self.bot = bot
+        self.azar = azar
+        self._update_id = 0
+        self._message_id = 0
+        self._transaction_id = 0
+
+    def _ids(self):
+        self._update_id += 1
+        self._message_id += 1
+        return self._update_id, self._message_id
+
+    @staticmethod
+    def _usuario(chat_id):
+        return {"id": chat_id, "is_bot": False, "first_name": f"Usuario{chat_id}"}
+
+    def mensaje(self, chat_id, texto):
+        update_id, message_id = self._ids()
+        mensaje = {"message_id": message_id, "date": int(time.time()), "text": texto,
+                   "chat": {"id": chat_id, "type": "private"}, "from": self._usuario(chat_id)}
+        if texto.startswith("/"):
+            mensaje["entities"] = [{"type": "bot_command", "offset": 0, "length": len(texto.split()[0])}]
+        return Update.de_json({"update_id": update_id, "message": mensaje}, self.bot)
+
+    def boton(self, chat_id, data, texto=TEXTO_COMPRA):
+        update_id, message_id = self._ids()
+        return Update.de_json({"update_id": update_id, "callback_query": {
+            "id": str(update_id), "chat_instance": str(chat_id), "data": data, "from": self._usuario(chat_id),
+            "message": {"message_id": message_id, "date": int(time.time()), "text": texto,
+                        "chat": {"id": chat_id, "type": "private"},
+                        "from": {"id": BOT_ID, "is_bot": True, "first_name": "Bench"}},
+        }}, self.bot)
+
+    def sesion(self, chat_id):
+        """Una interacción completa de un usuario (lista de updates en orden)."""
+        tipo = self.azar.choices(["recientes", "configuracion", "resumen", "tarjetas", "registro"],
+                                 weights=[3, 4, 2, 1, 1])[0]
+        if tipo == "recientes":
+            ultimo = chat_id * 100 + 20
+            return [self.mensaje(chat_id, "/recientes"),
+                    self.boton(chat_id, f"rec|o|{ultimo - 4}"),
+                    self.boton(chat_id, f"edit|{ultimo - 6}"),
+                    self.boton(chat_id, f"setmult|{ultimo - 6}|2.0")]
+        if tipo == "configuracion":
+            # Llega una compra nueva del watcher con el teclado combinado: multiplicador y categoría
+            self._transaction_id += 1
+            filas = botones.filas_configuracion(self._transaction_id, "b")
+            # El segundo clic sale del teclado redibujado, que ya trae el multiplicador elegido
+            redibujadas = botones.filas_configuracion(self._transaction_id, "b", botones.MULTIPLICADORES[1])
+            return [self.boton(chat_id, filas[0][1][1]), self.boton(chat_id, redibujadas[1][0][1])]
+        if tipo == "registro":
+            return [self.mensaje(chat_id, "/registro"),
+                    self.mensaje(chat_id, f"usuario{chat_id}@gmail.com"),
+                    self.mensaje(chat_id, "abcd efgh ijkl mnop")]
+        return [self.mensaje(chat_id, f"/{tipo}")]
+
+
+def etiqueta(update):
+    """Nombre del flujo al que pertenece el update (para agrupar latencias)."""
+    if update.callback_query:
+        return "boton:" + update.callback_query.data.split("|")[0]
+    texto = update.message.text
+    return texto.split()[0] if texto.startswith("/") else "registro:texto"
+
+
+def percentiles(valores):
+    if not valores:
+        return {}
+    ordenados = sorted(valores)
+    tomar = lambda p: ordenados[min(len(ordenados) - 1, int(p * len(ordenados)))]  # noqa: E731
+    return {"n": len(ordenados), "p50": tomar(0.5), "p95": tomar(0.95), "p99": tomar(0.99), "max": ordenados[-1]}
+
+
+async def vigilar_loop(retrasos, detener, paso=0.005):
+    """Mide cuánto tarda el event loop en despertar a una tarea que pidió dormir `paso`."""
+    while not detener.is_set():
+        inicio = time.perf_counter()
+        await asyncio.sleep(paso)
+        retrasos.append(time.perf_counter() - inicio - paso)
+
+
+async def correr(args):
+    import telegram_bot
+
+    db = FakeDB(latencia=args.latencia_bd, latencias={"get_monthly_summary": args.latencia_resumen})
+    api = BotApiLocal(latencia=args.latencia_api)
+    app = telegram_bot.build_application(db, token="123456:BENCH", request=api, concurrencia=args.concurrencia)
+
+    encolado, inicio, fin, tipo = {}, {}, {}, {}
+    orden = {}      # chat_id -> update_ids en el orden en que empezaron sus handlers
+    errores = []
+
+    async def marcar_inicio(update, context):
+        inicio[update.update_id] = time.perf_counter()
+        orden.setdefault(update.effective_chat.id, []).append(update.update_id)
+
+    async def marcar_fin(update, context):
+        fin[update.update_id] = time.perf_counter()
+
+    async def contar_error(update, context):
+        errores.append(repr(context.error))
+        if isinstance(update, Update):
+            fin[update.update_id] = time.perf_counter()
+
+    # Grupos antes y después de los handlers reales (que están en el grupo 0)
+    app.add_handler(TypeHandler(Update, marcar_inicio), group=-1)
+    app.add_handler(TypeHandler(Update, marcar_fin), group=99)
+    app.add_error_handler(contar_error)
+
+    await app.initialize()
+    await app.start()
+
+    # Plan: cada chat empieza en un instante al azar y encadena sus sesiones con `pausa` entre updates
+    azar = random.Random(args.semilla)
+    escenarios = Escenarios(app.bot, azar)
+    plan = []
+    for chat_id in range(1, args.chats + 1):
+        instante = azar.uniform(0, args.duracion)
+        for _ in range(args.sesiones_por_chat):
+            for update in escenarios.sesion(100000 + chat_id):
+                plan.append((instante, update))
+                instante += args.pausa
+    plan.sort(key=lambda x: x[0])
+    registros = sum(1 for _, u in plan if u.message and u.message.text == "/registro")
+
+    retrasos = []
+    detener = asyncio.Event()
+    vigilante = asyncio.create_task(vigilar_loop(retrasos, detener))
+
+    comienzo = time.perf_counter()
+    for instante, update in plan:
+        espera = comienzo + instante - time.perf_counter()
+        if espera > 0:
+            await asyncio.sleep(espera)
+        encolado[update.update_id] = time.perf_counter()
+        tipo[update.update_id] = etiqueta(update)
+        await app.update_queue.put(update)
+
+    limite = time.perf_counter() + args.espera_max
+    while len(fin) < len(plan) and time.perf_counter() < limite:
+        await asyncio.sleep(0.05)
+    duracion = time.perf_counter() - comienzo
+    detener.set()
+    await vigilante
+    await app.stop()
+    await app.shutdown()
+
+    por_tipo = {}
+    for update_id, terminado in fin.items():
+        if update_id in encolado:
+            datos = por_tipo.setdefault(tipo[update_id], ([], []))
+            datos[0].append(terminado - encolado[update_id])
+            datos[1].append(terminado - inicio.get(update_id, terminado))
+    return {
+        "updates": len(plan),
+        "procesados": len(fin),
+        "duracion_s": duracion,
+        "updates_por_s": len(fin) / duracion,
+        "handlers": {t: {"latencia": percentiles(lat), "propio": percentiles(propio)}
+                     for t, (lat, propio) in sorted(por_tipo.items())},
+        "loop_retraso_max_s": max(retrasos) if retrasos else None,
+        "loop_retraso_p99_s": percentiles(retrasos).get("p99"),
+        "chats_fuera_de_orden": sum(1 for ids in orden.values() if ids != sorted(ids)),
+        "registros_completos": db.llamadas.get("register_user_credentials", 0),
+        "registros_iniciados": registros,
+        "errores": len(errores),
+        "ejemplo_error": errores[0] if errores else None,
+        "bot_api": dict(api.llamadas),
+        "bd": dict(db.llamadas),
+    }
+
+
+def mostrar(r):
+    ms = lambda v: "-" if v is None else f"{v * 1000:.0f}"  # noqa: E731
+    print(f"{'handler':<16} {'n':>6} {'p50(ms)':>9} {'p95(ms)':>9} {'p99(ms)':>9} {'máx(ms)':>9}"
+          f" {'propio p50':>11} {'propio p99':>11}")
+    for nombre, datos in r["handlers"].items():
+        lat, propio = datos["latencia"], datos["propio"]
+        print(f"{nombre:<16} {lat['n']:>6} {ms(lat['p50']):>9} {ms(lat['p95']):>9} {ms(lat['p99']):>9}"
+              f" {ms(lat['max']):>9} {ms(propio['p50']):>11} {ms(propio['p99']):>11}")
+    print(f"\nUpdates: {r['procesados']}/{r['updates']} en {r['duracion_s']:.1f}s ({r['updates_por_s']:.0f}/s)")
+    print(f"Retraso del event loop: máx {ms(r['loop_retraso_max_s'])} ms, p99 {ms(r['loop_retraso_p99_s'])} ms")
+    print(f"Chats con updates fuera de orden: {r['chats_fuera_de_orden']}")
+    print(f"Registros completos: {r['registros_completos']}/{r['registros_iniciados']} | errores: {r['errores']}"
+          + (f" (p.ej. {r['ejemplo_error']})" if r["ejemplo_error"] else ""))
+    print(f"Bot API: {r['bot_api']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chats", type=int, default=1000)
+    parser.add_argument("--sesiones-por-chat", type=int, default=3)
+    parser.add_argument("--duracion", type=float, default=10.0, help="Segundos en los que arrancan los chats")
+    parser.add_argument("--pausa", type=float, default=0.3, help="Segundos entre updates de un mismo chat")
+    parser.add_argument("--latencia-bd", type=float, default=0.005)
+    parser.add_argument("--latencia-resumen", type=float, default=0.2, help="Latencia de get_monthly_summary")
+    parser.add_argument("--latencia-api", type=float, default=0.02, help="Latencia de cada llamada a la Bot API")
+    parser.add_argument("--hilos-bd", type=int, default=8, help="BOT_DB_CONCURRENCY")
+    parser.add_argument("--concurrencia", type=int, default=None,
+                        help="Updates en paralelo (por defecto BOT_CONCURRENT_UPDATES; 1 = secuencial)")
+    parser.add_argument("--espera-max", type=float, default=300)
+    parser.add_argument("--semilla", type=int, default=0)
+    parser.add_argument("--json", help="Guardar el resultado en este archivo")
+    args = parser.parse_args()
+
+    # telegram_bot lee la configuración al importarse; logs/ queda fuera del repo
+    os.environ.update({"BOT_DB_CONCURRENCY": str(args.hilos_bd), "LOG_LEVEL": "WARNING"})
+    salida = os.path.abspath(args.json) if args.json else None
+    os.chdir(tempfile.mkdtemp(prefix="bench_bot_"))
+
+    resultado = asyncio.run(correr(args))
+    mostrar(resultado)
+    if salida:
+        with open(salida, "w", encoding="utf-8") as f:
+            json.dump(resultado, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
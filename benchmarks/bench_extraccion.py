@@ -0,0 +1,132 @@
+"""
+Microbenchmark del motor de extracción de correos bancarios.
+
+Uso (desde la raíz del repo):
+    python benchmarks/bench_extraccion.py [--repeticiones 2000]
+
+Reporta correos/segundo y la exactitud por plantilla contra el corpus
+benchmarks/corpus_correos.json, incluido el filtro por asunto que decide qué
+cuerpos se descargan (solo los correos con compra deben pasarlo). También comprueba que los cuerpos enviados en
+base64 truncado (sin relleno o cortados) se decodifiquen y extraigan igual.
+"""
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+from extraccion import motor  # noqa: E402
+from imap_fetch import decodificar_parte  # noqa: E402
+
+CORPUS = os.path.join(RAIZ, "benchmarks", "corpus_correos.json")
+
+
+def cargar_corpus(ruta=CORPUS):
+    with open(ruta, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def evaluar(corpus):
+    """Exactitud por plantilla esperada (todos los campos deben coincidir)."""
+    aciertos = defaultdict(int)
+    totales = defaultdict(int)
+    fallos = []
+    for muestra in corpus:
+        esperado = muestra["esperado"]
+        clave = esperado["banco"] if esperado else "(sin compra)"
+        totales[clave] += 1
+        datos, _ = motor.extraer(muestra["cuerpo"], muestra["remitente"])
+        if datos == esperado or (datos and esperado and
+                                 datos["comercio"] == esperado["comercio"] and
+                                 datos["last4"] == esperado["last4"] and
+                                 datos["banco"] == esperado["banco"] and
+                                 abs(datos["monto"] - esperado["monto"]) < 0.001):
+            aciertos[clave] += 1
+        else:
+            fallos.append((muestra["remitente"], esperado, datos))
+    return aciertos, totales, fallos
+
+
+def evaluar_asuntos(corpus):
+    """:return: (correctos, fallos) del filtro por asunto: pasa si y solo si el correo trae una compra."""
+    correctos, fallos = 0, []
+    for muestra in corpus:
+        pasa = motor.es_asunto_de_compra(muestra["remitente"], muestra["asunto"])
+        if pasa == (muestra["esperado"] is not None):
+            correctos += 1
+        else:
+            fallos.append((muestra["remitente"], muestra["asunto"], pasa))
+    return correctos, fallos
+
+
+def evaluar_base64_truncado(corpus):
+    """
+    Cada cuerpo como parte base64 sin relleno y con el último carácter cortado
+    (p.ej. "SG9sYQ" en vez de "SG9sYQ=="): no debe lanzar excepción y las compras
+    se deben extraer igual.
+    :return: (correctos, total, errores)
+    """
+    correctos, errores = 0, []
+    for muestra in corpus:
+        # Se agregan espacios al final para que el corte no caiga sobre los datos
+        codificado = base64.b64encode((muestra["cuerpo"] + "   ").encode("utf-8")).rstrip(b"=")
+        for truncado in (codificado, codificado[:-1]):
+            try:
+                texto = decodificar_parte(truncado, "base64", "utf-8")
+            except Exception as e:
+                errores.append((muestra["remitente"], repr(e)))
+                continue
+            datos, _ = motor.extraer(texto, muestra["remitente"])
+            esperado = muestra["esperado"]
+            if (datos is None) == (esperado is None) and (datos is None or datos["comercio"] == esperado["comercio"]):
+                correctos += 1
+            else:
+                errores.append((muestra["remitente"], f"esperado={esperado} obtenido={datos}"))
+    return correctos, 2 * len(corpus), errores
+
+
+def medir(corpus, repeticiones):
+    inicio = time.perf_counter()
+    for _ in range(repeticiones):
+        for muestra in corpus:
+            motor.extraer(muestra["cuerpo"], muestra["remitente"])
+    duracion = time.perf_counter() - inicio
+    return repeticiones * len(corpus) / duracion
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeticiones", type=int, default=2000)
+    args = parser.parse_args()
+
+    corpus = cargar_corpus()
+    aciertos, totales, fallos = evaluar(corpus)
+
+    print(f"Corpus: {len(corpus)} correos")
+    print("Exactitud por plantilla:")
+    for clave in sorted(totales):
+        print(f"  {clave:<16} {aciertos[clave]}/{totales[clave]} ({100.0 * aciertos[clave] / totales[clave]:.1f}%)")
+    for remitente, esperado, obtenido in fallos:
+        print(f"  FALLO {remitente}: esperado={esperado} obtenido={obtenido}")
+
+    correctos, fallos_asunto = evaluar_asuntos(corpus)
+    print(f"Filtro por asunto: {correctos}/{len(corpus)} correctos")
+    for remitente, asunto, pasa in fallos_asunto:
+        print(f"  FALLO {remitente}: asunto={asunto!r} {'pasó' if pasa else 'no pasó'} el filtro")
+
+    correctos, total, errores = evaluar_base64_truncado(corpus)
+    print(f"Base64 truncado: {correctos}/{total} correctos")
+    for remitente, detalle in errores:
+        print(f"  FALLO {remitente}: {detalle}")
+
+    velocidad = medir(corpus, args.repeticiones)
+    print(f"Velocidad: {velocidad:,.0f} correos/segundo")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Prueba de carga del TelegramNotifier contra la Bot API local (telegram_stub).
+
+Uso (desde la raíz del repo):
+    python benchmarks/bench_notificador.py [--mensajes 300] [--chats 60] [--tasa-429 0.05]
+
+Verifica que cada chat reciba sus mensajes en orden, que no se viole el
+límite por chat y reporta mensajes/segundo, respuestas 429 y mensajes
+guardados en el spool.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+sys.path.insert(0, os.path.join(RAIZ, "benchmarks"))
+# El logger abre logs/ al importarse: la carpeta de trabajo es temporal para no escribir en el repo
+CARPETA = tempfile.mkdtemp(prefix="bench_notificador_")
+os.chdir(CARPETA)
+
+from notificador import TelegramNotifier  # noqa: E402
+from telegram_stub import TelegramStub  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mensajes", type=int, default=300)
+    parser.add_argument("--chats", type=int, default=60)
+    parser.add_argument("--latencia", type=float, default=0.02)
+    parser.add_argument("--tasa-429", type=float, default=0.05)
+    parser.add_argument("--intervalo-chat", type=float, default=0.5)
+    args = parser.parse_args()
+
+    stub = TelegramStub(latencia=args.latencia, tasa_429=args.tasa_429, retry_after=1,
+                        intervalo_chat=args.intervalo_chat).iniciar()
+    spool = os.path.join(CARPETA, "pendientes.jsonl")
+    notificador = TelegramNotifier("TOKEN", api_url=stub.url, spool_path=spool,
+                                   per_chat_interval=args.intervalo_chat, global_rate=30)
+    notificador.iniciar()
+
+    inicio = time.perf_counter()
+    for i in range(args.mensajes):
+        notificador.enviar(1000 + i % args.chats, f"msg {i}")
+    encolado = time.perf_counter() - inicio
+
+    while notificador.pendientes():
+        time.sleep(0.05)
+    duracion = time.perf_counter() - inicio
+    notificador.detener()
+    stub.detener()
+
+    por_chat = {}
+    for chat_id, texto, _ in stub.mensajes:
+        por_chat.setdefault(chat_id, []).append(int(texto.split()[1]))
+    desordenados = sum(1 for v in por_chat.values() if v != sorted(v))
+    en_spool = sum(1 for _ in open(spool)) if os.path.exists(spool) else 0
+
+    print(f"Encolado de {args.mensajes} mensajes: {encolado * 1000:.1f} ms")
+    print(f"Entregados: {len(stub.mensajes)}/{args.mensajes} en {duracion:.2f}s ({len(stub.mensajes) / duracion:.1f} msg/s)")
+    print(f"Respuestas 429: {stub.respuestas_429} | violaciones del límite por chat: {stub.violaciones_chat}")
+    print(f"Chats con mensajes fuera de orden: {desordenados}")
+    print(f"Mensajes en spool: {en_spool}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+"""
+Benchmark extremo a extremo del watcher con IMAP, BD y Telegram locales.
+
+Corre el código real de gmail_watcher (registro de cuentas, planificador,
+sesiones IMAP, FETCH en dos etapas, extracción, spool, índice y notificador)
+contra:
+  - benchmarks/imap_stub.py: servidor IMAP en otro proceso (IDLE incluido),
+  - benchmarks/fake_db.py: GlobalPointsDB en memoria con latencia configurable,
+  - benchmarks/telegram_stub.py: Bot API local.
+
+Cada escala corre en un proceso nuevo (así el pico de memoria es el de esa
+escala): espera el barrido inicial de todas las cuentas, entrega correos de
+bancos y de ruido durante `--ventana` segundos y espera sus notificaciones.
+
+Uso (desde la raíz del repo):
+    python benchmarks/bench_watcher.py [--escalas 10,1000,10000] [--modo poll|idle]
+                                       [--latencia-bd 0.002] [--compras 300] [--ruido 2]
+                                       [--comparar benchmarks/resultados/<archivo>.json]
+
+Reporta, por escala: barrido inicial, revisiones de cuentas por segundo,
+p50/p99 de la revisión de una cuenta, correos procesados por segundo,
+p50/p99 desde la entrega del correo hasta que llega a Telegram y el pico de
+RSS. El resultado se guarda en benchmarks/resultados/ con el commit actual.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+sys.path.insert(0, os.path.join(RAIZ, "benchmarks"))
+
+from buzones import GeneradorCorreos  # noqa: E402
+from fake_db import FakeDB  # noqa: E402
+from imap_stub import ImapStubProceso  # noqa: E402
+from telegram_stub import TelegramStub  # noqa: E402
+
+RESULTADOS = os.path.join(RAIZ, "benchmarks", "resultados")
+_CLAVE = re.compile(r"\[([0-9a-f]{32})\]")
+
+
+def percentil(valores, p):
+    if not valores:
+        return None
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(p * len(ordenados)))]
+
+
+def _esperar(condicion, limite, paso=0.05):
+    """:return: segundos hasta que `condicion()` fue verdadera, o None si se agotó `limite`."""
+    inicio = time.perf_counter()
+    while not condicion():
+        if time.perf_counter() - inicio > limite:
+            return None
+        time.sleep(paso)
+    return time.perf_counter() - inicio
+
+
+# --- Proceso de una escala ---
+def correr_escala(conexion, n_cuentas, opciones):
+    carpeta = tempfile.mkdtemp(prefix="bench_watcher_")
+    os.chdir(carpeta)   # logs/ y data/ del watcher quedan fuera del repo
+
+    imap = ImapStubProceso(latencia=opciones["latencia_imap"]).iniciar()
+    telegram = TelegramStub().iniciar()
+    intervalo = opciones["intervalo"]
+    # Antes de importar el watcher: lee la configuración al importarse (y .env no pisa lo ya definido)
+    os.environ.update({
+        "TELEGRAM_TOKEN": "BENCH",
+        "TELEGRAM_API_URL": telegram.url,
+        "TELEGRAM_SPOOL_FILE": os.path.join(carpeta, "telegram.jsonl"),
+        "WATCHER_IMAP_SERVER": "127.0.0.1",
+        "WATCHER_IMAP_PORT": str(imap.puerto),
+        "WATCHER_IMAP_SSL": "0",
+        "WATCHER_MODE": opciones["modo"],
+        "WATCHER_MAX_WORKERS": str(opciones["hilos"]),
+        "WATCHER_POLL_INTERVAL": str(intervalo),
+        "WATCHER_POLL_MIN": str(max(1, intervalo // 2)),
+        "WATCHER_POLL_MAX": str(intervalo * 2),
+        "WATCHER_SHARDED": "0",
+        "WATCHER_METRICS_PORT": "0",
+        "WATCHER_METRICS_SNAPSHOT": "",
+        "WATCHER_PROCESSED_INDEX": os.path.join(carpeta, "indice.sqlite3"),
+        "WATCHER_TX_SPOOL": os.path.join(carpeta, "spool.sqlite3"),
+        "LOG_LEVEL": "WARNING",
+    })
+    import gmail_watcher as watcher
+    import metricas
+    from indice_mensajes import clave_mensaje
+
+    cuentas = [{"user_id": i + 1, "chat_id": 100000 + i, "email": f"usuario{i}@bench.local",
+                "password": f"clave-{i}"} for i in range(n_cuentas)]
+    imap.crear_buzones([(c["email"], c["password"]) for c in cuentas])
+    db = FakeDB(cuentas, latencia=opciones["latencia_bd"])
+    watcher.GlobalPointsDB = lambda: db
+    watcher.notificador.global_rate = opciones["tasa_telegram"]
+
+    inicio = time.perf_counter()
+    threading.Thread(target=watcher.main, name="watcher", daemon=True).start()
+    barrido = _esperar(lambda: db.checkpoints() >= n_cuentas, opciones["espera_max"])
+    resultado = {"cuentas": n_cuentas, "barrido_inicial_s": barrido}
+    if barrido is None:
+        resultado["error"] = f"solo {db.checkpoints()} de {n_cuentas} cuentas revisadas"
+
+    # Régimen estable: revisiones por segundo sin correo nuevo
+    revisiones = metricas.ETAPAS.labels("cuenta")
+    antes, t0 = revisiones.total, time.perf_counter()
+    time.sleep(intervalo * 2)
+    resultado["revisiones_por_s"] = (revisiones.total - antes) / (time.perf_counter() - t0)
+
+    # Entrega de correos repartida en la ventana
+    generador = GeneradorCorreos(opciones["semilla"])
+    azar = random.Random(opciones["semilla"])
+    n_compras = opciones["compras"] if opciones["compras"] is not None else min(n_cuentas, 300)
+    destinos = ([azar.choice(cuentas) for _ in range(n_compras)] if n_compras > n_cuentas
+                else azar.sample(cuentas, n_compras))
+    plan = [(c, True) for c in destinos] + [(azar.choice(cuentas), False) for _ in range(n_compras * opciones["ruido"])]
+    azar.shuffle(plan)
+
+    vistos = metricas.CORREOS.labels("vistos")
+    vistos_antes = vistos.valor
+    entregados = {}     # clave hex -> instante de entrega
+    pasos = max(1, int(opciones["ventana"] / 0.1))
+    inicio_entrega = time.perf_counter()
+    for paso in range(pasos):
+        tramo = plan[paso * len(plan) // pasos:(paso + 1) * len(plan) // pasos]
+        lote, claves = [], []
+        for cuenta, es_banco in tramo:
+            message_id, encabezados, cuerpo = generador.banco() if es_banco else generador.ruido()
+            lote.append((cuenta["email"], encabezados, cuerpo))
+            if es_banco:
+                claves.append(clave_mensaje(message_id).hex())
+        imap.agregar_lote(lote)
+        ahora = time.monotonic()
+        entregados.update((clave, ahora) for clave in claves)
+        time.sleep(max(0.0, inicio_entrega + (paso + 1) * 0.1 - time.perf_counter()))
+
+    # Correos/s: desde la primera entrega hasta que el watcher vio el último
+    procesado = _esperar(lambda: vistos.valor - vistos_antes >= len(plan), opciones["espera_max"])
+    correos_s = (vistos.valor - vistos_antes) / (time.perf_counter() - inicio_entrega)
+    _esperar(lambda: len(telegram.mensajes) >= n_compras, opciones["espera_max"])
+
+    latencias = []
+    recibidas = set()
+    for _, texto, instante in list(telegram.mensajes):
+        encontrada = _CLAVE.search(texto or "")
+        if encontrada and encontrada.group(1) in entregados:
+            recibidas.add(encontrada.group(1))
+            latencias.append(instante - entregados[encontrada.group(1)])
+
+    cuenta_p50 = revisiones.percentil(0.5)
+    cuenta_p99 = revisiones.percentil(0.99)
+    resultado.update({
+        "correos_entregados": len(plan),
+        "compras_entregadas": n_compras,
+        "correos_por_s": correos_s,
+        "notificaciones": len(telegram.mensajes),
+        "notificaciones_unicas": len(recibidas),
+        "cuenta_p50_s": cuenta_p50,
+        "cuenta_p99_s": cuenta_p99,
+        "e2e_p50_s": percentil(latencias, 0.5),
+        "e2e_p99_s": percentil(latencias, 0.99),
+        "e2e_max_s": max(latencias) if latencias else None,
+        "rss_pico_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "hilos": threading.active_count(),
+        "llamadas_bd": dict(db.llamadas),
+        "imap": imap.estado(),
+        "duracion_s": time.perf_counter() - inicio,
+    })
+    if procesado is None:
+        resultado["error"] = f"solo {int(vistos.valor - vistos_antes)} de {len(plan)} correos procesados"
+
+    # El watcher sigue corriendo: sin log, para que no reporte como fallas las conexiones que se cierran
+    logging.disable(logging.CRITICAL)
+    imap.detener()
+    telegram.detener()
+    conexion.send(resultado)
+
+
+# --- Proceso principal ---
+def commit_actual():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=RAIZ,
+                                capture_output=True, text=True).stdout.strip()
+        cambios = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=RAIZ,
+                                 capture_output=True, text=True).stdout.strip()
+        return commit + ("-modificado" if cambios else "")
+    except Exception:
+        return "desconocido"
+
+
+def _fmt(valor, escala=1.0, decimales=2):
+    return "-" if valor is None else f"{valor * escala:.{decimales}f}"
+
+
+COLUMNAS = [
+    ("barrido_inicial_s", "barrido(s)", 1, 2),
+    ("revisiones_por_s", "revis/s", 1, 0),
+    ("cuenta_p50_s", "cuenta p50(ms)", 1000, 0),
+    ("cuenta_p99_s", "cuenta p99(ms)", 1000, 0),
+    ("correos_por_s", "correos/s", 1, 0),
+    ("e2e_p50_s", "e2e p50(s)", 1, 2),
+    ("e2e_p99_s", "e2e p99(s)", 1, 2),
+    ("rss_pico_mb", "RSS(MB)", 1, 0),
+]
+
+
+def mostrar(resultados, anteriores=None):
+    previos = {r["cuentas"]: r for r in (anteriores or [])}
+    print(f"{'cuentas':>8} " + " ".join(f"{titulo:>15}" for _, titulo, _, _ in COLUMNAS))
+    for r in resultados:
+        print(f"{r['cuentas']:>8} " + " ".join(f"{_fmt(r.get(c), e, d):>15}" for c, _, e, d in COLUMNAS))
+        previo = previos.get(r["cuentas"])
+        if previo:
+            deltas = []
+            for clave, _, _, _ in COLUMNAS:
+                a, b = previo.get(clave), r.get(clave)
+                deltas.append("-" if not a or b is None else f"{(b - a) / a * 100:+.0f}%")
+            print(f"{'vs ant.':>8} " + " ".join(f"{d:>15}" for d in deltas))
+        print(f"{'':>8} notificaciones {r.get('notificaciones_unicas')}/{r.get('compras_entregadas')}"
+              f", hilos {r.get('hilos')}" + (f"  ERROR: {r['error']}" if r.get("error") else ""))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--escalas", default="10,1000,10000", help="Cantidades de cuentas, separadas por coma")
+    parser.add_argument("--modo", choices=["poll", "idle"], default="poll")
+    parser.add_argument("--hilos", type=int, default=8, help="WATCHER_MAX_WORKERS")
+    parser.add_argument("--intervalo", type=int, default=5, help="Intervalo base de sondeo (s)")
+    parser.add_argument("--latencia-bd", type=float, default=0.002, help="Latencia por llamada a la BD (s)")
+    parser.add_argument("--latencia-imap", type=float, default=0.0, help="Latencia por comando IMAP (s)")
+    parser.add_argument("--compras", type=int, default=None, help="Correos de bancos a entregar (por defecto min(cuentas, 300))")
+    parser.add_argument("--ruido", type=int, default=2, help="Correos de ruido por cada correo de banco")
+    parser.add_argument("--ventana", type=float, default=5.0, help="Segundos en los que se reparte la entrega")
+    parser.add_argument("--tasa-telegram", type=float, default=30, help="Límite global de mensajes/s del notificador")
+    parser.add_argument("--espera-max", type=float, default=600, help="Límite de cada espera (s)")
+    parser.add_argument("--semilla", type=int, default=0)
+    parser.add_argument("--comparar", help="Resultado anterior (JSON) contra el cual comparar")
+    parser.add_argument("--no-guardar", action="store_true")
+    args = parser.parse_args()
+    opciones = {k: v for k, v in vars(args).items() if k not in ("escalas", "comparar", "no_guardar")}
+
+    ctx = multiprocessing.get_context("spawn")
+    resultados = []
+    for n in [int(e) for e in args.escalas.split(",") if e.strip()]:
+        print(f"Escala {n} cuentas...", flush=True)
+        padre, hijo = ctx.Pipe(duplex=False)
+        proceso = ctx.Process(target=correr_escala, args=(hijo, n, opciones))
+        proceso.start()
+        hijo.close()
+        try:
+            resultados.append(padre.recv())
+        except EOFError:
+            resultados.append({"cuentas": n, "error": f"el proceso terminó con código {proceso.exitcode}"})
+        proceso.join(timeout=10)
+        if proceso.is_alive():
+            proceso.terminate()
+
+    anteriores = None
+    if args.comparar:
+        with open(args.comparar, encoding="utf-8") as f:
+            anteriores = json.load(f)["resultados"]
+    mostrar(resultados, anteriores)
+
+    if not args.no_guardar:
+        commit = commit_actual()
+        os.makedirs(RESULTADOS, exist_ok=True)
+        ruta = os.path.join(RESULTADOS, f"watcher_{datetime.now():%Y%m%d_%H%M%S}_{commit}.json")
+        with open(ruta, "w", encoding="utf-8") as f:
+            json.dump({"commit": commit, "fecha": datetime.now().isoformat(timespec="seconds"),
+                       "opciones": opciones, "resultados": resultados}, f, ensure_ascii=False, indent=2)
+        print(f"Resultado guardado en {os.path.relpath(ruta, RAIZ)}")
+
+
+if __name__ == "__main__":
+    main()
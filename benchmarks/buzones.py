@@ -0,0 +1,61 @@
+"""
+Generador de correos sintéticos para el benchmark del watcher.
+
+Las confirmaciones de compra salen de las muestras de
+benchmarks/corpus_correos.json que sí traen una compra (mismo remitente,
+asunto y cuerpo que envían los bancos), con un monto variable para que cada una sea
+distinta; el ruido son boletines y avisos de remitentes que no son bancos.
+"""
+import json
+import os
+import random
+from email.header import Header
+from email.utils import format_datetime, make_msgid
+from datetime import datetime, timezone
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus_correos.json")
+
+RUIDO = [
+    ("novedades@tiendaonline.com", "Ofertas de la semana"),
+    ("no-reply@redsocial.com", "Tienes 3 notificaciones nuevas"),
+    ("boletin@noticias.com.pa", "Resumen del día"),
+    ("facturas@energia.com.pa", "Tu factura está disponible"),
+    ("equipo@trabajo.com", "Re: reunión del jueves"),
+]
+PARRAFO = ("Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor "
+           "incididunt ut labore et dolore magna aliqua.\r\n")
+
+
+def muestras_banco(ruta=CORPUS):
+    with open(ruta, encoding="utf-8") as f:
+        return [m for m in json.load(f) if m["esperado"]]
+
+
+def _encabezados(remitente, asunto, message_id, fecha):
+    # Solo los campos que pide la etapa 1 del watcher, como los devuelve HEADER.FIELDS
+    return (f"From: {remitente}\r\nSubject: {asunto}\r\nMessage-ID: {message_id}\r\n"
+            f"Date: {format_datetime(fecha)}\r\n\r\n").encode("utf-8")
+
+
+class GeneradorCorreos:
+    def __init__(self, semilla=0):
+        self._azar = random.Random(semilla)
+        self._muestras = muestras_banco()
+
+    def banco(self):
+        """:return: (message_id, encabezados, cuerpo) de una confirmación de compra."""
+        muestra = self._azar.choice(self._muestras)
+        monto = f"{muestra['esperado']['monto']:.2f}"
+        nuevo = f"{self._azar.uniform(1, 500):.2f}"
+        cuerpo = muestra["cuerpo"].replace(monto, nuevo, 1)
+        message_id = make_msgid(domain="bench.local")
+        fecha = datetime.now(timezone.utc)
+        asunto = Header(muestra["asunto"], "utf-8").encode()
+        return message_id, _encabezados(muestra["remitente"], asunto, message_id, fecha), cuerpo.encode("utf-8")
+
+    def ruido(self):
+        remitente, asunto = self._azar.choice(RUIDO)
+        message_id = make_msgid(domain="bench.local")
+        cuerpo = PARRAFO * self._azar.randint(2, 20)
+        fecha = datetime.now(timezone.utc)
+        return message_id, _encabezados(remitente, asunto, message_id, fecha), cuerpo.encode("utf-8")
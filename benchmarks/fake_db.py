@@ -0,0 +1,125 @@
+"""
+Stand-in en memoria de GlobalPointsDB para los benchmarks del watcher y del bot.
+
+Implementa lo que usan gmail_watcher (cuentas, checkpoints, registro de
+compras con descarte de duplicados por message_key) y los handlers de
+telegram_bot (historial, tarjetas, resumen, configuración, registro). Cada
+llamada bloquea el hilo durante una latencia configurable, como pyodbc
+esperando a SQL Server.
+"""
+import threading
+import time
+
+
+class FakeDB:
+    def __init__(self, cuentas=(), latencia=0.0, latencias=None):
+        """
+        :param cuentas: lista de {user_id, chat_id, email, password}.
+        :param latencias: {metodo: segundos} para los métodos más lentos que `latencia`.
+        """
+        self.latencia = latencia
+        self.latencias = latencias or {}
+        self._cuentas = [dict(c, active=True) for c in cuentas]
+        self._estados = {}          # user_id -> {email, uid_validity, last_uid}
+        self._procesados = set()    # (user_id, message_key)
+        self._lock = threading.Lock()
+        self._transaction_id = 0
+        self.llamadas = {}
+
+    def _llamada(self, nombre):
+        with self._lock:
+            self.llamadas[nombre] = self.llamadas.get(nombre, 0) + 1
+        espera = self.latencias.get(nombre, self.latencia)
+        if espera:
+            time.sleep(espera)
+
+    # --- Cuentas ---
+    def get_monitored_accounts_changes(self, since_version=None):
+        self._llamada("get_monitored_accounts_changes")
+        # Sin cambios después de la carga completa
+        return (list(self._cuentas) if since_version is None else []), 1
+
+    def get_all_monitored_accounts(self):
+        self._llamada("get_all_monitored_accounts")
+        return [{k: v for k, v in c.items() if k != "active"} for c in self._cuentas]
+
+    def get_merchant_catalog_changes(self, since_version=None):
+        self._llamada("get_merchant_catalog_changes")
+        # Catálogo vacío: cada comercio del benchmark es nuevo
+        return [], [], 1
+
+    # --- Checkpoints ---
+    def get_sync_state(self, app_user_id):
+        self._llamada("get_sync_state")
+        with self._lock:
+            estado = self._estados.get(app_user_id)
+            return dict(estado) if estado else None
+
+    def save_sync_state(self, app_user_id, email, uid_validity, last_uid):
+        self._llamada("save_sync_state")
+        with self._lock:
+            self._estados[app_user_id] = {"email": email, "uid_validity": uid_validity, "last_uid": last_uid}
+
+    def checkpoints(self):
+        with self._lock:
+            return len(self._estados)
+
+    # --- Compras ---
+    def process_transaction(self, app_user_id, merchant_text, card_last4, bank_name, amount, message_key=None,
+                            transaction_at=None, lanzar_conexion=False):
+        self._llamada("process_transaction")
+        return self._registrar(app_user_id, merchant_text, amount, message_key)
+
+    def process_transactions_bulk(self, transactions):
+        self._llamada("process_transactions_bulk")
+        return [self._registrar(t['app_user_id'], t['merchant_text'], t['amount'], t.get('message_key'))
+                for t in transactions]
+
+    def _registrar(self, app_user_id, merchant_text, amount, message_key):
+        with self._lock:
+            if message_key is not None:
+                if (app_user_id, message_key) in self._procesados:
+                    return {"transaction_id": None, "bot_action": "DUPLICATE", "message": ""}
+                self._procesados.add((app_user_id, message_key))
+            self._transaction_id += 1
+            # La clave va en el mensaje: el benchmark la usa para medir correo -> Telegram
+            clave = message_key.hex() if message_key else "-"
+            return {"transaction_id": self._transaction_id, "bot_action": "AUTO",
+                    "message": f"Compra en {merchant_text} por ${amount} [{clave}]"}
+
+    def complete_configuration(self, transaction_id, multiplier=None, category_name=None):
+        self._llamada("complete_configuration")
+        return True
+
+    # --- Bot (datos sintéticos por chat) ---
+    def register_user_credentials(self, telegram_chat_id, email, raw_password):
+        self._llamada("register_user_credentials")
+        return True
+
+    def get_transactions_page(self, chat_id, limit=5, older_than=None, newer_than=None):
+        self._llamada("get_transactions_page")
+        # Historial de 20 compras por chat con Id decreciente: base = chat_id * 100
+        ultimo = chat_id * 100 + 20
+        desde = older_than - 1 if older_than else ultimo
+        if newer_than:
+            desde = min(ultimo, newer_than + limit)
+        ids = [i for i in range(desde, desde - limit, -1) if i > chat_id * 100]
+        return {
+            "items": [{"id": i, "comercio": f"COMERCIO {i % 37}", "monto": float(i % 90 + 1),
+                       "puntos": i % 90 + 1, "multiplicador": 1.0, "fecha": "01/01 12:00"} for i in ids],
+            "has_older": bool(ids) and ids[-1] > chat_id * 100 + 1,
+            "has_newer": desde < ultimo,
+        }
+
+    def get_user_cards(self, chat_id):
+        self._llamada("get_user_cards")
+        return [{"id": 1, "banco": "Global Bank", "last4": f"{chat_id % 10000:04d}", "alias": "Principal",
+                 "fecha": None, "activa": True}]
+
+    def get_monthly_summary(self, chat_id):
+        self._llamada("get_monthly_summary")
+        return {"total_usd": 1234.5, "total_points": 2469, "count": 42, "top_category": "Comida",
+                "month_name": "Enero"}
+
+    def disponible(self):
+        return True
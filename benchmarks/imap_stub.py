@@ -0,0 +1,274 @@
+"""
+Stand-in local de un servidor IMAP (Gmail) para pruebas y benchmarks.
+
+Implementa lo que usa el watcher: CAPABILITY, LOGIN, SELECT (con UIDVALIDITY y
+UIDNEXT), UID FETCH de encabezados + BODYSTRUCTURE y de partes del cuerpo,
+NOOP, IDLE/DONE y LOGOUT. Sin TLS: el watcher se apunta con
+WATCHER_IMAP_SERVER / WATCHER_IMAP_PORT y WATCHER_IMAP_SSL=0.
+
+Corre sobre asyncio en un hilo propio, así que aguanta miles de conexiones
+persistentes. `ImapStubProceso` lo levanta en un proceso aparte (los sockets de
+ambos extremos no suman contra el límite de descriptores del proceso medido).
+"""
+import asyncio
+import multiprocessing
+import re
+import threading
+
+_TOKEN = re.compile(rb'"((?:[^"\\]|\\.)*)"|(\S+)')
+HEADER_FIELDS = b"HEADER.FIELDS (FROM SUBJECT MESSAGE-ID DATE)"
+
+
+class Buzon:
+    def __init__(self, password, uid_validity=1):
+        self.password = password
+        self.uid_validity = uid_validity
+        self.mensajes = []          # (uid, encabezados, cuerpo)
+        self.uid_next = 1
+        self.esperando = set()      # asyncio.Event de las conexiones en IDLE
+
+
+def _tokens(linea):
+    return [m.group(1).replace(b'\\"', b'"').replace(b"\\\\", b"\\") if m.group(1) is not None else m.group(2)
+            for m in _TOKEN.finditer(linea)]
+
+
+def _conjunto_uids(texto, buzon):
+    """'5:*', '3:9' o '1,4,7' -> mensajes del buzón en ese conjunto (orden por UID)."""
+    if not buzon.mensajes:
+        return []
+    ultimo = buzon.mensajes[-1][0]
+    elegidos = set()
+    for parte in texto.split(b","):
+        if b":" in parte:
+            a, b = parte.split(b":")
+            a = ultimo if a == b"*" else int(a)
+            b = ultimo if b == b"*" else int(b)
+            a, b = min(a, b), max(a, b)
+            elegidos.update(range(a, b + 1))
+        else:
+            elegidos.add(int(parte))
+    return [(i + 1, m) for i, m in enumerate(buzon.mensajes) if m[0] in elegidos]
+
+
+def _estructura(cuerpo):
+    return (b'("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "8BIT" %d %d)'
+            % (len(cuerpo), cuerpo.count(b"\n")))
+
+
+class ImapStub:
+    def __init__(self, host="127.0.0.1", puerto=0, latencia=0.0):
+        self.host = host
+        self.puerto = puerto
+        self.latencia = latencia
+        self.buzones = {}               # email -> Buzon
+        self.conexiones = 0
+        self.logins = 0
+        self.comandos = {}
+        self._loop = None
+        self._server = None
+        self._listo = threading.Event()
+
+    # --- API (segura desde otros hilos) ---
+    def iniciar(self):
+        threading.Thread(target=self._correr, name="imap-stub", daemon=True).start()
+        self._listo.wait()
+        return self
+
+    def detener(self):
+        if self._loop:
+            asyncio.run_coroutine_threadsafe(self._cerrar(), self._loop).result(timeout=10)
+
+    async def _cerrar(self):
+        self._server.close()
+        tareas = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for tarea in tareas:
+            tarea.cancel()
+        await asyncio.gather(*tareas, return_exceptions=True)
+        self._loop.call_soon(self._loop.stop)
+
+    def crear_buzon(self, email_addr, password):
+        self._en_loop(self._crear_buzon, email_addr, password)
+
+    def agregar(self, email_addr, encabezados, cuerpo):
+        """Entrega un correo (encabezados y cuerpo en bytes) y avisa a los IDLE de ese buzón."""
+        self._en_loop(self._agregar, email_addr, encabezados, cuerpo)
+
+    def _en_loop(self, funcion, *args):
+        listo = threading.Event()
+
+        def _llamar():
+            funcion(*args)
+            listo.set()
+        self._loop.call_soon_threadsafe(_llamar)
+        listo.wait()
+
+    # --- Dentro del loop ---
+    def _crear_buzon(self, email_addr, password):
+        self.buzones.setdefault(email_addr.lower(), Buzon(password))
+
+    def _agregar(self, email_addr, encabezados, cuerpo):
+        buzon = self.buzones[email_addr.lower()]
+        buzon.mensajes.append((buzon.uid_next, encabezados, cuerpo))
+        buzon.uid_next += 1
+        for evento in buzon.esperando:
+            evento.set()
+
+    def _correr(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._server = self._loop.run_until_complete(
+            asyncio.start_server(self._atender, self.host, self.puerto, backlog=4096)
+        )
+        self.puerto = self._server.sockets[0].getsockname()[1]
+        self._listo.set()
+        self._loop.run_forever()
+
+    async def _atender(self, reader, writer):
+        self.conexiones += 1
+        buzon = None
+        conocidos = 0
+        try:
+            writer.write(b"* OK IMAP stub listo\r\n")
+            while True:
+                linea = await reader.readline()
+                if not linea:
+                    break
+                partes = _tokens(linea.rstrip(b"\r\n"))
+                if len(partes) < 2:
+                    continue
+                tag, comando, args = partes[0], partes[1].upper(), partes[2:]
+                self.comandos[comando] = self.comandos.get(comando, 0) + 1
+                if self.latencia:
+                    await asyncio.sleep(self.latencia)
+
+                if comando == b"CAPABILITY":
+                    writer.write(b"* CAPABILITY IMAP4rev1 IDLE UIDPLUS\r\n" + tag + b" OK CAPABILITY\r\n")
+                elif comando == b"LOGIN":
+                    usuario, password = (args + [b"", b""])[:2]
+                    candidato = self.buzones.get(usuario.decode().lower())
+                    if candidato is None or candidato.password != password.decode():
+                        writer.write(tag + b" NO [AUTHENTICATIONFAILED] Invalid credentials\r\n")
+                    else:
+                        buzon = candidato
+                        self.logins += 1
+                        writer.write(tag + b" OK LOGIN\r\n")
+                elif comando in (b"SELECT", b"EXAMINE") and buzon is not None:
+                    conocidos = len(buzon.mensajes)
+                    writer.write(
+                        b"* %d EXISTS\r\n* 0 RECENT\r\n* OK [UIDVALIDITY %d] UIDs\r\n* OK [UIDNEXT %d] next\r\n"
+                        % (conocidos, buzon.uid_validity, buzon.uid_next)
+                        + tag + b" OK [READ-WRITE] SELECT\r\n"
+                    )
+                elif comando == b"UID" and args and args[0].upper() == b"FETCH" and buzon is not None:
+                    self._fetch(writer, buzon, args[1], b" ".join(args[2:]).upper())
+                    writer.write(tag + b" OK FETCH\r\n")
+                elif comando == b"NOOP":
+                    writer.write(tag + b" OK NOOP\r\n")
+                elif comando == b"IDLE" and buzon is not None:
+                    conocidos = await self._idle(reader, writer, buzon, conocidos)
+                    writer.write(tag + b" OK IDLE terminado\r\n")
+                elif comando == b"LOGOUT":
+                    writer.write(b"* BYE\r\n" + tag + b" OK LOGOUT\r\n")
+                    await writer.drain()
+                    break
+                else:
+                    writer.write(tag + b" BAD comando no soportado\r\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            self.conexiones -= 1
+            writer.close()
+
+    def _fetch(self, writer, buzon, conjunto, items):
+        for seq, (uid, encabezados, cuerpo) in _conjunto_uids(conjunto, buzon):
+            if b"HEADER.FIELDS" in items:
+                writer.write(b"* %d FETCH (UID %d BODYSTRUCTURE %s BODY[%s] {%d}\r\n"
+                             % (seq, uid, _estructura(cuerpo), HEADER_FIELDS, len(encabezados))
+                             + encabezados + b")\r\n")
+            else:
+                # BODY.PEEK[1]: el único text/plain
+                writer.write(b"* %d FETCH (UID %d BODY[1] {%d}\r\n" % (seq, uid, len(cuerpo)) + cuerpo + b")\r\n")
+
+    async def _idle(self, reader, writer, buzon, conocidos):
+        writer.write(b"+ idling\r\n")
+        await writer.drain()
+        evento = asyncio.Event()
+        buzon.esperando.add(evento)
+        lectura = asyncio.ensure_future(reader.readline())
+        try:
+            while True:
+                if len(buzon.mensajes) > conocidos:
+                    # Pausa breve: un EXISTS pegado al "+" podría quedar en el buffer del cliente
+                    await asyncio.sleep(0.005)
+                    conocidos = len(buzon.mensajes)
+                    writer.write(b"* %d EXISTS\r\n" % conocidos)
+                    await writer.drain()
+                espera = asyncio.ensure_future(evento.wait())
+                hechos, _ = await asyncio.wait({lectura, espera}, return_when=asyncio.FIRST_COMPLETED)
+                if lectura in hechos:
+                    espera.cancel()
+                    return conocidos      # DONE (o conexión cerrada)
+                evento.clear()
+        finally:
+            buzon.esperando.discard(evento)
+
+
+# --- Versión en un proceso aparte ---
+def _servir(conexion, host, latencia):
+    stub = ImapStub(host, latencia=latencia).iniciar()
+    conexion.send(stub.puerto)
+    while True:
+        orden, datos = conexion.recv()
+        if orden == "buzones":
+            for email_addr, password in datos:
+                stub.crear_buzon(email_addr, password)
+        elif orden == "agregar":
+            for email_addr, encabezados, cuerpo in datos:
+                stub.agregar(email_addr, encabezados, cuerpo)
+        elif orden == "estado":
+            conexion.send({"conexiones": stub.conexiones, "logins": stub.logins, "comandos": {
+                k.decode(): v for k, v in stub.comandos.items()}})
+            continue
+        elif orden == "fin":
+            stub.detener()
+            conexion.send("ok")
+            return
+        conexion.send("ok")
+
+
+class ImapStubProceso:
+    """Misma API que ImapStub (buzones y correos), con el servidor en otro proceso."""
+
+    def __init__(self, host="127.0.0.1", latencia=0.0):
+        self.host = host
+        self._conexion, hijo = multiprocessing.Pipe()
+        self._proceso = multiprocessing.get_context("spawn").Process(
+            target=_servir, args=(hijo, host, latencia), name="imap-stub", daemon=True)
+
+    def iniciar(self):
+        self._proceso.start()
+        self.puerto = self._conexion.recv()
+        return self
+
+    def _orden(self, orden, datos=None):
+        self._conexion.send((orden, datos))
+        return self._conexion.recv()
+
+    def crear_buzones(self, cuentas):
+        """:param cuentas: lista de (email, password)."""
+        self._orden("buzones", cuentas)
+
+    def agregar_lote(self, correos):
+        """:param correos: lista de (email, encabezados, cuerpo); vuelve cuando ya están en los buzones."""
+        self._orden("agregar", correos)
+
+    def estado(self):
+        return self._orden("estado")
+
+    def detener(self):
+        try:
+            self._orden("fin")
+        finally:
+            self._proceso.join(timeout=5)
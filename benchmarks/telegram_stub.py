@@ -0,0 +1,120 @@
+"""
+Stand-in local de la Bot API de Telegram para pruebas y benchmarks.
+
+Acepta `POST /bot<token>/<metodo>` con JSON, registra los sendMessage y
+responde como Telegram. Puede inyectar latencia, errores 500 y respuestas 429
+con `retry_after`, y marca como 429 los envíos al mismo chat más seguidos que
+`intervalo_chat` (igual que el límite real).
+
+Uso como script:
+    python benchmarks/telegram_stub.py --puerto 8081
+y apuntar TELEGRAM_API_URL=http://127.0.0.1:8081
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class TelegramStub:
+    def __init__(self, host="127.0.0.1", puerto=0, latencia=0.0, tasa_429=0.0, tasa_500=0.0,
+                 retry_after=1, intervalo_chat=0.0):
+        self.latencia = latencia
+        self.tasa_429 = tasa_429
+        self.tasa_500 = tasa_500
+        self.retry_after = retry_after
+        self.intervalo_chat = intervalo_chat
+
+        self.mensajes = []          # (chat_id, texto, instante)
+        self.llamadas = {}          # metodo -> cantidad
+        self.respuestas_429 = 0
+        self.violaciones_chat = 0
+        self._ultimo_por_chat = {}
+        self._lock = threading.Lock()
+        self._message_id = 0
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                largo = int(self.headers.get("Content-Length", 0))
+                cuerpo = json.loads(self.rfile.read(largo) or b"{}")
+                metodo = self.path.rsplit("/", 1)[-1]
+                estado, respuesta = stub._atender(metodo, cuerpo)
+                datos = json.dumps(respuesta).encode()
+                self.send_response(estado)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(datos)))
+                self.end_headers()
+                self.wfile.write(datos)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, puerto), Handler)
+        self._server.daemon_threads = True
+        self.url = f"http://{host}:{self._server.server_address[1]}"
+        self._hilo = None
+
+    def iniciar(self):
+        self._hilo = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._hilo.start()
+        return self
+
+    def detener(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _atender(self, metodo, cuerpo):
+        if self.latencia:
+            time.sleep(self.latencia)
+        with self._lock:
+            self.llamadas[metodo] = self.llamadas.get(metodo, 0) + 1
+            if self.tasa_500 and random.random() < self.tasa_500:
+                return 500, {"ok": False, "error_code": 500, "description": "Internal Server Error"}
+
+            limitar = self.tasa_429 and random.random() < self.tasa_429
+            chat_id = cuerpo.get("chat_id")
+            ahora = time.monotonic()
+            if metodo == "sendMessage" and self.intervalo_chat and chat_id in self._ultimo_por_chat:
+                if ahora - self._ultimo_por_chat[chat_id] < self.intervalo_chat:
+                    self.violaciones_chat += 1
+                    limitar = True
+            if limitar:
+                self.respuestas_429 += 1
+                return 429, {"ok": False, "error_code": 429,
+                             "description": f"Too Many Requests: retry after {self.retry_after}",
+                             "parameters": {"retry_after": self.retry_after}}
+
+            if metodo == "sendMessage":
+                self._ultimo_por_chat[chat_id] = ahora
+                self.mensajes.append((chat_id, cuerpo.get("text"), ahora))
+            self._message_id += 1
+            return 200, {"ok": True, "result": {
+                "message_id": self._message_id, "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, "text": cuerpo.get("text")
+            } if metodo == "sendMessage" else True}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--puerto", type=int, default=8081)
+    parser.add_argument("--latencia", type=float, default=0.0)
+    parser.add_argument("--tasa-429", type=float, default=0.0)
+    args = parser.parse_args()
+    stub = TelegramStub(puerto=args.puerto, latencia=args.latencia, tasa_429=args.tasa_429).iniciar()
+    print(f"Bot API local en {stub.url}")
+    try:
+        while True:
+            time.sleep(5)
+            print(f"sendMessage recibidos: {len(stub.mensajes)} | 429: {stub.respuestas_429}")
+    except KeyboardInterrupt:
+        stub.detener()
+
+
+if __name__ == "__main__":
+    main()
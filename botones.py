@@ -0,0 +1,141 @@
+"""
+Botones de configuración de compras (multiplicador + categoría).
+
+Los arma el watcher al notificar una compra nueva y los interpreta el bot,
+así que la codificación del callback_data vive aquí. No depende de la
+librería de Telegram: las filas son listas de (texto, callback_data).
+
+callback_data compacto (Telegram admite hasta 64 bytes):
+    c|<tx en base 36>|<pendiente>|m<i>      multiplicador MULTIPLICADORES[i]
+    c|<tx en base 36>|<pendiente>|c<j>      categoría CATEGORIAS[j]
+    c|<tx en base 36>|<pendiente>|m<i>c<j>  ambos
+`pendiente` es lo que la compra espera del usuario: m (multiplicador),
+c (categoría) o b (ambos). Cada botón lleva lo que ya se eligió más su propia
+opción, así que el segundo clic no depende de la memoria del bot (que puede
+reiniciarse o descartar el estado). Los mensajes viejos traen el formato anterior
+`cfg|<tx>|mult|<valor>` / `cfg|<tx>|cat|<nombre>`, que el bot sigue aceptando.
+"""
+import re
+import string
+import time
+from collections import OrderedDict
+
+PREFIJO = "c"
+MULTIPLICADORES = (1.0, 2.0, 3.0)
+# (texto del botón, nombre de la categoría en la BD)
+CATEGORIAS = (
+    ("Comida", "Comida"),
+    ("Transporte", "Transporte"),
+    ("Super", "Supermercado"),
+    ("Servicios", "Servicios"),
+    ("General", "General"),
+)
+PENDIENTE_POR_ACCION = {"ASK_MULT": "m", "ASK_CAT": "c", "ASK_BOTH": "b"}
+
+_DIGITOS = string.digits + string.ascii_lowercase
+_SELECCION = re.compile(r"(?:m(\d+))?(?:c(\d+))?")
+
+
+def _base36(n):
+    n = int(n)
+    texto = ""
+    while True:
+        n, resto = divmod(n, 36)
+        texto = _DIGITOS[resto] + texto
+        if not n:
+            return texto
+
+
+def codificar(tx_id, pendiente, multiplicador=None, categoria=None):
+    """:param multiplicador / categoria: índices en MULTIPLICADORES / CATEGORIAS (None = sin elegir)."""
+    seleccion = ("" if multiplicador is None else f"m{multiplicador}") + ("" if categoria is None else f"c{categoria}")
+    return f"{PREFIJO}|{_base36(tx_id)}|{pendiente}|{seleccion}"
+
+
+def decodificar(data):
+    """
+    :return: {"tx_id", "pendiente"} más "multiplicador" y/o "categoria", o None si
+             no es un callback_data de configuración en formato compacto.
+    """
+    partes = data.split("|")
+    if len(partes) != 4 or partes[0] != PREFIJO or partes[2] not in ("m", "c", "b"):
+        return None
+    seleccion = _SELECCION.fullmatch(partes[3])
+    if not partes[3] or seleccion is None:
+        return None
+    try:
+        eleccion = {"tx_id": int(partes[1], 36), "pendiente": partes[2]}
+        if seleccion.group(1) is not None:
+            eleccion["multiplicador"] = MULTIPLICADORES[int(seleccion.group(1))]
+        if seleccion.group(2) is not None:
+            eleccion["categoria"] = CATEGORIAS[int(seleccion.group(2))][1]
+    except (ValueError, IndexError):
+        return None
+    return eleccion
+
+
+def filas_configuracion(tx_id, pendiente, multiplicador=None, categoria=None):
+    """
+    Teclado combinado: fila de multiplicadores y filas de categorías según lo
+    pendiente; la opción ya elegida lleva ✓ y viaja en el callback_data de
+    los botones del otro campo.
+    :param pendiente: "m", "c" o "b" (ver PENDIENTE_POR_ACCION).
+    """
+    i_mult = MULTIPLICADORES.index(multiplicador) if multiplicador in MULTIPLICADORES else None
+    i_cat = next((i for i, (_, nombre) in enumerate(CATEGORIAS) if nombre == categoria), None)
+    filas = []
+    if pendiente in ("m", "b"):
+        filas.append([
+            (("✓ " if i == i_mult else "") + f"{valor:g}x", codificar(tx_id, pendiente, i, i_cat))
+            for i, valor in enumerate(MULTIPLICADORES)
+        ])
+    if pendiente in ("c", "b"):
+        botones = [
+            (("✓ " if i == i_cat else "") + texto, codificar(tx_id, pendiente, i_mult, i))
+            for i, (texto, _) in enumerate(CATEGORIAS)
+        ]
+        filas.extend([botones[:3], botones[3:]])
+    return filas
+
+
+def teclado_json(filas):
+    """Filas -> reply_markup para la Bot API (JSON), como lo envía el notificador del watcher."""
+    return {"inline_keyboard": [[{"text": texto, "callback_data": data} for texto, data in fila] for fila in filas]}
+
+
+class ConfiguracionesPendientes:
+    """
+    Estado de las configuraciones a medio elegir, por TransactionId: lo que
+    falta, lo ya elegido y el texto de la compra para volver a dibujar el
+    mensaje. Acotado (`maximo`, se descarta la más antigua) y con expiración
+    (`ttl`). Si una entrada se pierde, el siguiente clic la recrea desde el
+    callback_data, que ya trae todo lo elegido.
+    Solo se usa desde el event loop del bot (sin locks).
+    """
+
+    def __init__(self, ttl=86400, maximo=10000):
+        self.ttl = ttl
+        self.maximo = maximo
+        self._entradas = OrderedDict()   # tx_id -> (expira_en, estado)
+
+    def obtener(self, tx_id):
+        entrada = self._entradas.get(tx_id)
+        if entrada is None:
+            return None
+        expira_en, estado = entrada
+        if expira_en <= time.monotonic():
+            del self._entradas[tx_id]
+            return None
+        return estado
+
+    def guardar(self, tx_id, estado):
+        self._entradas[tx_id] = (time.monotonic() + self.ttl, estado)
+        self._entradas.move_to_end(tx_id)
+        while len(self._entradas) > self.maximo:
+            self._entradas.popitem(last=False)
+
+    def quitar(self, tx_id):
+        self._entradas.pop(tx_id, None)
+
+    def __len__(self):
+        return len(self._entradas)
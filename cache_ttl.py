@@ -0,0 +1,99 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class CacheTTL:
+    """
+    Cache en memoria agrupada por una clave (p.ej. el chat_id): cada grupo
+    guarda varias consultas y se invalida completo de una sola vez.
+    Los grupos expiran a los `ttl` segundos y, al pasar de `max_grupos`,
+    se descarta el usado hace más tiempo (LRU). Es segura entre hilos.
+    """
+
+    def __init__(self, ttl=30, max_grupos=1000):
+        self.ttl = ttl
+        self.max_grupos = max_grupos
+        self._grupos = OrderedDict()   # grupo -> {clave: (expira_en, valor)}
+        self._invalidado_en = {}       # grupo -> instante de su última invalidación
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidaciones = 0
+
+    def obtener(self, grupo, clave, contar=True):
+        """
+        :param contar: False para consultas internas que no deben sumar a hits/misses.
+        :return: (True, valor) si está vigente, (False, None) si no.
+        """
+        with self._lock:
+            entradas = self._grupos.get(grupo)
+            if entradas is not None and clave in entradas:
+                expira_en, valor = entradas[clave]
+                if expira_en > time.monotonic():
+                    self._grupos.move_to_end(grupo)
+                    self.hits += contar
+                    return True, valor
+                del entradas[clave]
+            self.misses += contar
+            return False, None
+
+    def contar_hit(self):
+        with self._lock:
+            self.hits += 1
+
+    def contar_miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def guardar(self, grupo, clave, valor, leido_en=None):
+        """
+        `leido_en` es el instante (time.monotonic) en que empezó la consulta:
+        si el grupo se invalidó mientras tanto, el valor ya viene viejo y no se guarda.
+        """
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            if leido_en is not None and self._invalidado_desde(grupo) >= leido_en:
+                return
+            entradas = self._grupos.get(grupo)
+            if entradas is None:
+                entradas = self._grupos[grupo] = {}
+            else:
+                self._grupos.move_to_end(grupo)
+            entradas[clave] = (time.monotonic() + self.ttl, valor)
+            while len(self._grupos) > self.max_grupos:
+                self._grupos.popitem(last=False)
+
+    def invalidar(self, grupo):
+        ahora = time.monotonic()
+        with self._lock:
+            if self._grupos.pop(grupo, None) is not None:
+                self.invalidaciones += 1
+            self._invalidado_en[grupo] = ahora
+            if len(self._invalidado_en) > self.max_grupos:
+                # Solo importan las invalidaciones recientes (consultas aún en curso)
+                self._invalidado_en = {g: t for g, t in self._invalidado_en.items() if ahora - t < self.ttl}
+
+    def limpiar(self):
+        """Invalida todos los grupos."""
+        ahora = time.monotonic()
+        with self._lock:
+            self.invalidaciones += len(self._grupos)
+            self._grupos.clear()
+            self._invalidado_en = {None: ahora}
+
+    def _invalidado_desde(self, grupo):
+        return max(self._invalidado_en.get(grupo, float("-inf")), self._invalidado_en.get(None, float("-inf")))
+
+    def estadisticas(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 3) if total else 0.0,
+                "invalidaciones": self.invalidaciones,
+                "grupos": len(self._grupos),
+            }
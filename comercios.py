@@ -0,0 +1,186 @@
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter
+
+import metricas
+from logger_helper import AppLogger
+
+log = AppLogger("Comercios")
+
+# Los bancos mandan el comercio en campos de ancho fijo: nombre (con sucursal)
+# relleno con espacios y luego la ciudad, p.ej. "PEDIDOSYA                BELLA VISTA".
+ANCHO_NOMBRE = 25
+_SEPARADOR_CAMPOS = re.compile(r"\s{2,}")
+_NO_ALFANUMERICO = re.compile(r"[^A-Z0-9]+")
+# Una cadena no se reconoce por un prefijo que termina en artículo ("DELTA EL ...", "RESTAURANTE LA ...")
+_ARTICULOS = {"EL", "LA", "LOS", "LAS", "DE", "DEL", "Y"}
+
+
+def clave(nombre):
+    """
+    Nombre del comercio -> clave de comparación: sin la ciudad, en mayúsculas,
+    sin tildes ni signos y con espacios simples.
+    "NICOLINA SALYDULCE SOH   BELLA VISTA" -> "NICOLINA SALYDULCE SOH"
+    """
+    texto = nombre.strip()
+    partes = _SEPARADOR_CAMPOS.split(texto, maxsplit=1)
+    if len(partes) > 1:
+        texto = partes[0]
+    elif len(texto) > ANCHO_NOMBRE:
+        texto = texto[:ANCHO_NOMBRE]
+    sin_tildes = unicodedata.normalize("NFKD", texto)
+    texto = "".join(c for c in sin_tildes if not unicodedata.combining(c)).upper()
+    return _NO_ALFANUMERICO.sub(" ", texto).strip()
+
+
+def trigramas(texto):
+    relleno = f"  {texto} "
+    return {relleno[i:i + 3] for i in range(len(relleno) - 2)}
+
+
+def prefijo_cadena(clave_a, clave_b):
+    """
+    Tokens iniciales en común si bastan para decir que es la misma cadena con
+    otra sucursal ("SUPER 99 VILLA ZAITA" / "SUPER 99 BRISAS" -> "SUPER 99"):
+    al menos dos tokens y 8 caracteres, sin terminar en artículo. Si no, None.
+    """
+    comunes = []
+    for a, b in zip(clave_a.split(), clave_b.split()):
+        if a != b:
+            break
+        comunes.append(a)
+    while comunes and comunes[-1] in _ARTICULOS:
+        comunes.pop()
+    prefijo = " ".join(comunes)
+    if len(comunes) >= 2 and len(prefijo) >= 8:
+        return prefijo
+    return None
+
+
+class CatalogoComercios:
+    """
+    Caché en memoria de dbo.Comercio y de las reglas de multiplicador
+    (ComercioReglaUsuario) para canonicalizar el nombre del comercio antes de
+    registrar la compra. sp_InsertTransactionFromEmail busca el comercio por
+    nombre exacto: una variante ("SUPER 99 VILLA ZAITA" con otro relleno u
+    otra sucursal) creaba otro Comercio sin regla y volvía a preguntar
+    multiplicador y categoría.
+
+    Se resuelve, en orden:
+      1. Misma clave que un comercio con regla para esa tarjeta, o que cualquier comercio.
+      2. Parecido por trigramas (Dice >= `similitud`) a un comercio conocido,
+         prefiriendo los que tienen regla para esa tarjeta.
+      3. Otra sucursal de una cadena con regla para esa tarjeta (ver prefijo_cadena).
+    Si nada coincide, el nombre queda como vino y se agrega al catálogo.
+
+    Cada sincronización trae solo lo que cambió desde la última (ROWVERSION);
+    la recarga completa se hace cada `full_reload_interval` segundos.
+    """
+
+    def __init__(self, similitud=0.8, full_reload_interval=3600):
+        self.similitud = similitud
+        self.full_reload_interval = full_reload_interval
+        self._comercios = {}       # clave -> (Name, CategoryId, cantidad de trigramas)
+        self._indice = {}          # trigrama -> set(clave)
+        self._reglas = {}          # (app_user_id, last4) -> {clave: (Name, Multiplicador)}
+        self._version = None
+        self._ultima_recarga = 0.0
+        self._lock = threading.Lock()
+
+    def sincronizar(self, db):
+        """Aplica los cambios de comercios y reglas. Devuelve False si la BD no respondió."""
+        completa = self._version is None or time.monotonic() - self._ultima_recarga > self.full_reload_interval
+        resultado = db.get_merchant_catalog_changes(None if completa else self._version)
+        if resultado is None:
+            # Error de BD: seguimos con lo que ya teníamos
+            return False
+
+        comercios, reglas, version = resultado
+        with self._lock:
+            if completa:
+                self._comercios, self._indice, self._reglas = {}, {}, {}
+                self._ultima_recarga = time.monotonic()
+            for fila in comercios:
+                self._agregar(fila['name'], fila['category_id'])
+            for fila in reglas:
+                por_tarjeta = self._reglas.setdefault((fila['app_user_id'], fila['card_last4']), {})
+                por_tarjeta[clave(fila['name'])] = (fila['name'], fila['multiplicador'])
+            self._version = version
+            total_comercios, total_reglas = len(self._comercios), sum(len(r) for r in self._reglas.values())
+        if completa:
+            log.info("Catálogo de comercios: %s comercios, %s reglas.", total_comercios, total_reglas)
+        elif comercios or reglas:
+            log.debug("Catálogo de comercios: +%s comercios, +%s reglas.", len(comercios), len(reglas))
+        return True
+
+    def _agregar(self, nombre, categoria_id=None):
+        k = clave(nombre)
+        if not k:
+            return
+        anterior = self._comercios.get(k)
+        # Con varios comercios de la misma clave se queda el primero (el de menor Id)
+        if anterior is None:
+            propios = trigramas(k)
+            self._comercios[k] = (nombre, categoria_id, len(propios))
+            for t in propios:
+                self._indice.setdefault(t, set()).add(k)
+        elif anterior[0] == nombre:
+            self._comercios[k] = (nombre, categoria_id, anterior[2])
+
+    def canonico(self, nombre, app_user_id=None, card_last4=None):
+        """Nombre con el que se registra la compra: el de un comercio conocido equivalente o el original."""
+        k = clave(nombre)
+        if not k:
+            return nombre
+        with self._lock:
+            reglas = self._reglas.get((app_user_id, card_last4), {})
+            elegido, resolucion = self._resolver(k, reglas)
+            if elegido is None:
+                # Comercio nuevo: la BD lo creará con este nombre; las variantes que
+                # lleguen antes de la próxima sincronización ya lo encuentran
+                self._agregar(nombre.strip())
+                elegido, resolucion = nombre, "nuevo"
+        metricas.COMERCIOS.labels(resolucion).inc()
+        if resolucion in ("similar", "cadena"):
+            log.debug("Comercio '%s' -> '%s' (%s).", nombre, elegido, resolucion)
+        return elegido
+
+    def _resolver(self, k, reglas):
+        if k in reglas:
+            return reglas[k][0], "regla"
+        if k in self._comercios:
+            return self._comercios[k][0], "exacto"
+
+        # Candidatos que comparten trigramas, con su Dice
+        propios = trigramas(k)
+        comunes = Counter()
+        for t in propios:
+            comunes.update(self._indice.get(t, ()))
+        mejor, mejor_puntaje = None, 0.0
+        for candidato, n in comunes.items():
+            puntaje = 2.0 * n / (len(propios) + self._comercios[candidato][2])
+            if puntaje < self.similitud:
+                continue
+            # Primero los que tienen regla para esta tarjeta, luego el más parecido
+            puntaje += 1.0 if candidato in reglas else 0.0
+            if puntaje > mejor_puntaje:
+                mejor, mejor_puntaje = candidato, puntaje
+        if mejor is not None:
+            nombre = reglas[mejor][0] if mejor in reglas else self._comercios[mejor][0]
+            return nombre, "similar"
+
+        # Otra sucursal de una cadena que el usuario ya configuró para esta tarjeta
+        mejor, mejor_largo = None, 0
+        for candidato, (nombre, _) in reglas.items():
+            prefijo = prefijo_cadena(k, candidato)
+            if prefijo and len(prefijo) > mejor_largo:
+                mejor, mejor_largo = nombre, len(prefijo)
+        if mejor is not None:
+            return mejor, "cadena"
+        return None, None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._comercios)
@@ -1,11 +1,273 @@
 import pyodbc
 import os
+import threading
+import time
+from collections import deque
+from decimal import Decimal
+from contextlib import contextmanager
 from dotenv import load_dotenv
 from logger_helper import AppLogger
+from cache_ttl import CacheTTL
 
 # Cargar variables de entorno
 load_dotenv()
 
+class PoolAgotado(Exception):
+    """Todas las conexiones del pool están en uso: es carga del proceso, no una falla de SQL Server."""
+
+
+class ConnectionPool:
+    """
+    Pool thread-safe de conexiones pyodbc.
+    Valida con SELECT 1 las conexiones que llevan tiempo inactivas al prestarlas
+    y recicla las que superan la edad máxima.
+    """
+
+    def __init__(self, connection_string, min_size=1, max_size=10, max_age=1800, ping_after=30, timeout=30):
+        self.log = AppLogger("DB_Pool")
+        self.connection_string = connection_string
+        self.min_size = min_size
+        self.max_size = max(max_size, 1)
+        self.max_age = max_age
+        self.ping_after = ping_after
+        self.timeout = timeout
+
+        self._libres = deque()   # [conn, creada_en, ultimo_uso]
+        self._total = 0
+        self._cond = threading.Condition()
+
+    def _crear(self):
+        conn = pyodbc.connect(self.connection_string, autocommit=False)
+        ahora = time.monotonic()
+        return [conn, ahora, ahora]
+
+    def llenar(self):
+        """Abre las conexiones mínimas por adelantado."""
+        while True:
+            with self._cond:
+                if self._total >= self.min_size:
+                    return
+                self._total += 1
+            try:
+                entrada = self._crear()
+            except Exception:
+                with self._cond:
+                    self._total -= 1
+                raise
+            self.liberar(entrada)
+
+    def adquirir(self):
+        limite = time.monotonic() + self.timeout
+        with self._cond:
+            while True:
+                if self._libres:
+                    entrada = self._libres.pop()
+                    break
+                if self._total < self.max_size:
+                    self._total += 1
+                    entrada = None
+                    break
+                restante = limite - time.monotonic()
+                if restante <= 0 or not self._cond.wait(restante):
+                    raise PoolAgotado(f"Pool de BD agotado ({self.max_size} conexiones en uso)")
+
+        try:
+            if entrada is None:
+                return self._crear()
+            if not self._saludable(entrada):
+                self._cerrar(entrada[0])
+                return self._crear()
+            return entrada
+        except Exception:
+            with self._cond:
+                self._total -= 1
+                self._cond.notify()
+            raise
+
+    def _saludable(self, entrada):
+        conn, creada_en, ultimo_uso = entrada
+        ahora = time.monotonic()
+        if ahora - creada_en > self.max_age:
+            return False
+        if ahora - ultimo_uso > self.ping_after:
+            try:
+                conn.cursor().execute("SELECT 1").fetchone()
+            except Exception as e:
+                self.log.warning("Conexión del pool descartada en la validación: %s", e)
+                return False
+        return True
+
+    def liberar(self, entrada, descartar=False):
+        entrada[2] = time.monotonic()
+        if descartar or entrada[2] - entrada[1] > self.max_age:
+            self._cerrar(entrada[0])
+            with self._cond:
+                self._total -= 1
+                self._cond.notify()
+            return
+        with self._cond:
+            self._libres.append(entrada)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """
+        Presta una conexión del pool. Al salir se hace rollback de lo que no se
+        haya confirmado; si el rollback falla la conexión se descarta.
+        """
+        entrada = self.adquirir()
+        descartar = False
+        try:
+            yield entrada[0]
+        finally:
+            try:
+                entrada[0].rollback()
+            except Exception:
+                descartar = True
+            self.liberar(entrada, descartar)
+
+    def cerrar(self):
+        with self._cond:
+            libres, self._libres = list(self._libres), deque()
+            self._total -= len(libres)
+        for conn, _, _ in libres:
+            self._cerrar(conn)
+
+    @staticmethod
+    def _cerrar(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+class BDNoDisponible(Exception):
+    """El interruptor está abierto: no se intenta hablar con SQL Server."""
+
+
+def es_error_conexion(e):
+    """
+    Errores de red/servidor de pyodbc (no de datos): son los que abren el interruptor.
+    PoolAgotado no cuenta: el servidor puede estar sano y solo faltan conexiones libres.
+    """
+    if isinstance(e, PoolAgotado):
+        return False
+    if isinstance(e, (pyodbc.OperationalError, pyodbc.InterfaceError)):
+        return True
+    # SQLSTATE 08xxx: conexión rechazada, perdida o cerrada; HYT00/HYT01: timeouts
+    estado = str(e.args[0]) if getattr(e, "args", None) else ""
+    return estado.startswith("08") or estado in ("HYT00", "HYT01")
+
+
+class Interruptor:
+    """
+    Circuit breaker de la BD.
+    - Cerrado: las llamadas pasan; `umbral` errores de conexión seguidos lo abren.
+    - Abierto: las llamadas fallan al instante con BDNoDisponible durante `espera` segundos.
+    - Semiabierto: pasa una sola llamada de prueba; si sale bien se cierra y si
+      falla vuelve a abrirse con una espera el doble de larga (hasta `espera_max`).
+    """
+
+    CERRADO, ABIERTO, SEMIABIERTO = "cerrado", "abierto", "semiabierto"
+
+    def __init__(self, umbral=5, espera=10, espera_max=300):
+        self.log = AppLogger("DB_Interruptor")
+        self.umbral = umbral
+        self.espera_base = espera
+        self.espera_max = espera_max
+
+        self.estado = self.CERRADO
+        self._fallos = 0
+        self._espera = espera
+        self._reabre_en = 0.0
+        self._lock = threading.Lock()
+
+    def permitir(self):
+        """Deja pasar la llamada o lanza BDNoDisponible."""
+        with self._lock:
+            if self.estado == self.CERRADO:
+                return
+            if self.estado == self.ABIERTO and time.monotonic() >= self._reabre_en:
+                self.estado = self.SEMIABIERTO
+                return
+            raise BDNoDisponible(f"BD no disponible (interruptor {self.estado})")
+
+    def exito(self):
+        with self._lock:
+            if self.estado != self.CERRADO:
+                self.log.info("BD disponible de nuevo, interruptor cerrado.")
+            self.estado = self.CERRADO
+            self._fallos = 0
+            self._espera = self.espera_base
+
+    def fallo(self):
+        with self._lock:
+            self._fallos += 1
+            if self.estado == self.SEMIABIERTO:
+                self._espera = min(self.espera_max, self._espera * 2)
+            elif self.estado == self.ABIERTO or self._fallos < self.umbral:
+                return
+            self.estado = self.ABIERTO
+            self._reabre_en = time.monotonic() + self._espera
+            espera, fallos = self._espera, self._fallos
+        self.log.error("BD no disponible tras %s errores de conexión; se reintenta en %ss.", fallos, espera)
+
+    def sin_resultado(self):
+        """La llamada no llegó a SQL Server (pool agotado): si era la de prueba, la próxima vuelve a probar."""
+        with self._lock:
+            if self.estado == self.SEMIABIERTO:
+                self.estado = self.ABIERTO   # _reabre_en ya pasó
+
+    def disponible(self):
+        """False mientras el interruptor esté abierto y no toque probar."""
+        with self._lock:
+            return self.estado != self.ABIERTO or time.monotonic() >= self._reabre_en
+
+
+# Un pool por cadena de conexión, compartido por todas las instancias del proceso
+_pools = {}
+_pools_lock = threading.Lock()
+
+def _obtener_pool(connection_string):
+    with _pools_lock:
+        pool = _pools.get(connection_string)
+        if pool is None:
+            pool = ConnectionPool(
+                connection_string,
+                min_size=int(os.getenv("MSSQL_POOL_MIN", "1")),
+                max_size=int(os.getenv("MSSQL_POOL_MAX", "10")),
+                max_age=int(os.getenv("MSSQL_POOL_MAX_AGE", "1800")),
+                ping_after=int(os.getenv("MSSQL_POOL_PING_AFTER", "30")),
+            )
+            # Un interruptor por servidor: lo comparten watcher, drenador y handlers del bot
+            pool.interruptor = Interruptor(
+                umbral=int(os.getenv("DB_BREAKER_FAILURES", "5")),
+                espera=int(os.getenv("DB_BREAKER_COOLDOWN", "10")),
+                espera_max=int(os.getenv("DB_BREAKER_COOLDOWN_MAX", "300")),
+            )
+            _pools[connection_string] = pool
+        return pool
+
+# Caches de lectura del proceso, compartidas por todas las instancias.
+# _lecturas: resultados de /recientes, /tarjetas y /resumen agrupados por UserId,
+#            como (versión en dbo.UserDataVersion, valor).
+# _versiones: última versión leída de cada UserId; mientras esté vigente los hits
+#            no tocan la BD, así que lo que registra otro proceso (el watcher) se ve
+#            con hasta DB_CACHE_VERSION_TTL segundos de atraso.
+# _usuarios: TelegramChatId -> UserId (no cambia una vez creado el usuario).
+_lecturas = CacheTTL(
+    ttl=int(os.getenv("DB_CACHE_TTL", "30")),
+    max_grupos=int(os.getenv("DB_CACHE_MAX_USERS", "1000")),
+)
+_versiones = CacheTTL(
+    ttl=int(os.getenv("DB_CACHE_VERSION_TTL", "5")),
+    max_grupos=int(os.getenv("DB_CACHE_MAX_USERS", "1000")),
+)
+_usuarios = CacheTTL(
+    ttl=int(os.getenv("DB_CACHE_USER_TTL", "3600")),
+    max_grupos=int(os.getenv("DB_CACHE_MAX_USERS", "1000")),
+)
+
 class GlobalPointsDB:
     def __init__(self):
         self.log = AppLogger("DB_Client")
@@ -27,239 +289,628 @@ class GlobalPointsDB:
             f"PWD={password};"
         )
 
-    def _get_cursor(self):
+        # Pool compartido por todas las instancias (watcher y handlers del bot)
+        self.pool = _obtener_pool(self.connection_string)
+        self.interruptor = self.pool.interruptor
         try:
-            conn = pyodbc.connect(self.connection_string, autocommit=False)
-            return conn, conn.cursor()
+            self.pool.llenar()
         except Exception as e:
+            self.interruptor.fallo()
             self.log.error(f"Error conectando a SQL Server: {e}")
+
+    @contextmanager
+    def _connection(self):
+        """
+        Presta una conexión del pool: `with self._connection() as conn:`
+        Con el interruptor abierto lanza BDNoDisponible sin tocar la red.
+        """
+        self.interruptor.permitir()
+        try:
+            with self.pool.connection() as conn:
+                yield conn
+        except PoolAgotado:
+            # No se llegó a hablar con SQL Server: ni falla ni éxito para el interruptor
+            self.interruptor.sin_resultado()
             raise
+        except Exception as e:
+            if es_error_conexion(e):
+                self.interruptor.fallo()
+            else:
+                # Un error de datos también demuestra que el servidor responde
+                self.interruptor.exito()
+            raise
+        self.interruptor.exito()
+
+    def disponible(self):
+        """False mientras el interruptor esté abierto (SQL Server caído)."""
+        return self.interruptor.disponible()
+
+    # --- Cache de lecturas ---
+    def _leer_cache(self, chat_id, clave):
+        """
+        Lectura desde memoria, sin pedir conexión: vale si la versión del usuario
+        se comprobó hace menos de DB_CACHE_VERSION_TTL segundos y coincide con la
+        de la consulta cacheada. Con la BD caída se sirve lo último leído.
+        :return: (True, valor) o (False, None) si hay que ir a la BD.
+        """
+        encontrado, user_id = _usuarios.obtener(chat_id, "user_id", contar=False)
+        if not encontrado:
+            return False, None
+        vigente, version = _versiones.obtener(user_id, "version", contar=False)
+        if vigente:
+            encontrado, valor = self._cacheado(user_id, clave, version)
+        elif not self.disponible():
+            encontrado, cacheado = _lecturas.obtener(user_id, clave, contar=False)
+            valor = cacheado[1] if encontrado else None
+        else:
+            return False, None
+        if encontrado:
+            _lecturas.contar_hit()
+        return encontrado, valor
+
+    def _validar_cache(self, cursor, user_id, clave):
+        """
+        Lee la versión del usuario en dbo.UserDataVersion (los SPs de escritura la
+        incrementan) y busca la consulta cacheada con esa versión.
+        :return: (versión, encontrado, valor)
+        """
+        leido_en = time.monotonic()
+        cursor.execute("SELECT Version FROM dbo.UserDataVersion WHERE AppUserId = ?", (user_id,))
+        row = cursor.fetchone()
+        version = row.Version if row else 0
+        _versiones.guardar(user_id, "version", version, leido_en)
+        encontrado, valor = self._cacheado(user_id, clave, version)
+        if encontrado:
+            _lecturas.contar_hit()
+        else:
+            _lecturas.contar_miss()
+        return version, encontrado, valor
+
+    @staticmethod
+    def _cacheado(user_id, clave, version):
+        encontrado, cacheado = _lecturas.obtener(user_id, clave, contar=False)
+        if encontrado and cacheado[0] == version:
+            return True, cacheado[1]
+        if encontrado:
+            # Otro proceso modificó los datos del usuario: lo cacheado ya no sirve
+            _lecturas.invalidar(user_id)
+        return False, None
+
+    def _resolver_usuario(self, cursor, chat_id):
+        """TelegramChatId -> UserId, memorizado. None si el chat no está registrado."""
+        encontrado, user_id = _usuarios.obtener(chat_id, "user_id", contar=False)
+        if encontrado:
+            return user_id
+        cursor.execute("SELECT UserId FROM dbo.AppUsers WHERE TelegramChatId = ?", (chat_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        _usuarios.guardar(chat_id, "user_id", row.UserId)
+        return row.UserId
+
+    def invalidar_usuario(self, app_user_id):
+        """Descarta las lecturas en cache de un usuario tras modificar sus datos."""
+        _lecturas.invalidar(app_user_id)
+        _versiones.invalidar(app_user_id)
+
+    def cache_stats(self):
+        """Contadores de hit/miss de las caches de lectura."""
+        return {"lecturas": _lecturas.estadisticas(), "usuarios": _usuarios.estadisticas()}
 
     def get_user_data_by_email(self, email):
         """Busca ID y ChatID dado un email."""
-        conn, cursor = None, None
         try:
-            conn, cursor = self._get_cursor()
-            sql = """
-            SELECT u.UserId, u.TelegramChatId 
-            FROM dbo.AppUsers u
-            INNER JOIN dbo.EmailCredentials c ON u.Id = c.AppUserId
-            WHERE c.Email = ?
-            """
-            cursor.execute(sql, (email,))
-            row = cursor.fetchone()
-            if row:
-                return {"user_id": row[0], "chat_id": row[1]}
-            return None
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                sql = """
+                SELECT u.UserId, u.TelegramChatId 
+                FROM dbo.AppUsers u
+                INNER JOIN dbo.EmailCredentials c ON u.UserId = c.AppUserId
+                WHERE c.Email = ?
+                """
+                cursor.execute(sql, (email,))
+                row = cursor.fetchone()
+                if row:
+                    return {"user_id": row[0], "chat_id": row[1]}
+                return None
         except Exception as e:
             self.log.error(f"Error buscando usuario: {e}")
             return None
-        finally:
-            if conn: conn.close()
 
     def register_user_credentials(self, telegram_chat_id, email, raw_password):
         """Registra usuario y contraseña usando el SP de registro"""
-        conn, cursor = None, None
         try:
-            conn, cursor = self._get_cursor()
-            # Llamada al SP que maneja la encriptación y lógica IF/ELSE
-            sql = "EXEC dbo.sp_RegisterUserCredentials @TelegramChatId = ?, @Email = ?, @RawPassword = ?"
-            cursor.execute(sql, (telegram_chat_id, email, raw_password))
-            conn.commit()
-            self.log.info(f"Credenciales registradas para ChatID {telegram_chat_id}")
-            return True
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                # Llamada al SP que maneja la encriptación y lógica IF/ELSE
+                sql = "EXEC dbo.sp_RegisterUserCredentials @TelegramChatId = ?, @Email = ?, @RawPassword = ?"
+                cursor.execute(sql, (telegram_chat_id, email, raw_password))
+                conn.commit()
+                self.log.info("Credenciales registradas para ChatID %s", telegram_chat_id)
+                return True
         except Exception as e:
-            if conn: conn.rollback()
             self.log.error(f"Error en registro: {e}")
             return False
-        finally:
-            if conn: conn.close()
 
-    def process_transaction(self, app_user_id, merchant_text, card_last4, bank_name, amount):
-        """Procesa la transacción nueva."""
-        conn, cursor = None, None
+    def process_transaction(self, app_user_id, merchant_text, card_last4, bank_name, amount, message_key=None,
+                            transaction_at=None, lanzar_conexion=False):
+        """
+        Procesa la transacción nueva.
+        :param message_key: clave del correo (indice_mensajes.clave_mensaje); si ya se
+                            registró, la BD responde bot_action 'DUPLICATE' sin contarla.
+        :param transaction_at: fecha del correo (datetime UTC); None = ahora.
+        :param lanzar_conexion: relanzar los errores de conexión (BDNoDisponible, PoolAgotado,
+                                red) en vez de devolver None, para distinguirlos de los de datos.
+        :return: {transaction_id, bot_action, message} o None si la BD no la registró.
+        """
         try:
-            conn, cursor = self._get_cursor()
-            sql = """
-            DECLARE @OutId INT, @OutAction VARCHAR(20), @OutMsg NVARCHAR(MAX);
-            EXEC dbo.sp_InsertTransactionFromEmail
-                @AppUserId = ?, @RawComercioTexto = ?, @CardLast4 = ?, 
-                @BankName = ?, @AmountUSD = ?,
-                @TransactionId = @OutId OUTPUT, @BotAction = @OutAction OUTPUT, @MessageText = @OutMsg OUTPUT;
-            SELECT @OutId as id, @OutAction as action, @OutMsg as msg;
-            """
-            cursor.execute(sql, (app_user_id, merchant_text, card_last4, bank_name, amount))
-            row = cursor.fetchone()
-            conn.commit()
-            if row:
-                return {"transaction_id": row.id, "bot_action": row.action, "message": row.msg}
-            return None
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                sql = """
+                DECLARE @OutId INT, @OutAction VARCHAR(20), @OutMsg NVARCHAR(MAX);
+                EXEC dbo.sp_InsertTransactionFromEmail
+                    @AppUserId = ?, @RawComercioTexto = ?, @CardLast4 = ?, 
+                    @BankName = ?, @AmountUSD = ?,
+                    @TransactionId = @OutId OUTPUT, @BotAction = @OutAction OUTPUT, @MessageText = @OutMsg OUTPUT,
+                    @MessageKey = ?, @TransactionAt = ?;
+                SELECT @OutId as id, @OutAction as action, @OutMsg as msg;
+                """
+                cursor.execute(sql, (app_user_id, merchant_text, card_last4, bank_name, amount, message_key, transaction_at))
+                row = cursor.fetchone()
+                conn.commit()
+                self.invalidar_usuario(app_user_id)
+                if row:
+                    return {"transaction_id": row.id, "bot_action": row.action, "message": row.msg}
+                return None
         except Exception as e:
-            if conn: conn.rollback()
+            if lanzar_conexion and (isinstance(e, (BDNoDisponible, PoolAgotado)) or es_error_conexion(e)):
+                raise
             self.log.error(f"Error procesando transacción: {e}")
             return None
-        finally:
-            if conn: conn.close()
+
+    def process_transactions_bulk(self, transactions):
+        """
+        Procesa varias transacciones en una sola llamada (TVP dbo.EmailTransactionList).
+        :param transactions: lista de dicts con los mismos campos que process_transaction.
+        :return: lista alineada con la entrada con {transaction_id, bot_action, message}
+                 (bot_action 'DUPLICATE' para correos ya registrados),
+                 o None si el lote completo falló.
+        """
+        if not transactions:
+            return []
+        try:
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                filas = [
+                    (i, t['app_user_id'], t['merchant_text'], t['card_last4'],
+                     t['bank_name'], Decimal(str(t['amount'])), t.get('message_key'), t.get('transaction_at'))
+                    for i, t in enumerate(transactions)
+                ]
+                cursor.execute("EXEC dbo.sp_InsertTransactionsFromEmailBulk @Items = ?", (filas,))
+                rows = cursor.fetchall()
+                conn.commit()
+                for user_id in {t['app_user_id'] for t in transactions}:
+                    self.invalidar_usuario(user_id)
+
+                resultados = [None] * len(transactions)
+                for r in rows:
+                    resultados[r.RowNum] = {
+                        "transaction_id": r.TransactionId,
+                        "bot_action": r.BotAction,
+                        "message": r.MessageText
+                    }
+                return resultados
+        except Exception as e:
+            self.log.error("Error procesando lote de %s transacciones: %s", len(transactions), e)
+            return None
 
     def complete_configuration(self, transaction_id, multiplier=None, category_name=None):
         """Actualiza la configuración (llamado por los botones del Bot)."""
-        conn, cursor = None, None
         try:
-            conn, cursor = self._get_cursor()
-            sql = "EXEC dbo.sp_CompletarConfiguracion @TransactionId = ?, @SelectedMultiplier = ?, @SelectedCategoryName = ?"
-            cursor.execute(sql, (transaction_id, multiplier, category_name))
-            conn.commit()
-            return True
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                sql = """
+                EXEC dbo.sp_CompletarConfiguracion @TransactionId = ?, @SelectedMultiplier = ?, @SelectedCategoryName = ?;
+                SELECT c.AppUserId
+                FROM dbo.Transactions t
+                INNER JOIN dbo.UserCards c ON t.UserCardId = c.Id
+                WHERE t.Id = ?;
+                """
+                cursor.execute(sql, (transaction_id, multiplier, category_name, transaction_id))
+                row = cursor.fetchone()
+                conn.commit()
+                if category_name is not None:
+                    # La categoría es del comercio: cambia el resumen de todos sus clientes
+                    _lecturas.limpiar()
+                    _versiones.limpiar()
+                elif row:
+                    self.invalidar_usuario(row.AppUserId)
+                return True
         except Exception as e:
-            if conn: conn.rollback()
             self.log.error(f"Error configurando: {e}")
             return False
-        finally:
-            if conn: conn.close()
 
     def get_recent_transactions(self, chat_id, limit=5):
         """Obtiene las últimas N transacciones para mostrarlas en Telegram."""
-        conn, cursor = None, None
+        return self.get_transactions_page(chat_id, limit)["items"]
+
+    def get_transactions_page(self, chat_id, limit=5, older_than=None, newer_than=None):
+        """
+        Página del historial, de la transacción más nueva a la más vieja.
+        Paginación por keyset sobre (TransactionAt, Id): cada página es un seek
+        en IX_Transactions_UserCard_TransactionAt, sin OFFSET.
+        :param older_than / newer_than: Id de la transacción que sirve de cursor
+                                        (la última / primera de la página visible).
+        :return: {"items": [...], "has_older": bool, "has_newer": bool}
+        """
+        vacia = {"items": [], "has_older": False, "has_newer": False}
+        clave = ("recientes", limit, older_than, newer_than)
+        encontrado, cacheado = self._leer_cache(chat_id, clave)
+        if encontrado:
+            return cacheado
+        leido_en = time.monotonic()
         try:
-            conn, cursor = self._get_cursor()
-            sql = """
-            SELECT TOP (?) 
-                 t.Id, 
-                m.Name AS Comercio, 
-                t.AmountUSD, 
-                t.Points, 
-                t.Multiplicador,
-                t.TransactionAt
-            FROM dbo.Transactions t
-            INNER JOIN dbo.Comercio m ON t.ComercioId = m.Id
-            INNER JOIN dbo.UserCards c ON t.UserCardId = c.Id
-            INNER JOIN dbo.AppUsers u ON c.AppUserId = u.UserId
-            WHERE u.TelegramChatId = ?
-            ORDER BY t.TransactionAt DESC
-            """
-            cursor.execute(sql, (limit, chat_id))
-            rows = cursor.fetchall()
-            self.log.info(rows)
-            results = []
-            for r in rows:
-                results.append({
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                user_id = self._resolver_usuario(cursor, chat_id)
+                if user_id is None:
+                    return vacia
+                version, encontrado, cacheado = self._validar_cache(cursor, user_id, clave)
+                if encontrado:
+                    return cacheado
+
+                hacia_nuevas = newer_than is not None
+                rows = self._leer_pagina(cursor, user_id, limit + 1, newer_than if hacia_nuevas else older_than, hacia_nuevas)
+                hay_mas = len(rows) > limit
+                rows = rows[:limit]
+                if hacia_nuevas:
+                    if not hay_mas:
+                        # Llegamos al principio: se muestra la primera página completa
+                        rows = self._leer_pagina(cursor, user_id, limit + 1, None, False)
+                        pagina = {"has_older": len(rows) > limit, "has_newer": False}
+                        rows = rows[:limit]
+                    else:
+                        rows.reverse()
+                        pagina = {"has_older": True, "has_newer": True}
+                else:
+                    pagina = {"has_older": hay_mas, "has_newer": older_than is not None}
+
+                pagina["items"] = [{
                     "id": r.Id,
                     "comercio": r.Comercio,
                     "monto": float(r.AmountUSD),
                     "puntos": r.Points,
                     "multiplicador": float(r.Multiplicador) if r.Multiplicador else 1.0,
                     "fecha": r.TransactionAt.strftime("%d/%m %H:%M")
-                })
-            return results
+                } for r in rows]
+                _lecturas.guardar(user_id, clave, (version, pagina), leido_en)
+                return pagina
         except Exception as e:
             self.log.error(f"Error obteniendo recientes: {e}")
-            return []
-        finally:
-            if conn: conn.close()
+            return vacia
+
+    def _leer_pagina(self, cursor, user_id, top, cursor_id, hacia_nuevas):
+        """Un seek por keyset desde la transacción `cursor_id` (o desde la más nueva)."""
+        filtro = ""
+        if cursor_id is not None:
+            comparador = ">" if hacia_nuevas else "<"
+            filtro = f"""
+                  AND (t.TransactionAt {comparador} @CursorAt
+                       OR (t.TransactionAt = @CursorAt AND t.Id {comparador} @CursorId))"""
+        orden = "ASC" if hacia_nuevas else "DESC"
+        sql = f"""
+        DECLARE @CursorId BIGINT = ?;
+        DECLARE @CursorAt DATETIME2(0) = (SELECT TransactionAt FROM dbo.Transactions WHERE Id = @CursorId);
+        SELECT TOP (?)
+            t.Id,
+            m.Name AS Comercio,
+            t.AmountUSD,
+            t.Points,
+            t.Multiplicador,
+            t.TransactionAt
+        FROM dbo.Transactions t
+        INNER JOIN dbo.UserCards c ON t.UserCardId = c.Id
+        INNER JOIN dbo.Comercio m ON t.ComercioId = m.Id
+        WHERE c.AppUserId = ?{filtro}
+        ORDER BY t.TransactionAt {orden}, t.Id {orden};
+        """
+        cursor.execute(sql, (cursor_id, top, user_id))
+        return cursor.fetchall()
 
     def get_user_cards(self, chat_id):
-        """Lista las tarjetas del usuario."""
         """
         Lista las tarjetas del usuario traduciendo primero el ChatId a AppUserId.
         """
-        conn, cursor = None, None
+        encontrado, cacheado = self._leer_cache(chat_id, "tarjetas")
+        if encontrado:
+            return cacheado
+        leido_en = time.monotonic()
         try:
-            conn, cursor = self._get_cursor()
-            
-            # Buscamos el ID real usando el ChatId de Telegram
-            sql = """
-            DECLARE @UID INT;
-            SELECT @UID = UserId FROM dbo.AppUsers WHERE TelegramChatId = ?;
+            with self._connection() as conn:
+                cursor = conn.cursor()
             
-            IF @UID IS NOT NULL
-                EXEC dbo.sp_ListUserCards @AppUserId = @UID;
-            """
-            
-            cursor.execute(sql, (chat_id,))
-            rows = cursor.fetchall()
+                # Buscamos el ID real usando el ChatId de Telegram
+                user_id = self._resolver_usuario(cursor, chat_id)
+                if user_id is None:
+                    return []
+                version, encontrado, cacheado = self._validar_cache(cursor, user_id, "tarjetas")
+                if encontrado:
+                    return cacheado
+
+                cursor.execute("EXEC dbo.sp_ListUserCards @AppUserId = ?", (user_id,))
+                rows = cursor.fetchall()
             
-            cards = []
-            for r in rows:
-                # Tu SP devuelve: Id, Bank, CardLast4, Alias, FechaRegistro
-                cards.append({
-                    "id": r.Id,
-                    "banco": r.Bank,
-                    "last4": r.CardLast4,
-                    "alias": r.Alias,
-                    "fecha": r.FechaRegistro,
-                    # Como tu SP ya no devuelve 'IsActive', asumimos True o lo quitamos
-                    "activa": True 
-                })
-            return cards
+                cards = []
+                for r in rows:
+                    # Tu SP devuelve: Id, Bank, CardLast4, Alias, FechaRegistro
+                    cards.append({
+                        "id": r.Id,
+                        "banco": r.Bank,
+                        "last4": r.CardLast4,
+                        "alias": r.Alias,
+                        "fecha": r.FechaRegistro,
+                        # Como tu SP ya no devuelve 'IsActive', asumimos True o lo quitamos
+                        "activa": True 
+                    })
+                _lecturas.guardar(user_id, "tarjetas", (version, cards), leido_en)
+                return cards
         except Exception as e:
             self.log.error(f"Error listando tarjetas: {e}")
             return []
-        finally:
-            if conn: conn.close()
 
     def get_monthly_summary(self, chat_id):
         """Obtiene estadísticas del mes actual."""
-        conn, cursor = None, None
+        encontrado, cacheado = self._leer_cache(chat_id, "resumen")
+        if encontrado:
+            return cacheado
+        leido_en = time.monotonic()
         try:
-            conn, cursor = self._get_cursor()
-            sql = "EXEC dbo.sp_MonthlyPointsSummary @TelegramChatId = ?"
-            cursor.execute(sql, (chat_id,))
-            row = cursor.fetchone()
-            if row:
-                return {
-                    "total_usd": float(row.TotalUSD),
-                    "total_points": row.TotalPoints,
-                    "count": row.TxCount,
-                    "top_category": row.TopCategory,
-                    "month_name": row.MonthName
-                }
-            return None
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                user_id = self._resolver_usuario(cursor, chat_id)
+                if user_id is None:
+                    return None
+                version, encontrado, cacheado = self._validar_cache(cursor, user_id, "resumen")
+                if encontrado:
+                    return cacheado
+                # El SP lee el acumulado dbo.MonthlyPointsRollup (O(categorías) del mes)
+                sql = "EXEC dbo.sp_MonthlyPointsSummary @TelegramChatId = ?, @AppUserId = ?"
+                cursor.execute(sql, (chat_id, user_id))
+                row = cursor.fetchone()
+                resumen = None
+                if row:
+                    resumen = {
+                        "total_usd": float(row.TotalUSD),
+                        "total_points": row.TotalPoints,
+                        "count": row.TxCount,
+                        "top_category": row.TopCategory,
+                        "month_name": row.MonthName
+                    }
+                _lecturas.guardar(user_id, "resumen", (version, resumen), leido_en)
+                return resumen
         except Exception as e:
             self.log.error(f"Error en resumen mensual: {e}")
             return None
-        finally:
-            if conn: conn.close()
+
+    def get_sync_state(self, app_user_id):
+        """
+        Lee el checkpoint IMAP (UIDVALIDITY + último UID procesado) de un usuario.
+        :return: dict, None si no hay checkpoint guardado o False si no se pudo leer.
+        """
+        try:
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                sql = """
+                SELECT Email, UidValidity, LastUid
+                FROM dbo.MailboxSyncState
+                WHERE AppUserId = ?
+                """
+                cursor.execute(sql, (app_user_id,))
+                row = cursor.fetchone()
+                if row:
+                    return {"email": row.Email, "uid_validity": row.UidValidity, "last_uid": row.LastUid}
+                return None
+        except Exception as e:
+            self.log.error("Error leyendo estado de sincronización: %s", e)
+            return False
+
+    def save_sync_state(self, app_user_id, email, uid_validity, last_uid):
+        """Guarda (upsert) el checkpoint IMAP de un usuario."""
+        try:
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                sql = """
+                MERGE dbo.MailboxSyncState AS target
+                USING (SELECT ? AS AppUserId, ? AS Email, ? AS UidValidity, ? AS LastUid) AS src
+                ON target.AppUserId = src.AppUserId
+                WHEN MATCHED THEN
+                    UPDATE SET Email = src.Email, UidValidity = src.UidValidity,
+                               LastUid = src.LastUid, UpdatedAt = SYSUTCDATETIME()
+                WHEN NOT MATCHED THEN
+                    INSERT (AppUserId, Email, UidValidity, LastUid)
+                    VALUES (src.AppUserId, src.Email, src.UidValidity, src.LastUid);
+                """
+                cursor.execute(sql, (app_user_id, email, uid_validity, last_uid))
+                conn.commit()
+                return True
+        except Exception as e:
+            self.log.error("Error guardando estado de sincronización: %s", e)
+            return False
 
     def get_all_monitored_accounts(self):
         """
         Recupera TODOS los usuarios activos con sus credenciales desencriptadas.
         """
-        conn, cursor = None, None
         try:
-            conn, cursor = self._get_cursor()
+            with self._connection() as conn:
+                cursor = conn.cursor()
             
-            # Script SQL para desencriptar y leer
-            sql = """
-            OPEN SYMMETRIC KEY EmailCredsKey DECRYPTION BY CERTIFICATE EmailCredsCert;
-
-            SELECT 
-                u.UserId AS UserId,
-                u.TelegramChatId,
-                c.Email,
-                CONVERT(NVARCHAR(MAX), DecryptByKey(c.PasswordEncrypted)) AS DecryptedPass
-            FROM dbo.AppUsers u
-            INNER JOIN dbo.EmailCredentials c ON u.UserId = c.AppUserId
-            WHERE u.IsActive = 1;
-
-            CLOSE SYMMETRIC KEY EmailCredsKey;
-            """
+                # Script SQL para desencriptar y leer
+                sql = """
+                OPEN SYMMETRIC KEY EmailCredsKey DECRYPTION BY CERTIFICATE EmailCredsCert;
+
+                SELECT 
+                    u.UserId AS UserId,
+                    u.TelegramChatId,
+                    c.Email,
+                    CONVERT(NVARCHAR(MAX), DecryptByKey(c.PasswordEncrypted)) AS DecryptedPass
+                FROM dbo.AppUsers u
+                INNER JOIN dbo.EmailCredentials c ON u.UserId = c.AppUserId
+                WHERE u.IsActive = 1;
+
+                CLOSE SYMMETRIC KEY EmailCredsKey;
+                """
             
-            cursor.execute(sql)
-            rows = cursor.fetchall()
+                cursor.execute(sql)
+                rows = cursor.fetchall()
             
-            accounts = []
-            for r in rows:
-                if r.Email and r.DecryptedPass:
-                    accounts.append({
+                accounts = []
+                for r in rows:
+                    if r.Email and r.DecryptedPass:
+                        accounts.append({
+                            "user_id": r.UserId,
+                            "chat_id": r.TelegramChatId,
+                            "email": r.Email,
+                            "password": r.DecryptedPass
+                        })
+                return accounts
+
+        except Exception as e:
+            self.log.error(f"Error obteniendo cuentas para monitorear: {e}")
+            return []
+
+    def get_monitored_accounts_changes(self, since_version=None):
+        """
+        Devuelve las cuentas cuyo usuario o credencial cambió desde `since_version`
+        (ROWVERSION), incluyendo las desactivadas para poder retirarlas.
+        Con since_version=None devuelve todas (recarga completa).
+        Solo se desencriptan las contraseñas de las filas devueltas.
+        :return: (cuentas, version) o None si hubo error.
+        """
+        try:
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                sql = """
+                SET NOCOUNT ON;
+                DECLARE @Desde BINARY(8) = ISNULL(?, 0x0000000000000000);
+                -- Solo filas ya confirmadas: por debajo de la menor versión activa
+                DECLARE @Hasta BINARY(8) = CAST(MIN_ACTIVE_ROWVERSION() AS BINARY(8));
+
+                OPEN SYMMETRIC KEY EmailCredsKey DECRYPTION BY CERTIFICATE EmailCredsCert;
+
+                WITH Cambios AS (
+                    SELECT UserId FROM dbo.AppUsers
+                    WHERE RowVer >= @Desde AND RowVer < @Hasta
+                    UNION
+                    SELECT AppUserId FROM dbo.EmailCredentials
+                    WHERE RowVer >= @Desde AND RowVer < @Hasta
+                )
+                SELECT
+                    u.UserId AS UserId,
+                    u.TelegramChatId,
+                    CAST(ISNULL(u.IsActive, 0) AS BIT) AS IsActive,
+                    c.Email,
+                    CASE WHEN u.IsActive = 1
+                         THEN CONVERT(NVARCHAR(MAX), DecryptByKey(c.PasswordEncrypted)) END AS DecryptedPass,
+                    @Hasta AS SyncVersion
+                FROM Cambios ch
+                INNER JOIN dbo.AppUsers u ON u.UserId = ch.UserId
+                LEFT JOIN dbo.EmailCredentials c ON c.AppUserId = u.UserId;
+
+                CLOSE SYMMETRIC KEY EmailCredsKey;
+                """
+                cursor.execute(sql, (since_version,))
+                rows = cursor.fetchall()
+
+                cuentas = []
+                version = since_version
+                for r in rows:
+                    version = bytes(r.SyncVersion)
+                    cuentas.append({
                         "user_id": r.UserId,
                         "chat_id": r.TelegramChatId,
                         "email": r.Email,
-                        "password": r.DecryptedPass
+                        "password": r.DecryptedPass,
+                        "active": bool(r.IsActive) and bool(r.Email) and bool(r.DecryptedPass)
                     })
-            return accounts
+                return cuentas, version
+        except Exception as e:
+            self.log.error("Error sincronizando cuentas monitoreadas: %s", e)
+            return None
+
+    def get_merchant_catalog_changes(self, since_version=None):
+        """
+        Comercios y reglas de multiplicador (ComercioReglaUsuario) que cambiaron
+        desde `since_version` (ROWVERSION), para el catálogo de comercios del watcher.
+        Con since_version=None devuelve todo (recarga completa).
+        :return: (comercios, reglas, version) o None si hubo error.
+        """
+        try:
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                sql = """
+                SET NOCOUNT ON;
+                DECLARE @Desde BINARY(8) = ISNULL(?, 0x0000000000000000);
+                DECLARE @Hasta BINARY(8) = CAST(MIN_ACTIVE_ROWVERSION() AS BINARY(8));
+
+                SELECT @Hasta AS SyncVersion;
+
+                SELECT c.Name, c.CategoryId
+                FROM dbo.Comercio c
+                WHERE c.RowVer >= @Desde AND c.RowVer < @Hasta
+                ORDER BY c.Id;
 
+                SELECT uc.AppUserId, uc.CardLast4, c.Name, r.Multiplicador
+                FROM dbo.ComercioReglaUsuario r
+                INNER JOIN dbo.UserCards uc ON uc.Id = r.UserCardId
+                INNER JOIN dbo.Comercio c ON c.Id = r.ComercioId
+                WHERE r.RowVer >= @Desde AND r.RowVer < @Hasta;
+                """
+                cursor.execute(sql, (since_version,))
+                version = bytes(cursor.fetchone().SyncVersion)
+                cursor.nextset()
+                comercios = [{"name": r.Name, "category_id": r.CategoryId} for r in cursor.fetchall()]
+                cursor.nextset()
+                reglas = [{
+                    "app_user_id": r.AppUserId,
+                    "card_last4": r.CardLast4,
+                    "name": r.Name,
+                    "multiplicador": float(r.Multiplicador)
+                } for r in cursor.fetchall()]
+                return comercios, reglas, version
         except Exception as e:
-            self.log.error(f"Error obteniendo cuentas para monitorear: {e}")
-            return []
-        finally:
-            if conn: conn.close()
\ No newline at end of file
+            self.log.error("Error sincronizando el catálogo de comercios: %s", e)
+            return None
+
+    def claim_watcher_shards(self, worker_id, total_shards, lease_seconds, release_grace_seconds):
+        """
+        Latido del trabajador en modo shards: renueva sus arriendos, cede o toma
+        shards según los trabajadores vivos y devuelve los que le quedan.
+        :return: lista de ShardId, o None si hubo error (el trabajador conserva
+                 los suyos solo hasta que venza su arriendo).
+        """
+        try:
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    "EXEC dbo.sp_ClaimWatcherShards @WorkerId=?, @TotalShards=?, @LeaseSeconds=?, @ReleaseGraceSeconds=?",
+                    (worker_id, total_shards, lease_seconds, release_grace_seconds)
+                )
+                shards = [r.ShardId for r in cursor.fetchall()]
+                conn.commit()
+                return shards
+        except Exception as e:
+            self.log.error("Error renovando shards del trabajador %s: %s", worker_id, e)
+            return None
+
+    def release_watcher_shards(self, worker_id):
+        """Libera todos los shards del trabajador (apagado ordenado)."""
+        try:
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("EXEC dbo.sp_ReleaseWatcherShards @WorkerId=?", (worker_id,))
+                conn.commit()
+                return True
+        except Exception as e:
+            self.log.error("Error liberando shards del trabajador %s: %s", worker_id, e)
+            return False
@@ -0,0 +1,150 @@
+import re
+
+from imap_fetch import normalizar_asunto
+from logger_helper import AppLogger
+
+log = AppLogger("Extraccion")
+
+
+class PlantillaBanco:
+    """
+    Formato de correo de confirmación de un banco.
+    El patrón se compila una sola vez y debe tener los grupos con nombre
+    `comercio`, `monto` y `last4`; una sola búsqueda extrae todos los campos.
+    `asuntos` son fragmentos (en mayúsculas y sin tildes) de los asuntos con
+    que el banco envía sus confirmaciones; sin ninguno se acepta cualquier asunto.
+    """
+
+    def __init__(self, banco, patron, remitentes=(), palabras_clave=(), asuntos=()):
+        self.banco = banco
+        self.patron = re.compile(patron, re.IGNORECASE | re.DOTALL)
+        self.remitentes = tuple(r.lower() for r in remitentes)
+        self.palabras_clave = tuple(p.lower() for p in palabras_clave)
+        self.asuntos = tuple(normalizar_asunto(a) for a in asuntos)
+
+    def asunto_valido(self, asunto_normalizado):
+        return not self.asuntos or any(a in asunto_normalizado for a in self.asuntos)
+
+    def extraer(self, texto):
+        match = self.patron.search(texto)
+        if not match:
+            return None
+        try:
+            monto = float(match.group('monto').replace(',', ''))
+        except ValueError:
+            return None
+        return {
+            # Se conservan los espacios internos: el SP busca el comercio por nombre exacto
+            "comercio": match.group('comercio').replace('\r', '').replace('\n', ' ').strip(),
+            "monto": monto,
+            "last4": match.group('last4'),
+            "banco": self.banco
+        }
+
+
+class MotorExtraccion:
+    """
+    Elige la plantilla por remitente (dominio) o palabra clave antes de
+    intentar cualquier regex, y solo si esa falla prueba las demás.
+    """
+
+    def __init__(self, predeterminada=None):
+        self.plantillas = []
+        self.predeterminada = predeterminada
+        self._por_remitente = {}
+
+    def registrar(self, plantilla, predeterminada=False):
+        self.plantillas.append(plantilla)
+        for remitente in plantilla.remitentes:
+            self._por_remitente[remitente] = plantilla
+        if predeterminada:
+            self.predeterminada = plantilla
+        return plantilla
+
+    def _por_direccion(self, remitente):
+        remitente = remitente.lower()
+        dominio = remitente.rsplit('@', 1)[-1]
+        return self._por_remitente.get(remitente) or self._por_remitente.get(dominio)
+
+    def es_asunto_de_compra(self, remitente, asunto):
+        """
+        Filtro previo por asunto, antes de descargar el cuerpo: el de la plantilla
+        del remitente o, si no tiene (p.ej. un reenvío desde Gmail), el de cualquiera.
+        """
+        asunto = normalizar_asunto(asunto or "")
+        plantilla = self._por_direccion(remitente) if remitente else None
+        if plantilla:
+            return plantilla.asunto_valido(asunto)
+        return any(p.asunto_valido(asunto) for p in self.plantillas)
+
+    def elegir(self, texto, remitente=None):
+        """Plantilla más probable usando solo comparaciones de strings."""
+        if remitente:
+            plantilla = self._por_direccion(remitente)
+            if plantilla:
+                return plantilla
+
+        texto_lower = texto.lower()
+        for plantilla in self.plantillas:
+            if any(p in texto_lower for p in plantilla.palabras_clave):
+                return plantilla
+        return self.predeterminada
+
+    def extraer(self, texto, remitente=None):
+        """
+        :return: (datos, plantilla) o (None, None) si ningún formato coincide.
+        """
+        elegida = self.elegir(texto, remitente)
+        if elegida:
+            datos = elegida.extraer(texto)
+            if datos:
+                return datos, elegida
+
+        for plantilla in self.plantillas:
+            if plantilla is elegida:
+                continue
+            datos = plantilla.extraer(texto)
+            if datos:
+                log.info("Correo reconocido como %s tras fallar %s.", plantilla.banco, elegida.banco if elegida else 'la preselección')
+                return datos, plantilla
+        return None, None
+
+
+# --- PLANTILLAS REGISTRADAS ---
+MONTO = r"(?P<monto>\d{1,3}(?:,\d{3})*(?:\.\d{1,2})?|\d+(?:\.\d{1,2})?)"
+
+motor = MotorExtraccion()
+
+# Global Bank: el orden de los datos varía entre versiones del correo, así que
+# cada campo va en su propio lookahead (una sola llamada, sin depender del orden).
+GLOBAL_BANK = motor.registrar(PlantillaBanco(
+    "Global Bank",
+    r"\A(?=.*?\sen\s+(?P<comercio>.*?)\s+con\s+tarjeta)"
+    r"(?=.*?terminaci[óo]n\s+(?P<last4>\w{4}))"
+    r"(?=.*?\$\s?" + MONTO + ")",
+    remitentes=["globalbank.com.pa"],
+    palabras_clave=["global bank"],
+    asuntos=["CONFIRMACION"]             # "Confirmación de transacción"
+), predeterminada=True)
+
+# BAC Credomatic: notificación con campos en líneas "Comercio:", "Monto:".
+BAC_CREDOMATIC = motor.registrar(PlantillaBanco(
+    "Bac Credomatic",
+    r"terminada\s+en\s+\*?(?P<last4>\d{4})"
+    r".*?Comercio:\s*(?P<comercio>[^\r\n]+?)\s*[\r\n]"
+    r".*?Monto:\s*(?:USD|US\$|\$)\s?" + MONTO,
+    remitentes=["baccredomatic.com", "notificacionesbaccr.com"],
+    palabras_clave=["credomatic"],
+    asuntos=["TRANSACCION"]              # "Notificación de transacción"
+))
+
+# Banco General: una sola frase "tarjeta *1234 por B/. 10.00 en COMERCIO el dd/mm".
+BANCO_GENERAL = motor.registrar(PlantillaBanco(
+    "Banco General",
+    r"tarjeta\s+(?:\w+\s+)?\*+\s?(?P<last4>\d{4})"
+    r"\s+por\s+(?:B/\.|USD|\$)\s?" + MONTO +
+    r"\s+en\s+(?P<comercio>.+?)\s+el\s+\d{1,2}/\d{1,2}",
+    remitentes=["bgeneral.com"],
+    palabras_clave=["banco general"],
+    asuntos=["COMPRA"]                   # "Compra aprobada"
+))
@@ -1,163 +1,495 @@
+import argparse
 import imaplib
-import email
-import re
+import logging
+import multiprocessing
+import socket
 import time
 import os
-import requests
-from email.utils import parseaddr
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from email.utils import parsedate_to_datetime
 from dotenv import load_dotenv
 
-from db_client import GlobalPointsDB
+from account_registry import AccountRegistry
+import botones
+import comercios
+from db_client import BDNoDisponible, GlobalPointsDB
+import extraccion
+import imap_fetch
+import indice_mensajes
+import metricas
+from imap_session import ErrorAutenticacion, ImapSessionManager
 from logger_helper import AppLogger
+from notificador import TelegramNotifier
+import planificador
+import shards
+import spool_transacciones
 
 # Configuración
 load_dotenv()
 log = AppLogger("GmailWatcher")
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
-IMAP_SERVER = "imap.gmail.com"
+IMAP_SERVER = os.getenv("WATCHER_IMAP_SERVER", "imap.gmail.com")
+IMAP_PORT = int(os.getenv("WATCHER_IMAP_PORT", "993"))
+IMAP_SSL = os.getenv("WATCHER_IMAP_SSL", "1") == "1"   # 0 solo para el IMAP local de los benchmarks
+
+# Notificaciones: cola con sesión HTTP compartida y límites de Telegram
+notificador = TelegramNotifier(
+    TELEGRAM_TOKEN,
+    api_url=os.getenv("TELEGRAM_API_URL", "https://api.telegram.org"),
+    spool_path=os.getenv("TELEGRAM_SPOOL_FILE", "data/telegram_pendientes.jsonl"),
+)
+
+# Correos ya registrados (atajo local; la BD rechaza duplicados con dbo.ProcessedMessages)
+indice = indice_mensajes.IndiceMensajes(
+    os.getenv("WATCHER_PROCESSED_INDEX", "data/mensajes_procesados.sqlite3"),
+    retencion_dias=int(os.getenv("WATCHER_PROCESSED_RETENTION_DAYS", "90")),
+)
+
+# Compras extraídas que aún no confirma la BD (se reenvían cuando SQL Server vuelve)
+spool = spool_transacciones.SpoolTransacciones(
+    os.getenv("WATCHER_TX_SPOOL", "data/transacciones_pendientes.sqlite3"),
+    lote=int(os.getenv("WATCHER_TX_SPOOL_BATCH", "100")),
+    intervalo=int(os.getenv("WATCHER_TX_SPOOL_INTERVAL", "5")),
+)
+
+# Concurrencia del sondeo. POLL_INTERVAL es el intervalo base; cada cuenta se
+# revisa entre POLL_MIN (con compras recientes) y POLL_MAX (sin actividad).
+POLL_INTERVAL = int(os.getenv("WATCHER_POLL_INTERVAL", "45"))
+POLL_MIN = int(os.getenv("WATCHER_POLL_MIN", "15"))
+POLL_MAX = int(os.getenv("WATCHER_POLL_MAX", "300"))
+ACTIVE_WINDOW = int(os.getenv("WATCHER_ACTIVE_WINDOW", "3600"))
+MAX_WORKERS = int(os.getenv("WATCHER_MAX_WORKERS", "8"))
+ACCOUNT_TIMEOUT = int(os.getenv("WATCHER_ACCOUNT_TIMEOUT", "60"))
+
+# Sesiones persistentes: 'idle' (push en tiempo real) o 'poll' (sondeo periódico)
+WATCHER_MODE = os.getenv("WATCHER_MODE", "idle").lower()
+IDLE_TIMEOUT = int(os.getenv("WATCHER_IDLE_TIMEOUT", "1500"))  # Gmail corta IDLE a los ~29 min
+RECONNECT_BACKOFF_MAX = int(os.getenv("WATCHER_RECONNECT_BACKOFF_MAX", "300"))
+
+# Login rechazado: backoff exponencial propio y aviso único al usuario tras N fallos
+AUTH_BACKOFF_MAX = int(os.getenv("WATCHER_AUTH_BACKOFF_MAX", "21600"))
+AUTH_NOTIFY_AFTER = int(os.getenv("WATCHER_AUTH_NOTIFY_AFTER", "3"))
+
+# Refresco incremental de cuentas y recarga completa periódica
+ACCOUNTS_REFRESH_INTERVAL = int(os.getenv("WATCHER_ACCOUNTS_REFRESH", "5"))
+ACCOUNTS_FULL_RELOAD = int(os.getenv("WATCHER_ACCOUNTS_FULL_RELOAD", "3600"))
+
+# Catálogo de comercios: las variantes de un comercio conocido se registran con su nombre
+# (y su regla), en vez de crear otro Comercio y volver a preguntar multiplicador y categoría
+CANONICALIZAR_COMERCIOS = os.getenv("WATCHER_MERCHANT_CANONICAL", "1") == "1"
+catalogo = comercios.CatalogoComercios(
+    similitud=float(os.getenv("WATCHER_MERCHANT_SIMILARITY", "0.8")),
+    full_reload_interval=ACCOUNTS_FULL_RELOAD,
+)
+MERCHANTS_REFRESH_INTERVAL = int(os.getenv("WATCHER_MERCHANTS_REFRESH", "60"))
+
+# Intentos por correo antes de avanzar el checkpoint y descartarlo
+MAX_REINTENTOS_CORREO = 3
+
+# Métricas: endpoint Prometheus local y snapshot periódico en disco
+METRICS_PORT = int(os.getenv("WATCHER_METRICS_PORT", "9108"))
+METRICS_SNAPSHOT = os.getenv("WATCHER_METRICS_SNAPSHOT", "data/metricas_watcher.json")
+METRICS_SNAPSHOT_INTERVAL = int(os.getenv("METRICS_SNAPSHOT_INTERVAL", "60"))
+
+# Modo por shards (varias instancias): cada trabajador atiende los AppUsers de los
+# shards que tiene arrendados en la BD. Se activa con --workers N o WATCHER_SHARDED=1.
+SHARDED = os.getenv("WATCHER_SHARDED", "0") == "1"
+SHARDS_TOTAL = int(os.getenv("WATCHER_SHARDS", "64"))
+SHARD_LEASE = int(os.getenv("WATCHER_SHARD_LEASE", "60"))
+SHARD_HEARTBEAT = int(os.getenv("WATCHER_SHARD_HEARTBEAT", "20"))
 
 # Lista blanca de remitentes (bancos)
 ALLOWED_SENDERS = [
     "contactenos@globalbank.com.pa",
+    "@baccredomatic.com",
+    "@notificacionesbaccr.com",
+    "@bgeneral.com",
     "ingridt.r.pinto@gmail.com" ,
     "buglione2500@gmail.com"
 ]
 
-def enviar_telegram(chat_id, mensaje, botones=None):
-    """Envía notificación a Telegram."""
-    if not chat_id or not TELEGRAM_TOKEN:
-        return
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
-    payload = {"chat_id": chat_id, "text": mensaje, "parse_mode": "Markdown"}
-    if botones: payload["reply_markup"] = botones
+def es_correo_banco(correo):
+    """Filtro previo con los encabezados: remitente permitido y asunto de compra de su banco."""
+    remitente = correo['remitente'].lower()
+    if not any(s.lower() in remitente for s in ALLOWED_SENDERS):
+        return False
+    return extraccion.motor.es_asunto_de_compra(remitente, correo['asunto'])
+
+def enviar_telegram(chat_id, mensaje, botones=None, origen=None):
+    """Encola la notificación; el envío real lo hace el hilo del notificador."""
+    notificador.enviar(chat_id, mensaje, botones, origen=origen)
+
+def avisar_login_rechazado(account):
+    """Aviso único por Telegram cuando la contraseña de aplicación deja de funcionar."""
+    enviar_telegram(
+        account['chat_id'],
+        f"⚠️ No puedo entrar a tu correo `{account['email']}`. "
+        "Es posible que la contraseña de aplicación se haya revocado o cambiado.\n\n"
+        "Usa /registro para guardar una nueva."
+    )
+
+def fecha_correo(fecha):
+    """Encabezado Date -> epoch, o None si falta o no se puede interpretar."""
+    if not fecha:
+        return None
     try:
-        requests.post(url, json=payload, timeout=10)
-    except Exception as e:
-        log.error(f"Error Telegram: {e}")
+        return parsedate_to_datetime(fecha).timestamp()
+    except (TypeError, ValueError):
+        return None
 
 def crear_botones_configuracion(transaction_id, action_type):
-    """Genera botones de configuración."""
-    keyboard = {"inline_keyboard": []}
-    if action_type in ['ASK_MULT', 'ASK_BOTH']:
-        keyboard["inline_keyboard"].append([
-            {"text": "1x", "callback_data": f"cfg|{transaction_id}|mult|1.0"},
-            {"text": "2x", "callback_data": f"cfg|{transaction_id}|mult|2.0"},
-            {"text": "3x", "callback_data": f"cfg|{transaction_id}|mult|3.0"}
-        ])
-    if action_type in ['ASK_CAT', 'ASK_BOTH']:
-        keyboard["inline_keyboard"].append([
-            {"text": "Comida", "callback_data": f"cfg|{transaction_id}|cat|Comida"},
-            {"text": "Transporte", "callback_data": f"cfg|{transaction_id}|cat|Transporte"},
-            {"text": "Super", "callback_data": f"cfg|{transaction_id}|cat|Supermercado"}
-        ])
-        keyboard["inline_keyboard"].append([
-            {"text": "Servicios", "callback_data": f"cfg|{transaction_id}|cat|Servicios"},
-            {"text": "General", "callback_data": f"cfg|{transaction_id}|cat|General"}
-        ])
-    return keyboard
-
-def extraer_datos_regex(cuerpo_texto):
-    """Extrae datos del correo."""
-    texto = cuerpo_texto.replace('\r', '').replace('\n', ' ')
-    
-    patron_comercio = r" en\s+(.*?)\s+con tarjeta"
-    patron_monto = r"\$\s?([\d\.,]+)"
-    patron_tarjeta = r"terminaci[óo]n\s+(\w{4})"
-    patron_banco = r"(Global Bank|Bac Credomatic|Banco General)"
-
-    match_comercio = re.search(patron_comercio, texto, re.IGNORECASE)
-    match_monto = re.search(patron_monto, texto)
-    match_tarjeta = re.search(patron_tarjeta, texto, re.IGNORECASE)
-    match_banco = re.search(patron_banco, texto, re.IGNORECASE)
-
-    if match_comercio and match_monto and match_tarjeta:
-        return {
-            "comercio": match_comercio.group(1).strip(),
-            "monto": float(match_monto.group(1).replace(',', '')),
-            "last4": match_tarjeta.group(1),
-            "banco": match_banco.group(1) if match_banco else "Global Bank"
-        }
-    return None
-
-def procesar_cuenta(db, account):
-    """
-    Se conecta al Gmail de un usuario específico y procesa sus correos.
+    """Genera botones de configuración (teclado combinado, ver botones.py)."""
+    pendiente = botones.PENDIENTE_POR_ACCION.get(action_type)
+    if pendiente is None:
+        return {"inline_keyboard": []}
+    return botones.teclado_json(botones.filas_configuracion(transaction_id, pendiente))
+
+def extraer_datos_regex(cuerpo_texto, remitente=None):
+    """Extrae datos del correo con la plantilla del banco que lo envió."""
+    datos, _ = extraccion.motor.extraer(cuerpo_texto, remitente)
+    return datos
+
+def cargar_checkpoint(db, account, sesion):
+    """
+    Devuelve el último UID procesado de la cuenta para el UIDVALIDITY actual.
+    Si no hay estado guardado, cambió el correo o cambió UIDVALIDITY, el
+    checkpoint se reinicia al final del buzón (UIDNEXT - 1).
+    """
+    if sesion.last_uid is not None and sesion.checkpoint_validity == sesion.uid_validity:
+        return sesion.last_uid
+
+    email_addr = account['email']
+    estado = db.get_sync_state(account['user_id'])
+    if estado is False:
+        # Sin poder leerlo no se reinicia: se saltarían los correos llegados durante la caída
+        raise BDNoDisponible("No se pudo leer el checkpoint")
+    if (estado and estado['uid_validity'] == sesion.uid_validity
+            and estado['email'].lower() == email_addr.lower()):
+        last_uid = estado['last_uid']
+    else:
+        last_uid = max(0, sesion.uid_next - 1)
+        if estado:
+            log.warning("UIDVALIDITY cambió (%s -> %s). Checkpoint reiniciado en UID %s.", estado['uid_validity'], sesion.uid_validity, last_uid, cuenta=email_addr, etapa="checkpoint")
+        else:
+            log.info("Sin checkpoint previo. Iniciando en UID %s.", last_uid, cuenta=email_addr, etapa="checkpoint")
+        db.save_sync_state(account['user_id'], email_addr, sesion.uid_validity, last_uid)
+
+    sesion.last_uid = last_uid
+    sesion.checkpoint_validity = sesion.uid_validity
+    sesion.reintentos.clear()
+    return last_uid
+
+def registrar_fallo(sesion, email_addr, uid, error):
+    """
+    Cuenta un intento fallido del correo `uid`.
+    :return: True si ya agotó los reintentos y debe descartarse.
+    """
+    intentos = sesion.reintentos.get(uid, 0) + 1
+    sesion.reintentos[uid] = intentos
+    metricas.CORREOS.labels("fallidos").inc()
+    if intentos >= MAX_REINTENTOS_CORREO:
+        log.error("Correo UID %s descartado tras %s intentos: %s", uid, intentos, error, cuenta=email_addr, uid=uid)
+        sesion.reintentos.pop(uid, None)
+        return True
+    log.error("Error leyendo correo UID %s (intento %s): %s", uid, intentos, error, cuenta=email_addr, uid=uid)
+    return False
+
+def notificar_compra(chat_id, email_addr, res, recibido_en=None, uid=None):
+    """Avisa al usuario el resultado de registrar una compra (los duplicados no se notifican)."""
+    if res['bot_action'] == 'DUPLICATE':
+        # Ya registrada en un ciclo anterior (p.ej. caída antes del checkpoint): no se notifica otra vez
+        metricas.CORREOS.labels("duplicados").inc()
+        log.info("Correo UID %s ya registrado, se omite.", uid, cuenta=email_addr, etapa="registro", uid=uid)
+        return
+    botones = None
+    if res['bot_action'] != 'AUTO':
+        botones = crear_botones_configuracion(res['transaction_id'], res['bot_action'])
+    # Enviamos al Chat ID de esta cuenta
+    enviar_telegram(chat_id, f"💳 {res['message']}", botones, origen=recibido_en)
+
+def compra_recuperada(registro, res):
+    """El drenador registró una compra que había quedado en el spool."""
+    compra = registro['compra']
+    indice.registrar(compra['app_user_id'], [compra.get('message_key')])
+    notificar_compra(registro['chat_id'], registro['email'], res, registro.get('recibido_en'))
+
+def nombre_comercio(app_user_id, datos):
+    """Comercio con el que se registra la compra (canónico si el catálogo conoce uno equivalente)."""
+    if not CANONICALIZAR_COMERCIOS:
+        return datos['comercio']
+    return catalogo.canonico(datos['comercio'], app_user_id, datos['last4'])
+
+def registrar_compras(db, account, sesion, lote):
+    """
+    Guarda las compras del ciclo en una sola llamada (TVP) y notifica cada una.
+    Antes se escriben en el spool local: si la BD no las registra quedan ahí y
+    el drenador las reenvía (y notifica) después, así que el checkpoint avanza.
+    Sin spool, si el lote falla se reintenta compra por compra para aislar la que falla.
+    :param lote: lista de (uid, datos) en orden de llegada.
+    :return: UID de la primera compra que no se pudo guardar, o None.
+    """
+    email_addr = account['email']
+    compras = [{
+        "app_user_id": account['user_id'],
+        "merchant_text": nombre_comercio(account['user_id'], datos),
+        "card_last4": datos['last4'],
+        "bank_name": datos['banco'],
+        "amount": datos['monto'],
+        "message_key": datos.get('clave')
+    } for _, datos in lote]
+    ids = spool.agregar([
+        {"compra": compra, "chat_id": account['chat_id'], "email": email_addr, "recibido_en": datos.get('recibido_en')}
+        for compra, (_, datos) in zip(compras, lote)
+    ])
+
+    fallido = None
+    with metricas.ETAPAS.labels("registro_bd").medir():
+        resultados = db.process_transactions_bulk(compras)
+    if resultados is None and ids is not None:
+        log.warning("La BD no registró %d compras; quedan en el spool para reintentarlas.", len(compras),
+                    cuenta=email_addr, etapa="registro")
+        for uid, _ in lote:
+            sesion.reintentos.pop(uid, None)
+        return None
+    if resultados is None:
+        log.warning("Falló el registro en lote, reintentando una por una.", cuenta=email_addr, etapa="registro")
+        resultados = []
+        for (uid, _), compra in zip(lote, compras):
+            with metricas.ETAPAS.labels("registro_bd").medir():
+                res = db.process_transaction(**compra)
+            if res is None and not registrar_fallo(sesion, email_addr, uid, "La BD no registró la transacción"):
+                fallido = uid
+                break
+            resultados.append(res)
+    elif ids is not None:
+        spool.confirmar([i for i, res in zip(ids, resultados) if res])
+
+    indice.registrar(account['user_id'], [datos.get('clave') for (_, datos), res in zip(lote, resultados) if res])
+    for (uid, datos), res in zip(lote, resultados):
+        sesion.reintentos.pop(uid, None)
+        if res:
+            notificar_compra(account['chat_id'], email_addr, res, datos.get('recibido_en'), uid)
+    return fallido
+
+def procesar_cuenta(db, account, sesion):
+    """
+    Procesa los correos nuevos de un usuario usando su sesión IMAP persistente.
+    Solo pide al servidor los UID posteriores al checkpoint guardado: primero
+    los encabezados de todos, luego el texto de los que vienen de un banco.
     dict {user_id, chat_id, email, password}
+    :return: resultado para el planificador (planificador.CON_CORREO, SIN_CORREO, ...).
     """
     email_addr = account['email']
-    pwd = account['password']
+    # Límite total para la cuenta; el timeout del socket cubre cada operación IMAP
+    deadline = time.monotonic() + ACCOUNT_TIMEOUT
+    inicio = time.perf_counter()
     
     try:
-        
-        mail = imaplib.IMAP4_SSL(IMAP_SERVER)
-        mail.login(email_addr, pwd)
-        mail.select("inbox")
-        
-        log.info('Login a correo existoso')
-        # Buscar correos no leídos
-        status, messages = mail.search(None, '(UNSEEN SUBJECT "CONFIRMACION")')
-        email_ids = messages[0].split()
+        mail = sesion.obtener()
+        if mail is None:
+            # Esperando el backoff de reconexión
+            return planificador.EN_ESPERA
 
-        if email_ids:
-            log.info(f"[{email_addr}] Detectados {len(email_ids)} correos nuevos.")
+        last_uid = cargar_checkpoint(db, account, sesion)
+        checkpoint = last_uid
 
-        for e_id in email_ids:
-            try:
-                _, msg_data = mail.fetch(e_id, "(RFC822)")
-                msg = email.message_from_bytes(msg_data[0][1])
-                
-                # Filtro Remitente
-                remitente_raw = msg.get('From')
-                remitente_email = parseaddr(remitente_raw)[1]
-                
-                es_valido = any(s.lower() in remitente_email.lower() for s in ALLOWED_SENDERS)
-                if not es_valido:
-                    continue
+        # Etapa 1: encabezados + estructura de todo lo posterior al checkpoint
+        with metricas.ETAPAS.labels("encabezados").medir():
+            correos = imap_fetch.obtener_encabezados(mail, last_uid)
+        candidatos = [c for c in correos if es_correo_banco(c)]
+        metricas.CORREOS.labels("vistos").inc(len(correos))
+        metricas.CORREOS.labels("filtrados").inc(len(correos) - len(candidatos))
+
+        # Los ya registrados no se vuelven a descargar (reproceso tras una caída o cambio de shard)
+        nuevos, procesados = [], 0
+        for c in candidatos:
+            c['clave'] = indice_mensajes.clave_mensaje(c['message_id'], sesion.uid_validity, c['uid'])
+            if indice.contiene(account['user_id'], c['clave']):
+                procesados += 1
+            else:
+                nuevos.append(c)
+        if procesados:
+            metricas.CORREOS.labels("duplicados").inc(procesados)
+            log.debug("%d correos ya registrados, se omiten.", procesados, cuenta=email_addr, etapa="encabezados")
+        candidatos = nuevos
 
-                # Extraer cuerpo
-                cuerpo = ""
-                if msg.is_multipart():
-                    for part in msg.walk():
-                        if part.get_content_type() == "text/plain":
-                            cuerpo = part.get_payload(decode=True).decode(errors='ignore')
-                            break
+        if candidatos:
+            log.info("Detectados %d correos nuevos.", len(candidatos), cuenta=email_addr, etapa="encabezados")
+
+        # Etapa 2: solo la parte text/plain de los correos de bancos permitidos
+        cuerpos = {}
+        if candidatos:
+            with metricas.ETAPAS.labels("cuerpos").medir():
+                cuerpos = imap_fetch.obtener_cuerpos(mail, candidatos)
+        uids_candidatos = {c['uid'] for c in candidatos}
+
+        # Parsear todo lo del ciclo; las compras se guardan juntas en un solo lote
+        lote = []
+        examinados = []
+        for correo in correos:
+            uid = correo['uid']
+            if time.monotonic() > deadline:
+                log.warning("Tiempo límite alcanzado, el resto queda para el próximo ciclo.", cuenta=email_addr, etapa="parseo")
+                break
+            if uid in uids_candidatos:
+                if correo['texto_plano'] is None:
+                    log.warning("Correo UID %s sin parte text/plain, se omite.", uid, cuenta=email_addr, etapa="cuerpos", uid=uid)
+                elif uid not in cuerpos:
+                    if not registrar_fallo(sesion, email_addr, uid, "No se pudo descargar el cuerpo"):
+                        break
                 else:
-                    cuerpo = msg.get_payload(decode=True).decode(errors='ignore')
-
-                # Procesar Datos
-                datos = extraer_datos_regex(cuerpo)
-                if datos:
-                    log.info(f"[{email_addr}] Compra: {datos['comercio']} (${datos['monto']})")
-                    
-                    # Guardar en BD (Usamos el user_id de la cuenta actual)
-                    res = db.process_transaction(
-                        app_user_id=account['user_id'],
-                        merchant_text=datos['comercio'],
-                        card_last4=datos['last4'],
-                        bank_name=datos['banco'],
-                        amount=datos['monto']
-                    )
-
-                    if res:
-                        botones = None
-                        if res['bot_action'] != 'AUTO':
-                            botones = crear_botones_configuracion(res['transaction_id'], res['bot_action'])
-                        # Enviamos al Chat ID de esta cuenta
-                        enviar_telegram(account['chat_id'], f"💳 {res['message']}", botones)
+                    # Procesar Datos
+                    with metricas.ETAPAS.labels("extraccion").medir():
+                        datos = extraer_datos_regex(cuerpos[uid], correo['remitente'])
+                    if datos:
+                        metricas.CORREOS.labels("parseados").inc()
+                        log.info("Compra: %s ($%s)", datos['comercio'], datos['monto'], cuenta=email_addr, etapa="parseo", uid=uid)
+                        datos['recibido_en'] = fecha_correo(correo['fecha'])
+                        datos['clave'] = correo['clave']
+                        lote.append((uid, datos))
+                    else:
+                        metricas.CORREOS.labels("fallidos").inc()
+            examinados.append(uid)
 
-            except Exception as e:
-                log.error(f"[{email_addr}] Error leyendo correo {e_id}: {e}")
+        fallido = registrar_compras(db, account, sesion, lote) if lote else None
+
+        # El checkpoint avanza hasta justo antes de la primera compra no guardada
+        for uid in examinados:
+            if fallido is not None and uid >= fallido:
+                break
+            checkpoint = uid
+
+        if checkpoint != last_uid:
+            sesion.last_uid = checkpoint
+            db.save_sync_state(account['user_id'], email_addr, sesion.uid_validity, checkpoint)
+        return planificador.CON_CORREO if candidatos else planificador.SIN_CORREO
+
+    except BDNoDisponible as e:
+        # La conexión IMAP sigue sana; se reintenta cuando vuelva la BD
+        log.debug("Cuenta en espera: %s.", e, cuenta=email_addr, etapa="checkpoint")
+        log.limitado("bd_checkpoint", 60, "Cuentas en espera de la BD: %s.", e, nivel=logging.WARNING, etapa="checkpoint")
+        return planificador.ERROR
 
-        mail.close()
-        mail.logout()
+    except ErrorAutenticacion:
+        # El planificador lleva la cuenta de los rechazos y su backoff
+        sesion.marcar_caida()
+        return planificador.ERROR_AUTH
 
-    except imaplib.IMAP4.error:
-        log.warning(f"[{email_addr}] Error de autenticación. Posible contraseña cambiada.")
+    except imaplib.IMAP4.abort as e:
+        espera = sesion.marcar_caida()
+        log.warning("Conexión IMAP perdida (%s). Reintento en %ss.", e, espera, cuenta=email_addr, etapa="imap")
+    except imaplib.IMAP4.error as e:
+        espera = sesion.marcar_caida()
+        log.warning("Error IMAP: %s. Reintento en %ss.", e, espera, cuenta=email_addr, etapa="imap")
     except Exception as e:
-        log.error(f"[{email_addr}] Error de conexión: {e}")
+        espera = sesion.marcar_caida()
+        log.error("Error de conexión: %s. Reintento en %ss.", e, espera, cuenta=email_addr, etapa="imap")
+    finally:
+        metricas.ETAPAS.labels("cuenta").observar(time.perf_counter() - inicio)
+    return planificador.ERROR
+
+def revisar_cuentas(db, cuentas, executor, en_curso, sesiones, agenda):
+    """
+    Reparte las cuentas que ya tocaba revisar en el pool de hilos y espera como
+    máximo ACCOUNT_TIMEOUT. Una cuenta que sigue ocupada (buzón lento o colgado)
+    no se vuelve a encolar ni bloquea a las demás. Al terminar cada una, su
+    resultado fija la próxima revisión en la agenda.
+    """
+    futuros = []
+    for cuenta in cuentas:
+        email_addr = cuenta['email']
+        previo = en_curso.get(email_addr)
+        if previo and not previo.done():
+            log.warning("Revisión anterior aún en curso, se omite en este ciclo.", cuenta=email_addr)
+            agenda.reprogramar(cuenta, planificador.EN_ESPERA)
+            continue
+
+        # Una línea por cuenta y ciclo: solo en DEBUG
+        log.debug("Revisando buzón", cuenta=email_addr)
+        sesion = sesiones.obtener(cuenta)
+        futuro = executor.submit(procesar_cuenta, db, cuenta, sesion)
+        futuro.add_done_callback(
+            lambda f, c=cuenta, s=sesion: agenda.reprogramar(
+                c, f.result() if not f.exception() else planificador.ERROR, s.segundos_para_reintento()
+            )
+        )
+        en_curso[email_addr] = futuro
+        futuros.append(futuro)
+
+    if not futuros:
+        return
+
+    inicio = time.perf_counter()
+    _, pendientes = wait(futuros, timeout=ACCOUNT_TIMEOUT)
+    metricas.CICLO.set(time.perf_counter() - inicio)
+    if pendientes:
+        log.warning("%s buzones excedieron %ss; continúan en segundo plano.", len(pendientes), ACCOUNT_TIMEOUT)
+
+    # Limpiar referencias de cuentas terminadas
+    for email_addr in [e for e, f in en_curso.items() if f.done()]:
+        del en_curso[email_addr]
+
+def vigilar_cuenta(db, account, sesion, detener, limite, agenda):
+    """
+    Hilo dedicado a una cuenta en modo IDLE: procesa lo pendiente y queda
+    esperando el aviso del servidor. `limite` acota cuántas cuentas procesan
+    correo a la vez; `agenda` decide cuánto esperar tras un fallo.
+    """
+    email_addr = account['email']
+    while not detener.is_set():
+        with limite:
+            resultado = procesar_cuenta(db, account, sesion)
+        if detener.is_set():
+            break
+
+        espera = agenda.espera_tras(account, resultado, sesion.segundos_para_reintento())
+        if sesion.mail is None:
+            detener.wait(espera or sesion.segundos_para_reintento())
+            continue
+
+        try:
+            if sesion.esperar_correo(IDLE_TIMEOUT):
+                log.debug("Aviso de correo nuevo (IDLE).", cuenta=email_addr, etapa="idle")
+        except Exception as e:
+            if detener.is_set():
+                break
+            espera = sesion.marcar_caida()
+            log.warning("IDLE interrumpido (%s). Reintento en %ss.", e, espera, cuenta=email_addr, etapa="idle")
+
+def sincronizar_vigilantes(db, cuentas, sesiones, vigilantes, limite, agenda):
+    """Arranca hilos para cuentas nuevas y detiene los de cuentas retiradas o modificadas."""
+    por_email = {c['email']: c for c in cuentas}
 
-def main():
-    log.info("Iniciando lector de correo...")
+    for email_addr in list(vigilantes):
+        hilo, detener, account = vigilantes[email_addr]
+        actual = por_email.get(email_addr)
+        if actual is None or actual['password'] != account['password'] or not hilo.is_alive():
+            detener.set()
+            del vigilantes[email_addr]
+
+    sesiones.sincronizar(cuentas)
+    agenda.sincronizar(cuentas, agendar=False)
+
+    for email_addr, account in por_email.items():
+        if email_addr in vigilantes:
+            continue
+        log.debug("Vigilando buzón", cuenta=email_addr)
+        detener = threading.Event()
+        hilo = threading.Thread(
+            target=vigilar_cuenta,
+            args=(db, account, sesiones.obtener(account), detener, limite, agenda),
+            name=f"idle-{email_addr}",
+            daemon=True
+        )
+        vigilantes[email_addr] = (hilo, detener, account)
+        hilo.start()
+
+def main(worker_id=None):
+    """
+    :param worker_id: identificador del trabajador en modo shards; None atiende todas las cuentas.
+    """
+    log.info("Iniciando lector de correo (modo %s, %s hilos, timeout %ss por cuenta)...", WATCHER_MODE, MAX_WORKERS, ACCOUNT_TIMEOUT)
     
     try:
         db = GlobalPointsDB()
@@ -165,23 +497,144 @@ def main():
         log.error(f"Error crítico conectando a BD: {e}")
         return
 
-    while True:
-        try:
-            # 1. Obtener todas las cuentas a monitorear desde la BD
-            cuentas = db.get_all_monitored_accounts()
-            
-            if not cuentas:
-                log.info("No hay cuentas activas para monitorear. Esperando...")
+    arriendo = None
+    if worker_id:
+        # La gracia cubre la revisión en curso de un shard cedido antes de que otro lo tome
+        arriendo = shards.ArriendoShards(
+            db, worker_id, total_shards=SHARDS_TOTAL, duracion=SHARD_LEASE,
+            latido=SHARD_HEARTBEAT, gracia=ACCOUNT_TIMEOUT + SHARD_HEARTBEAT
+        )
+        log.info("Trabajador %s: %s shards, arriendo de %ss.", worker_id, SHARDS_TOTAL, SHARD_LEASE)
+        arriendo.iniciar()
+
+    notificador.iniciar()
+    indice.abrir()
+    spool.iniciar_drenado(db, compra_recuperada)
+    metricas.iniciar(METRICS_PORT, METRICS_SNAPSHOT, METRICS_SNAPSHOT_INTERVAL)
+    registro = AccountRegistry(db, full_reload_interval=ACCOUNTS_FULL_RELOAD)
+    if CANONICALIZAR_COMERCIOS:
+        # Carga en caliente: el catálogo ya está completo al registrar la primera compra
+        catalogo.sincronizar(db)
+    sesiones = ImapSessionManager(IMAP_SERVER, timeout=ACCOUNT_TIMEOUT, backoff_max=RECONNECT_BACKOFF_MAX,
+                                  port=IMAP_PORT, ssl=IMAP_SSL)
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="buzon")
+    en_curso = {}
+    vigilantes = {}
+    limite = threading.BoundedSemaphore(MAX_WORKERS)
+    agenda = planificador.PlanificadorCuentas(
+        intervalo_base=POLL_INTERVAL, intervalo_min=POLL_MIN, intervalo_max=POLL_MAX,
+        ventana_actividad=ACTIVE_WINDOW, auth_backoff_max=AUTH_BACKOFF_MAX,
+        avisar_tras=AUTH_NOTIFY_AFTER, avisar=avisar_login_rechazado
+    )
+    proxima_sincronizacion = 0.0
+    proxima_sincronizacion_comercios = time.monotonic() + MERCHANTS_REFRESH_INTERVAL
+    cuentas = []
+
+    try:
+        while True:
+            try:
+                # 1. Aplicar los cambios de cuentas (altas, bajas, contraseñas nuevas)
+                if time.monotonic() >= proxima_sincronizacion:
+                    cuentas = registro.sincronizar()
+                    if arriendo:
+                        cuentas = arriendo.propias(cuentas)
+                    proxima_sincronizacion = time.monotonic() + ACCOUNTS_REFRESH_INTERVAL
+                    if WATCHER_MODE != "idle":
+                        sesiones.sincronizar(cuentas)
+                        agenda.sincronizar(cuentas)
+
+                # Comercios y reglas nuevos (p.ej. configurados desde el bot) para canonicalizar
+                if CANONICALIZAR_COMERCIOS and time.monotonic() >= proxima_sincronizacion_comercios:
+                    catalogo.sincronizar(db)
+                    proxima_sincronizacion_comercios = time.monotonic() + MERCHANTS_REFRESH_INTERVAL
             
-            # 2. Iterar y procesar cada una
-            for cuenta in cuentas:
-                log.info(f"Revisando buzón de: {cuenta['email']}")
-                procesar_cuenta(db, cuenta)
+                # 2. Procesar las cuentas: hilos IDLE por cuenta o las que vencieron en la agenda
+                if WATCHER_MODE == "idle":
+                    sincronizar_vigilantes(db, cuentas, sesiones, vigilantes, limite, agenda)
+                else:
+                    revisar_cuentas(db, agenda.vencidas(), executor, en_curso, sesiones, agenda)
                 
-        except Exception as e:
-            log.error(f"Error en el ciclo principal: {e}")
+            except Exception as e:
+                log.error("Error en el ciclo principal: %s", e)
         
-        time.sleep(45)
+            # Dormir hasta la próxima cuenta que toque o la próxima sincronización de cuentas
+            espera = max(0.0, proxima_sincronizacion - time.monotonic())
+            if WATCHER_MODE != "idle":
+                proxima = agenda.segundos_para_proxima()
+                if proxima is not None:
+                    espera = min(espera, proxima)
+            time.sleep(max(espera, 0.2))
+    finally:
+        spool.detener()
+        if arriendo:
+            arriendo.detener()
+        # Lo que no alcance a salir queda en el spool para el próximo arranque
+        notificador.detener()
+
+def _con_sufijo(ruta, numero):
+    base, ext = os.path.splitext(ruta)
+    return f"{base}.{numero}{ext}"
+
+def _trabajador(numero):
+    """Proceso hijo de --workers: puertos y archivos propios para no pisarse con los demás."""
+    global METRICS_PORT, METRICS_SNAPSHOT
+    if METRICS_PORT:
+        METRICS_PORT += numero
+    if METRICS_SNAPSHOT:
+        METRICS_SNAPSHOT = _con_sufijo(METRICS_SNAPSHOT, numero)
+    if numero:
+        # Número estable: al reiniciar, el trabajador recupera sus propios spools e índice
+        # (el 0 conserva los de siempre y drena lo que dejó el modo de un solo proceso).
+        # El índice no se comparte: un SQLite por proceso evita la contención de escritura
+        # entre trabajadores; si un shard cambia de dueño, el nuevo solo vuelve a descargar
+        # algunos correos y la BD descarta los duplicados.
+        if notificador.spool_path:
+            notificador.spool_path = _con_sufijo(notificador.spool_path, numero)
+        if spool.ruta:
+            spool.ruta = _con_sufijo(spool.ruta, numero)
+        if indice.ruta:
+            indice.ruta = _con_sufijo(indice.ruta, numero)
+    try:
+        main(worker_id=f"{socket.gethostname()}:{os.getpid()}")
+    except KeyboardInterrupt:
+        pass
+
+def lanzar_trabajadores(n):
+    """
+    Lanza N procesos trabajadores en modo shards y los vuelve a lanzar si alguno
+    termina inesperadamente. Los shards del caído los toman los demás al vencer
+    su arriendo (o de inmediato si alcanzó a liberarlos).
+    """
+    ctx = multiprocessing.get_context("spawn")
+    procesos = {}
+    log.info("Lanzando %s trabajadores (%s shards).", n, SHARDS_TOTAL)
+    try:
+        while True:
+            for numero in range(n):
+                proceso = procesos.get(numero)
+                if proceso is not None and proceso.is_alive():
+                    continue
+                if proceso is not None:
+                    log.warning("Trabajador %s terminó (código %s); relanzando.", numero, proceso.exitcode)
+                proceso = ctx.Process(target=_trabajador, args=(numero,), name=f"watcher-{numero}")
+                proceso.start()
+                procesos[numero] = proceso
+            time.sleep(5)
+    except KeyboardInterrupt:
+        # Ctrl+C llega también a los hijos; se les da tiempo para liberar sus shards
+        for proceso in procesos.values():
+            proceso.join(timeout=ACCOUNT_TIMEOUT)
+            if proceso.is_alive():
+                proceso.terminate()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Lector de correos de bancos.")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="Lanza N procesos trabajadores en modo shards (arriendos en la BD).")
+    args = parser.parse_args()
+    if args.workers > 0:
+        lanzar_trabajadores(args.workers)
+    elif SHARDED:
+        main(worker_id=f"{socket.gethostname()}:{os.getpid()}")
+    else:
+        main()
\ No newline at end of file
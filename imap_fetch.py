@@ -0,0 +1,257 @@
+import base64
+import binascii
+import email
+import quopri
+import re
+import unicodedata
+from email.header import decode_header, make_header
+from email.utils import parseaddr
+
+# Solo se piden estos encabezados en la primera etapa (sin marcar como leído)
+HEADER_FIELDS = "FROM SUBJECT MESSAGE-ID DATE"
+FETCH_ENCABEZADOS = f"(UID BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS ({HEADER_FIELDS})])"
+
+# UIDs por comando FETCH en la segunda etapa
+LOTE_CUERPOS = 100
+
+_LITERAL = re.compile(rb"\{(\d+)\}$")
+_NO_BASE64 = re.compile(rb"[^A-Za-z0-9+/]")
+
+
+class _Literal(bytes):
+    """Bloque literal {n} ya leído por imaplib."""
+
+
+def _fragmentos(data):
+    """Aplana la respuesta de imaplib en fragmentos de texto y literales."""
+    for item in data:
+        if item is None:
+            continue
+        if isinstance(item, tuple):
+            texto, literal = item
+            yield _LITERAL.sub(b"", texto)
+            yield _Literal(literal)
+        else:
+            yield item
+
+
+def _tokens(data):
+    """Tokeniza una respuesta FETCH: paréntesis, átomos, strings y literales."""
+    for frag in _fragmentos(data):
+        if isinstance(frag, _Literal):
+            yield frag
+            continue
+        i, n = 0, len(frag)
+        while i < n:
+            c = frag[i:i + 1]
+            if c in b" \r\n":
+                i += 1
+            elif c in b"()":
+                yield c
+                i += 1
+            elif c == b'"':
+                j, buf = i + 1, bytearray()
+                while j < n and frag[j:j + 1] != b'"':
+                    if frag[j:j + 1] == b"\\":
+                        j += 1
+                    buf += frag[j:j + 1]
+                    j += 1
+                yield _Literal(bytes(buf))
+                i = j + 1
+            else:
+                # Átomo; lo que va entre corchetes (BODY[HEADER.FIELDS (...)]) es parte del átomo
+                j, corchetes = i, 0
+                while j < n:
+                    ch = frag[j:j + 1]
+                    if ch == b"[":
+                        corchetes += 1
+                    elif ch == b"]":
+                        corchetes -= 1
+                    elif corchetes == 0 and ch in b" ()":
+                        break
+                    j += 1
+                atomo = frag[i:j]
+                yield None if atomo.upper() == b"NIL" else atomo
+                i = j
+
+
+def _lista(tokens):
+    """Construye listas anidadas hasta el ')' de cierre."""
+    valores = []
+    for tok in tokens:
+        if tok == b"(" and not isinstance(tok, _Literal):
+            valores.append(_lista(tokens))
+        elif tok == b")" and not isinstance(tok, _Literal):
+            return valores
+        else:
+            valores.append(tok)
+    return valores
+
+
+def parsear_fetch(data):
+    """
+    Convierte la respuesta de `mail.uid('FETCH', ...)` en {uid: {ATRIBUTO: valor}}.
+    Las claves van en mayúsculas, p.ej. 'BODYSTRUCTURE' o 'BODY[1]'.
+    """
+    resultado = {}
+    tokens = _tokens(data)
+    for tok in tokens:
+        if tok != b"(" or isinstance(tok, _Literal):
+            # Número de secuencia y la palabra FETCH
+            continue
+        valores = _lista(tokens)
+        atributos = {}
+        for clave, valor in zip(valores[::2], valores[1::2]):
+            clave = clave.decode("ascii", errors="ignore").upper()
+            # BODY.PEEK[...] se responde como BODY[...]
+            atributos[clave.replace("BODY.PEEK[", "BODY[")] = valor
+        if "UID" in atributos:
+            resultado[int(atributos["UID"])] = atributos
+    return resultado
+
+
+def buscar_texto_plano(estructura, prefijo=""):
+    """
+    Busca la primera parte text/plain dentro de BODYSTRUCTURE.
+    :return: (seccion, encoding, charset) o None.
+    """
+    if not estructura:
+        return None
+    if isinstance(estructura[0], list):
+        # Multipart: las primeras entradas que son listas son las partes hijas
+        for i, parte in enumerate(estructura):
+            if not isinstance(parte, list):
+                break
+            encontrado = buscar_texto_plano(parte, f"{prefijo}{i + 1}.")
+            if encontrado:
+                return encontrado
+        return None
+
+    tipo = (estructura[0] or b"").lower()
+    subtipo = (estructura[1] or b"").lower() if len(estructura) > 1 else b""
+    if tipo != b"text" or subtipo != b"plain":
+        return None
+    params = estructura[2] if len(estructura) > 2 and isinstance(estructura[2], list) else []
+    charset = "utf-8"
+    for nombre, valor in zip(params[::2], params[1::2]):
+        if nombre and nombre.lower() == b"charset" and valor:
+            charset = valor.decode("ascii", errors="ignore")
+    encoding = (estructura[5] or b"7bit").decode("ascii", errors="ignore").lower() if len(estructura) > 5 else "7bit"
+    # Un mensaje no multipart tiene una única parte "1"
+    seccion = prefijo.rstrip(".") or "1"
+    return seccion, encoding, charset
+
+
+def _base64_tolerante(contenido):
+    """
+    Base64 con el relleno mal o truncado (correo cortado): se descartan los
+    caracteres ajenos al alfabeto y se completa el relleno, como hace el paquete
+    email con get_payload(decode=True).
+    """
+    limpio = _NO_BASE64.sub(b"", contenido)
+    if len(limpio) % 4 == 1:
+        # Un carácter suelto no alcanza para un byte
+        limpio = limpio[:-1]
+    return base64.b64decode(limpio + b"=" * (-len(limpio) % 4))
+
+
+def decodificar_parte(contenido, encoding, charset):
+    """Decodifica el contenido transfer-encoded de una parte a texto."""
+    if encoding == "base64":
+        try:
+            contenido = base64.b64decode(contenido)
+        except (binascii.Error, ValueError):
+            contenido = _base64_tolerante(contenido)
+    elif encoding == "quoted-printable":
+        contenido = quopri.decodestring(contenido)
+    try:
+        return contenido.decode(charset, errors="ignore")
+    except LookupError:
+        return contenido.decode("utf-8", errors="ignore")
+
+
+def texto_plano_mensaje(mensaje):
+    """
+    Equivalente a buscar_texto_plano + decodificar_parte para un correo completo
+    ya parseado (archivos .eml/.mbox): texto de la primera parte text/plain o None.
+    """
+    for parte in mensaje.walk():
+        if parte.get_content_type() != "text/plain" or parte.get_filename():
+            continue
+        contenido = parte.get_payload(decode=True) or b""
+        return decodificar_parte(contenido, "8bit", parte.get_content_charset() or "utf-8")
+    return None
+
+
+def _decodificar_header(valor):
+    if not valor:
+        return ""
+    try:
+        return str(make_header(decode_header(valor)))
+    except Exception:
+        return valor
+
+
+def normalizar_asunto(asunto):
+    """Mayúsculas y sin tildes, para comparar con los asuntos de cada banco."""
+    sin_tildes = unicodedata.normalize("NFKD", asunto)
+    return "".join(c for c in sin_tildes if not unicodedata.combining(c)).upper()
+
+
+def datos_encabezados(headers):
+    """From/Subject/Message-ID/Date de un mensaje parseado, en el formato que usa el watcher."""
+    return {
+        "remitente": parseaddr(headers.get("From", ""))[1],
+        "asunto": _decodificar_header(headers.get("Subject", "")),
+        "message_id": (headers.get("Message-ID") or "").strip(),
+        "fecha": headers.get("Date"),
+    }
+
+
+def obtener_encabezados(mail, desde_uid):
+    """
+    Etapa 1: un solo FETCH con From/Subject/Message-ID/Date y BODYSTRUCTURE de
+    todos los UID posteriores a `desde_uid`. No descarga cuerpos ni marca leído.
+    :return: lista ordenada por UID de dicts con los datos de cada correo.
+    """
+    _, data = mail.uid("FETCH", f"{desde_uid + 1}:*", FETCH_ENCABEZADOS)
+    correos = []
+    for uid, atributos in parsear_fetch(data).items():
+        # "n:*" siempre incluye el último mensaje aunque su UID sea <= n
+        if uid <= desde_uid:
+            continue
+        crudo = next((v for k, v in atributos.items() if k.startswith("BODY[HEADER")), b"") or b""
+        correo = datos_encabezados(email.message_from_bytes(crudo))
+        correo["uid"] = uid
+        correo["texto_plano"] = buscar_texto_plano(atributos.get("BODYSTRUCTURE"))
+        correos.append(correo)
+    correos.sort(key=lambda c: c["uid"])
+    return correos
+
+
+def obtener_cuerpos(mail, correos):
+    """
+    Etapa 2: descarga en lote solo la parte text/plain de los correos dados,
+    agrupando por número de sección para usar un FETCH por grupo.
+    :return: {uid: texto}
+    """
+    por_seccion = {}
+    for c in correos:
+        if c["texto_plano"]:
+            por_seccion.setdefault(c["texto_plano"][0], []).append(c)
+
+    cuerpos = {}
+    for seccion, grupo in por_seccion.items():
+        for i in range(0, len(grupo), LOTE_CUERPOS):
+            lote = {c["uid"]: c for c in grupo[i:i + LOTE_CUERPOS]}
+            uids = ",".join(str(u) for u in lote)
+            _, data = mail.uid("FETCH", uids, f"(UID BODY.PEEK[{seccion}])")
+            for uid, atributos in parsear_fetch(data).items():
+                if uid not in lote:
+                    continue
+                contenido = atributos.get(f"BODY[{seccion}]")
+                if contenido is None:
+                    continue
+                _, encoding, charset = lote[uid]["texto_plano"]
+                cuerpos[uid] = decodificar_parte(contenido, encoding, charset)
+    return cuerpos
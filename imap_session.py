@@ -0,0 +1,251 @@
+import imaplib
+import selectors
+import ssl
+import threading
+import time
+
+import metricas
+from logger_helper import AppLogger
+
+log = AppLogger("ImapSession")
+
+
+class ErrorAutenticacion(imaplib.IMAP4.error):
+    """El servidor rechazó el login (contraseña de aplicación revocada o cambiada)."""
+
+
+class ImapSession:
+    """
+    Conexión IMAP persistente (una por cuenta monitoreada).
+    Mantiene el login y el INBOX seleccionado entre ciclos, reconecta con
+    backoff exponencial y permite esperar correo nuevo con IMAP IDLE.
+    """
+
+    # Tras este tiempo sin uso se valida la conexión con NOOP antes de reusarla
+    NOOP_AFTER = 300
+
+    def __init__(self, email_addr, password, server, timeout=60, backoff_base=5, backoff_max=300, port=993, ssl=True):
+        self.email_addr = email_addr
+        self.password = password
+        self.server = server
+        self.port = port
+        self.ssl = ssl      # False solo para servidores locales de prueba (benchmarks)
+        self.timeout = timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self.mail = None
+        self.fallos = 0
+        self.proximo_intento = 0.0
+        self.ultimo_uso = 0.0
+
+        # Estado de sincronización por UID (se llena al seleccionar INBOX)
+        self.uid_validity = None
+        self.uid_next = None
+        self.last_uid = None
+        self.checkpoint_validity = None
+        self.reintentos = {}
+
+    def conectar(self):
+        """Abre la conexión, hace login y selecciona INBOX."""
+        self.cerrar()
+        inicio = time.perf_counter()
+        if self.ssl:
+            mail = imaplib.IMAP4_SSL(self.server, self.port, timeout=self.timeout)
+        else:
+            mail = imaplib.IMAP4(self.server, self.port, timeout=self.timeout)
+        try:
+            try:
+                mail.login(self.email_addr, self.password)
+            except imaplib.IMAP4.error as e:
+                raise ErrorAutenticacion(str(e)) from e
+            mail.select("inbox")
+            self.uid_validity = self._respuesta_int(mail, 'UIDVALIDITY')
+            self.uid_next = self._respuesta_int(mail, 'UIDNEXT')
+            if self.uid_next is None:
+                _, data = mail.status("INBOX", "(UIDNEXT)")
+                self.uid_next = int(data[0].split(b"UIDNEXT")[1].strip(b" )"))
+        except Exception:
+            self._cerrar_socket(mail)
+            raise
+        self.mail = mail
+        self.fallos = 0
+        self.ultimo_uso = time.monotonic()
+        metricas.ETAPAS.labels("login").observar(time.perf_counter() - inicio)
+        # Con miles de cuentas esta línea se repite mucho: el detalle por cuenta va en DEBUG
+        # y en INFO solo un conteo de todas las cuentas una vez por minuto (sin `cuenta`)
+        log.debug("Login a correo exitoso.", cuenta=self.email_addr, etapa="login")
+        log.limitado("login", 60, "Login a correo exitoso (todas las cuentas).", etapa="login")
+        return mail
+
+    def obtener(self):
+        """
+        Devuelve la conexión lista para usar, reconectando si hace falta.
+        Devuelve None si la cuenta está esperando su backoff de reconexión.
+        """
+        if self.mail is not None:
+            if time.monotonic() - self.ultimo_uso > self.NOOP_AFTER:
+                try:
+                    self.mail.noop()
+                except Exception:
+                    log.warning("Conexión inactiva perdida, reconectando.", cuenta=self.email_addr, etapa="noop")
+                    self._cerrar_socket(self.mail)
+                    self.mail = None
+            if self.mail is not None:
+                self.ultimo_uso = time.monotonic()
+                return self.mail
+
+        if time.monotonic() < self.proximo_intento:
+            return None
+        return self.conectar()
+
+    def marcar_caida(self):
+        """Descarta la conexión actual y programa el siguiente intento con backoff."""
+        self.cerrar()
+        self.fallos += 1
+        # El primer fallo reconecta de inmediato; los siguientes esperan cada vez más
+        espera = 0 if self.fallos == 1 else min(self.backoff_max, self.backoff_base * 2 ** (self.fallos - 2))
+        self.proximo_intento = time.monotonic() + espera
+        return espera
+
+    def segundos_para_reintento(self):
+        return max(0.0, self.proximo_intento - time.monotonic())
+
+    def esperar_correo(self, timeout):
+        """
+        Entra en IDLE hasta que el servidor avise de correo nuevo o pase `timeout`.
+        :return: True si llegó un aviso EXISTS/RECENT, False si venció el tiempo.
+        """
+        mail = self.obtener()
+        if mail is None:
+            return False
+
+        tag = mail._new_tag()
+        mail.send(tag + b" IDLE\r\n")
+        respuesta = mail.readline()
+        if not respuesta.startswith(b"+"):
+            raise imaplib.IMAP4.error(f"IDLE rechazado: {respuesta!r}")
+
+        hay_correo = False
+        limite = time.monotonic() + timeout
+        # select.select() no admite descriptores >= 1024 (miles de cuentas en IDLE): se usa poll/epoll
+        selector = selectors.DefaultSelector()
+        selector.register(mail.sock, selectors.EVENT_READ)
+        try:
+            while not hay_correo:
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    break
+                # Líneas que ya están en el buffer de imaplib o en el de TLS no despiertan al selector
+                if not self._datos_en_buffer(mail):
+                    if not selector.select(restante):
+                        break
+                linea = mail.readline()
+                if not linea:
+                    raise imaplib.IMAP4.abort("Conexión cerrada durante IDLE")
+                if linea.startswith(b"*") and (b"EXISTS" in linea or b"RECENT" in linea):
+                    hay_correo = True
+        finally:
+            selector.close()
+
+        # Terminar IDLE y consumir hasta la respuesta etiquetada
+        mail.send(b"DONE\r\n")
+        while True:
+            linea = mail.readline()
+            if not linea:
+                raise imaplib.IMAP4.abort("Conexión cerrada al terminar IDLE")
+            if linea.startswith(tag):
+                if b" OK" not in linea:
+                    raise imaplib.IMAP4.error(f"IDLE terminó con error: {linea!r}")
+                break
+            if linea.startswith(b"*") and b"EXISTS" in linea:
+                hay_correo = True
+
+        self.ultimo_uso = time.monotonic()
+        return hay_correo
+
+    def cerrar(self):
+        """Cierra la conexión (también despierta un IDLE en curso desde otro hilo)."""
+        mail, self.mail = self.mail, None
+        if mail is not None:
+            self._cerrar_socket(mail)
+
+    @staticmethod
+    def _datos_en_buffer(mail):
+        """
+        True si hay datos leídos del socket que el selector no va a reportar: en el
+        BufferedReader de imaplib (`mail.file`, p.ej. un EXISTS que llegó pegado
+        al "+ idling") o ya descifrados en el buffer TLS. El peek se hace con el
+        socket en modo no bloqueante: con el buffer vacío peek() lee del socket.
+        """
+        pendiente = getattr(mail.sock, "pending", None)
+        if pendiente and pendiente():
+            return True
+        timeout = mail.sock.gettimeout()
+        mail.sock.setblocking(False)
+        try:
+            return bool(mail.file.peek(1))
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return False
+        finally:
+            mail.sock.settimeout(timeout)
+
+    @staticmethod
+    def _respuesta_int(mail, codigo):
+        _, data = mail.response(codigo)
+        if data and data[-1] is not None:
+            return int(data[-1])
+        return None
+
+    @staticmethod
+    def _cerrar_socket(mail):
+        try:
+            mail.shutdown()
+        except Exception:
+            pass
+
+
+class ImapSessionManager:
+    """Registro de sesiones IMAP persistentes, una por correo monitoreado."""
+
+    def __init__(self, server, timeout=60, backoff_base=5, backoff_max=300, port=993, ssl=True):
+        self.server = server
+        self.port = port
+        self.ssl = ssl
+        self.timeout = timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._sesiones = {}
+        self._lock = threading.Lock()
+
+    def obtener(self, account):
+        """Devuelve la sesión de la cuenta; la recrea si cambió la contraseña."""
+        email_addr = account['email']
+        with self._lock:
+            sesion = self._sesiones.get(email_addr)
+            if sesion is not None and sesion.password != account['password']:
+                sesion.cerrar()
+                sesion = None
+            if sesion is None:
+                sesion = ImapSession(
+                    email_addr, account['password'], self.server,
+                    timeout=self.timeout, backoff_base=self.backoff_base, backoff_max=self.backoff_max,
+                    port=self.port, ssl=self.ssl
+                )
+                self._sesiones[email_addr] = sesion
+            return sesion
+
+    def sincronizar(self, cuentas):
+        """Cierra las sesiones de cuentas que ya no se monitorean."""
+        activos = {c['email'] for c in cuentas}
+        with self._lock:
+            retirados = [e for e in self._sesiones if e not in activos]
+            for email_addr in retirados:
+                self._sesiones.pop(email_addr).cerrar()
+        return retirados
+
+    def cerrar_todas(self):
+        with self._lock:
+            for sesion in self._sesiones.values():
+                sesion.cerrar()
+            self._sesiones.clear()
@@ -0,0 +1,123 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from logger_helper import AppLogger
+
+log = AppLogger("IndiceMensajes")
+
+
+def clave_mensaje(message_id, uid_validity=None, uid=None):
+    """
+    Clave compacta (16 bytes) de un correo: el Message-ID normalizado o, si el
+    correo no trae, UIDVALIDITY + UID (único dentro del buzón).
+    Es la misma que se guarda en dbo.ProcessedMessages.
+    """
+    message_id = (message_id or "").strip().strip("<>").lower()
+    texto = f"mid:{message_id}" if message_id else f"uid:{uid_validity}:{uid}"
+    return hashlib.sha256(texto.encode("utf-8")).digest()[:16]
+
+
+class IndiceMensajes:
+    """
+    Correos ya registrados, por AppUser. Es la verificación rápida antes de
+    descargar cuerpos: lo que está aquí no se vuelve a bajar ni a enviar a la BD.
+    - En memoria: las claves de cada usuario con su fecha (se carga de SQLite al arrancar).
+    - En disco: SQLite local, para que sobreviva a reinicios y caídas.
+    Las claves con más de `retencion_dias` se purgan (en memoria y en disco)
+    como mucho una vez cada `purga_cada` segundos, así el índice no crece sin límite.
+    La garantía real es la clave única de dbo.ProcessedMessages; este índice
+    solo evita trabajo, así que perder el archivo no duplica puntos.
+    """
+
+    def __init__(self, ruta, retencion_dias=90, purga_cada=3600):
+        self.ruta = ruta
+        self.retencion = retencion_dias * 86400
+        self.purga_cada = purga_cada
+        self._memoria = {}         # user_id -> {clave: creado}
+        self._lock = threading.Lock()
+        self._conn = None
+        self._proxima_purga = time.monotonic() + purga_cada
+
+    def abrir(self):
+        """Carga el archivo local; hasta entonces el índice solo vive en memoria."""
+        if not self.ruta or self._conn is not None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.ruta) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.ruta, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS procesados ("
+                " user_id INTEGER NOT NULL, clave BLOB NOT NULL, creado REAL NOT NULL,"
+                " PRIMARY KEY (user_id, clave)) WITHOUT ROWID"
+            )
+            conn.execute("DELETE FROM procesados WHERE creado < ?", (time.time() - self.retencion,))
+            total = 0
+            with self._lock:
+                for user_id, clave, creado in conn.execute("SELECT user_id, clave, creado FROM procesados"):
+                    self._memoria.setdefault(user_id, {}).setdefault(bytes(clave), creado)
+                    total += 1
+                self._conn = conn
+            log.info("Índice de correos procesados cargado: %s claves.", total)
+        except Exception as e:
+            # Sin archivo solo se pierde el atajo; la BD sigue descartando duplicados
+            log.error("No se pudo abrir el índice local de correos (%s): %s", self.ruta, e)
+            self._conn = None
+
+    def contiene(self, user_id, clave):
+        with self._lock:
+            claves = self._memoria.get(user_id)
+            return claves is not None and clave in claves
+
+    def registrar(self, user_id, claves):
+        """Marca las claves como procesadas (memoria y disco)."""
+        claves = [c for c in claves if c is not None]
+        if not claves:
+            return
+        ahora = time.time()
+        with self._lock:
+            propias = self._memoria.setdefault(user_id, {})
+            for c in claves:
+                propias.setdefault(c, ahora)
+            if time.monotonic() >= self._proxima_purga:
+                self._purgar(ahora)
+            if self._conn is None:
+                return
+            try:
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO procesados (user_id, clave, creado) VALUES (?, ?, ?)",
+                    [(user_id, c, ahora) for c in claves]
+                )
+            except Exception as e:
+                log.error("Error guardando en el índice local de correos: %s", e)
+
+    def _purgar(self, ahora):
+        """Quita las claves vencidas. Se llama con el lock tomado."""
+        self._proxima_purga = time.monotonic() + self.purga_cada
+        limite = ahora - self.retencion
+        total = 0
+        for user_id in list(self._memoria):
+            propias = self._memoria[user_id]
+            vencidas = [c for c, creado in propias.items() if creado < limite]
+            for c in vencidas:
+                del propias[c]
+            if not propias:
+                del self._memoria[user_id]
+            total += len(vencidas)
+        if self._conn is not None:
+            try:
+                self._conn.execute("DELETE FROM procesados WHERE creado < ?", (limite,))
+            except Exception as e:
+                log.error("Error purgando el índice local de correos: %s", e)
+        if total:
+            log.info("Índice de correos procesados: %s claves vencidas purgadas.", total)
+
+    def cerrar(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
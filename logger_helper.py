@@ -1,6 +1,115 @@
+import atexit
+import json
 import logging
 import os
-from logging.handlers import RotatingFileHandler
+import queue
+import threading
+import time
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+
+# Configuración global (opcional, vía .env)
+#   LOG_LEVEL  : DEBUG / INFO / WARNING / ERROR (INFO por defecto)
+#   LOG_FORMAT : "texto" (por defecto) o "json" (una línea JSON por mensaje)
+#   LOG_ASYNC  : "1" (por defecto) escribe desde un hilo aparte; "0" escribe en el hilo que loguea
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "texto").lower()
+LOG_ASYNC = os.getenv("LOG_ASYNC", "1") == "1"
+
+# Campos estructurados que se pueden pasar como kwargs: log.info("...", cuenta=email, etapa="fetch")
+CAMPOS_EXTRA = "campos"
+
+
+class TextoFormatter(logging.Formatter):
+    """Formato de siempre; los campos `cuenta` y `etapa` van como prefijo legible."""
+
+    def __init__(self):
+        super().__init__('%(asctime)s [%(levelname)s] [%(name)s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+    def formatMessage(self, record):
+        campos = getattr(record, CAMPOS_EXTRA, None)
+        if campos and campos.get("cuenta"):
+            record.message = f"[{campos['cuenta']}] {record.message}"
+        return super().formatMessage(record)
+
+
+class JsonFormatter(logging.Formatter):
+    """Una línea JSON por mensaje con nivel, módulo y los campos estructurados."""
+
+    def format(self, record):
+        datos = {
+            "ts": time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            "nivel": record.levelname,
+            "modulo": record.name,
+            "msg": record.getMessage(),
+        }
+        campos = getattr(record, CAMPOS_EXTRA, None)
+        if campos:
+            datos.update(campos)
+        if record.exc_info:
+            datos["error"] = self.formatException(record.exc_info)
+        return json.dumps(datos, ensure_ascii=False, default=str)
+
+
+class _QueueHandlerLocal(QueueHandler):
+    """
+    La cola no sale del proceso: solo se resuelve `msg % args` (los argumentos
+    podrían cambiar después); fecha, formato y escritura quedan para el listener.
+    """
+
+    def prepare(self, record):
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+
+# Handlers compartidos por archivo: un solo RotatingFileHandler por archivo físico
+# (varios handlers rotando el mismo archivo se pisan entre sí).
+_salidas = {}
+_salidas_lock = threading.Lock()
+
+
+def _crear_handlers(log_file):
+    try:
+        os.makedirs("logs", exist_ok=True)
+        file_path = os.path.join("logs", log_file)
+    except Exception:
+        file_path = log_file
+
+    formatter = JsonFormatter() if LOG_FORMAT == "json" else TextoFormatter()
+    handlers = []
+
+    # 2. Archivo con ROTACIÓN
+    try:
+        file_handler = RotatingFileHandler(
+            file_path, maxBytes=5*1024*1024, backupCount=5, encoding='utf-8'
+        )
+        file_handler.setFormatter(formatter)
+        handlers.append(file_handler)
+    except Exception as e:
+        print(f"No se pudo crear el archivo de log: {e}")
+
+    #En consola
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(formatter)
+    handlers.append(console_handler)
+    return handlers
+
+
+def _handlers_para(log_file):
+    """Handlers que se agregan a cada logger: los reales o un QueueHandler hacia ellos."""
+    with _salidas_lock:
+        if log_file not in _salidas:
+            handlers = _crear_handlers(log_file)
+            if LOG_ASYNC:
+                cola = queue.SimpleQueue()
+                listener = QueueListener(cola, *handlers, respect_handler_level=True)
+                listener.start()
+                atexit.register(listener.stop)
+                handlers = [_QueueHandlerLocal(cola)]
+            _salidas[log_file] = handlers
+        return _salidas[log_file]
+
 
 class AppLogger:
     def __init__(self, module_name="GlobalPointsApp", log_file="watcher.log"):
@@ -9,41 +118,50 @@ class AppLogger:
         :param log_file: Nombre del archivo físico.
         """
         self.logger = logging.getLogger(module_name)
-        self.logger.setLevel(logging.INFO)
+        self.logger.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+
+        # Mensajes repetidos con límite de frecuencia: clave -> [último envío, omitidos]
+        self._limitados = {}
+        self._limitados_lock = threading.Lock()
 
         # Evitar duplicar mensajes si se instancia varias veces
         if not self.logger.handlers:
-            try:
-                os.makedirs("logs", exist_ok=True)
-                file_path = os.path.join("logs", log_file)
-            except Exception:
-                file_path = log_file 
-
-            formatter = logging.Formatter(
-                '%(asctime)s [%(levelname)s] [%(name)s] %(message)s', 
-                datefmt='%Y-%m-%d %H:%M:%S'
-            )
-
-            # 2. Archivo con ROTACIÓN
-            try:
-                file_handler = RotatingFileHandler(
-                    file_path, maxBytes=5*1024*1024, backupCount=5, encoding='utf-8'
-                )
-                file_handler.setFormatter(formatter)
-                self.logger.addHandler(file_handler)
-            except Exception as e:
-                print(f"No se pudo crear el archivo de log: {e}")
-
-            #En consola
-            console_handler = logging.StreamHandler()
-            console_handler.setFormatter(formatter)
-            self.logger.addHandler(console_handler)
-
-    def info(self, msg):
-        self.logger.info(msg)
-
-    def error(self, msg):
-        self.logger.error(msg)
-
-    def warning(self, msg):
-        self.logger.warning(msg)
\ No newline at end of file
+            for handler in _handlers_para(log_file):
+                self.logger.addHandler(handler)
+
+    # Los mensajes admiten formato perezoso estilo logging: log.debug("UID %s", uid)
+    # solo arma el texto si el nivel está habilitado.
+    def _log(self, nivel, msg, args, campos):
+        if self.logger.isEnabledFor(nivel):
+            self.logger.log(nivel, msg, *args, extra={CAMPOS_EXTRA: campos} if campos else None)
+
+    def debug(self, msg, *args, **campos):
+        self._log(logging.DEBUG, msg, args, campos)
+
+    def info(self, msg, *args, **campos):
+        self._log(logging.INFO, msg, args, campos)
+
+    def error(self, msg, *args, **campos):
+        self._log(logging.ERROR, msg, args, campos)
+
+    def warning(self, msg, *args, **campos):
+        self._log(logging.WARNING, msg, args, campos)
+
+    def limitado(self, clave, intervalo, msg, *args, nivel=logging.INFO, **campos):
+        """
+        Como `info`, pero emite la clave como mucho una vez cada `intervalo` segundos;
+        los mensajes descartados se cuentan y se informan en el siguiente.
+        """
+        if not self.logger.isEnabledFor(nivel):
+            return
+        ahora = time.monotonic()
+        with self._limitados_lock:
+            estado = self._limitados.get(clave)
+            if estado and ahora - estado[0] < intervalo:
+                estado[1] += 1
+                return
+            omitidos = estado[1] if estado else 0
+            self._limitados[clave] = [ahora, 0]
+        if omitidos:
+            msg = f"{msg} (+{omitidos} similares en {intervalo}s)"
+        self._log(nivel, msg, args, campos)
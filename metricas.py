@@ -0,0 +1,311 @@
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from logger_helper import AppLogger
+
+log = AppLogger("Metricas")
+
+# Límites de los buckets (segundos). Las etapas van de milisegundos a un minuto;
+# el extremo a extremo (correo -> Telegram) puede tardar minutos u horas.
+BUCKETS_ETAPA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BUCKETS_E2E = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 4 * 3600, 24 * 3600)
+
+
+class _Metrica:
+    """Base común: una métrica con etiquetas opcionales y un hijo por combinación."""
+    tipo = None
+
+    def __init__(self, nombre, ayuda, etiquetas=()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self._hijos = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *valores):
+        clave = tuple(str(v) for v in valores)
+        if len(clave) != len(self.etiquetas):
+            raise ValueError(f"{self.nombre} espera etiquetas {self.etiquetas}")
+        with self._lock:
+            hijo = self._hijos.get(clave)
+            if hijo is None:
+                hijo = self._hijos[clave] = self._nuevo()
+            return hijo
+
+    def _sin_etiquetas(self):
+        return self.labels()
+
+    def hijos(self):
+        with self._lock:
+            return list(self._hijos.items())
+
+
+class _ValorContador:
+    def __init__(self):
+        self.valor = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self._lock:
+            self.valor += n
+
+
+class Contador(_Metrica):
+    tipo = "counter"
+
+    def _nuevo(self):
+        return _ValorContador()
+
+    def inc(self, n=1):
+        self._sin_etiquetas().inc(n)
+
+
+class _ValorMedidor:
+    def __init__(self):
+        self.valor = 0.0
+
+    def set(self, valor):
+        self.valor = float(valor)
+
+
+class Medidor(_Metrica):
+    tipo = "gauge"
+
+    def _nuevo(self):
+        return _ValorMedidor()
+
+    def set(self, valor):
+        self._sin_etiquetas().set(valor)
+
+
+class _ValorHistograma:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.conteos = [0] * (len(buckets) + 1)   # el último es +Inf
+        self.suma = 0.0
+        self.total = 0
+        self._lock = threading.Lock()
+
+    def observar(self, valor):
+        i = bisect.bisect_left(self.buckets, valor)
+        with self._lock:
+            self.conteos[i] += 1
+            self.suma += valor
+            self.total += 1
+
+    @contextmanager
+    def medir(self):
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observar(time.perf_counter() - inicio)
+
+    def percentil(self, p):
+        """Aproximación por bucket (límite superior del bucket que contiene el percentil)."""
+        with self._lock:
+            if not self.total:
+                return None
+            objetivo = p * self.total
+            acumulado = 0
+            for limite, n in zip(self.buckets + (float("inf"),), self.conteos):
+                acumulado += n
+                if acumulado >= objetivo:
+                    return limite
+        return None
+
+
+class Histograma(_Metrica):
+    tipo = "histogram"
+
+    def __init__(self, nombre, ayuda, etiquetas=(), buckets=BUCKETS_ETAPA):
+        super().__init__(nombre, ayuda, etiquetas)
+        self.buckets = tuple(buckets)
+
+    def _nuevo(self):
+        return _ValorHistograma(self.buckets)
+
+    def observar(self, valor):
+        self._sin_etiquetas().observar(valor)
+
+    def medir(self):
+        return self._sin_etiquetas().medir()
+
+
+def _etiquetas_texto(nombres, valores, extra=None):
+    pares = list(zip(nombres, valores))
+    if extra:
+        pares.append(extra)
+    if not pares:
+        return ""
+    escapar = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{n}="{escapar(v)}"' for n, v in pares) + "}"
+
+
+def _numero(valor):
+    if valor == float("inf"):
+        return "+Inf"
+    return repr(float(valor)) if isinstance(valor, float) and not valor.is_integer() else str(int(valor))
+
+
+class RegistroMetricas:
+    """
+    Métricas del proceso. Se exponen en formato de texto de Prometheus
+    (`servir`) y se vuelcan periódicamente a un archivo JSON (`iniciar_snapshot`).
+    """
+
+    def __init__(self):
+        self._metricas = {}
+        self._lock = threading.Lock()
+        self._servidor = None
+        self._inicio = time.time()
+
+    def _registrar(self, clase, nombre, *args, **kwargs):
+        with self._lock:
+            metrica = self._metricas.get(nombre)
+            if metrica is None:
+                metrica = self._metricas[nombre] = clase(nombre, *args, **kwargs)
+            return metrica
+
+    def contador(self, nombre, ayuda, etiquetas=()):
+        return self._registrar(Contador, nombre, ayuda, etiquetas)
+
+    def medidor(self, nombre, ayuda, etiquetas=()):
+        return self._registrar(Medidor, nombre, ayuda, etiquetas)
+
+    def histograma(self, nombre, ayuda, etiquetas=(), buckets=BUCKETS_ETAPA):
+        return self._registrar(Histograma, nombre, ayuda, etiquetas, buckets=buckets)
+
+    # --- Exportación ---
+    def texto(self):
+        """Formato de exposición de Prometheus (text/plain; version=0.0.4)."""
+        lineas = []
+        with self._lock:
+            metricas = list(self._metricas.values())
+        for m in metricas:
+            lineas.append(f"# HELP {m.nombre} {m.ayuda}")
+            lineas.append(f"# TYPE {m.nombre} {m.tipo}")
+            for valores, hijo in m.hijos():
+                if m.tipo == "histogram":
+                    acumulado = 0
+                    for limite, n in zip(hijo.buckets + (float("inf"),), list(hijo.conteos)):
+                        acumulado += n
+                        etq = _etiquetas_texto(m.etiquetas, valores, ("le", _numero(limite)))
+                        lineas.append(f"{m.nombre}_bucket{etq} {acumulado}")
+                    etq = _etiquetas_texto(m.etiquetas, valores)
+                    lineas.append(f"{m.nombre}_sum{etq} {hijo.suma}")
+                    lineas.append(f"{m.nombre}_count{etq} {hijo.total}")
+                else:
+                    lineas.append(f"{m.nombre}{_etiquetas_texto(m.etiquetas, valores)} {hijo.valor}")
+        return "\n".join(lineas) + "\n"
+
+    def snapshot(self):
+        """Resumen JSON: valores de contadores/medidores y conteo, media y p50/p95/p99 de histogramas."""
+        datos = {"ts": time.strftime("%Y-%m-%dT%H:%M:%S"), "uptime_s": round(time.time() - self._inicio, 1), "metricas": {}}
+        with self._lock:
+            metricas = list(self._metricas.values())
+        for m in metricas:
+            serie = {}
+            for valores, hijo in m.hijos():
+                clave = ",".join(f"{n}={v}" for n, v in zip(m.etiquetas, valores)) or "_"
+                if m.tipo == "histogram":
+                    serie[clave] = {
+                        "count": hijo.total,
+                        "avg": round(hijo.suma / hijo.total, 4) if hijo.total else None,
+                        "p50": hijo.percentil(0.50),
+                        "p95": hijo.percentil(0.95),
+                        "p99": hijo.percentil(0.99),
+                    }
+                else:
+                    serie[clave] = hijo.valor
+            datos["metricas"][m.nombre] = serie
+        return datos
+
+    def servir(self, puerto, host="127.0.0.1"):
+        """Expone GET /metrics en un hilo aparte. Puerto 0 o en uso: solo se registra en el log."""
+        if not puerto or self._servidor:
+            return
+        registro = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/metrics", "/"):
+                    self.send_error(404)
+                    return
+                cuerpo = registro.texto().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(cuerpo)))
+                self.end_headers()
+                self.wfile.write(cuerpo)
+
+            def log_message(self, *args):
+                pass
+
+        try:
+            self._servidor = ThreadingHTTPServer((host, int(puerto)), _Handler)
+        except OSError as e:
+            log.error("No se pudo abrir el endpoint de métricas en %s:%s: %s", host, puerto, e)
+            return
+        threading.Thread(target=self._servidor.serve_forever, name="metricas-http", daemon=True).start()
+        log.info("Métricas disponibles en http://%s:%s/metrics", host, puerto)
+
+    def iniciar_snapshot(self, ruta, intervalo=60):
+        """Escribe `snapshot()` en `ruta` cada `intervalo` segundos (reemplazo atómico)."""
+        if not ruta or intervalo <= 0:
+            return
+
+        def _volcar():
+            while True:
+                time.sleep(intervalo)
+                self.guardar_snapshot(ruta)
+
+        threading.Thread(target=_volcar, name="metricas-snapshot", daemon=True).start()
+
+    def guardar_snapshot(self, ruta):
+        try:
+            os.makedirs(os.path.dirname(ruta) or ".", exist_ok=True)
+            temporal = ruta + ".tmp"
+            with open(temporal, "w", encoding="utf-8") as f:
+                json.dump(self.snapshot(), f, ensure_ascii=False, indent=2)
+            os.replace(temporal, ruta)
+        except Exception as e:
+            log.error("No se pudo guardar el snapshot de métricas: %s", e)
+
+
+# Registro del proceso (watcher o bot)
+registro = RegistroMetricas()
+
+# --- Métricas del lector de correo ---
+ETAPAS = registro.histograma(
+    "watcher_etapa_segundos", "Duración de cada etapa del procesamiento de un buzón.", ("etapa",))
+CORREOS = registro.contador(
+    "watcher_correos_total", "Correos por resultado: vistos, filtrados, duplicados, parseados, fallidos, notificados.", ("resultado",))
+CICLO = registro.medidor(
+    "watcher_ciclo_segundos", "Duración del último ciclo de revisión.")
+E2E = registro.histograma(
+    "watcher_correo_a_telegram_segundos", "Desde el encabezado Date del correo hasta el envío a Telegram.",
+    buckets=BUCKETS_E2E)
+COMERCIOS = registro.contador(
+    "watcher_comercios_total", "Comercios de compras por resolución: regla, exacto, similar, cadena, nuevo.", ("resolucion",))
+SPOOL = registro.medidor(
+    "watcher_spool_compras_pendientes", "Compras guardadas en el spool local que la BD aún no confirma.")
+TELEGRAM = registro.contador(
+    "telegram_envios_total", "Respuestas de la Bot API por resultado.", ("resultado",))
+
+# --- Métricas del bot ---
+BOT_HANDLERS = registro.histograma(
+    "bot_handler_segundos", "Duración de cada handler del bot.", ("handler",))
+BOT_BD = registro.histograma(
+    "bot_bd_segundos", "Duración de las llamadas a BD del bot (incluye la espera en el pool).", ("metodo",))
+
+
+def iniciar(puerto, snapshot_path, intervalo=60):
+    """Arranca el endpoint HTTP y el volcado periódico del proceso actual."""
+    registro.servir(puerto)
+    registro.iniciar_snapshot(snapshot_path, intervalo)
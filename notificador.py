@@ -0,0 +1,274 @@
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metricas
+from logger_helper import AppLogger
+
+log = AppLogger("Notificador")
+
+
+class TelegramNotifier:
+    """
+    Cola de salida hacia la Bot API de Telegram.
+    `enviar()` solo encola; un hilo planificador respeta los límites de
+    Telegram (por chat y global), reintenta honrando `retry_after` y guarda
+    en un archivo JSONL los mensajes que no se pudieron entregar por la red,
+    un 5xx o un 429 (se reenvían al arrancar). Los rechazados con otro 4xx
+    (Markdown inválido, chat bloqueado o inexistente) no se reenvían nunca:
+    van a `<spool>.descartados` para revisarlos a mano.
+    Los mensajes de un mismo chat salen siempre en orden.
+    """
+
+    def __init__(self, token, api_url="https://api.telegram.org", spool_path="data/telegram_pendientes.jsonl",
+                 per_chat_interval=1.0, global_rate=30, max_intentos=5, hilos=4, timeout=10):
+        self.token = token
+        self.api_url = api_url.rstrip("/")
+        self.spool_path = spool_path
+        self.per_chat_interval = per_chat_interval
+        self.global_rate = global_rate
+        self.max_intentos = max_intentos
+        self.timeout = timeout
+
+        # Sesión HTTP compartida: reutiliza conexiones TLS (keep-alive)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=hilos)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._executor = ThreadPoolExecutor(max_workers=hilos, thread_name_prefix="telegram")
+
+        self._cond = threading.Condition()
+        self._pendientes = {}      # chat_id -> deque de mensajes
+        self._listos = []          # heap (listo_en, seq, chat_id)
+        self._en_vuelo = set()     # chats con un envío en curso
+        self._seq = itertools.count()
+        self._envios_recientes = deque()  # instantes de los últimos envíos (límite global)
+        self._spool_lock = threading.Lock()
+        self._activo = False
+        self._hilo = None
+
+        self.enviados = 0
+        self.fallidos = 0
+
+    # --- API pública ---
+    def iniciar(self):
+        """Reencola lo que quedó pendiente en disco y arranca el planificador."""
+        if self._activo:
+            return
+        self._activo = True
+        self._reencolar_spool()
+        self._hilo = threading.Thread(target=self._planificar, name="telegram-planificador", daemon=True)
+        self._hilo.start()
+
+    def enviar(self, chat_id, texto, botones=None, origen=None):
+        """
+        Encola un mensaje; nunca bloquea por la red.
+        :param origen: epoch del evento que lo generó (p.ej. el Date del correo)
+                       para medir la latencia extremo a extremo.
+        """
+        if not chat_id or not self.token:
+            return
+        payload = {"chat_id": chat_id, "text": texto, "parse_mode": "Markdown"}
+        if botones:
+            payload["reply_markup"] = botones
+        self._encolar({"payload": payload, "intentos": 0, "origen": origen})
+
+    def pendientes(self):
+        with self._cond:
+            return sum(len(q) for q in self._pendientes.values())
+
+    def detener(self, timeout=10):
+        """
+        Espera a vaciar la cola hasta `timeout`; lo que quede se guarda en disco.
+        Los chats con un envío en curso los guarda su propio hilo al terminar
+        (el mensaje en vuelo solo si no se entregó, y en orden), así nada sale dos veces.
+        """
+        limite = time.monotonic() + timeout
+        with self._cond:
+            while (self._pendientes or self._en_vuelo) and time.monotonic() < limite:
+                self._cond.wait(0.1)
+            self._activo = False
+            restantes = []
+            for chat_id in [c for c in self._pendientes if c not in self._en_vuelo]:
+                restantes.extend(self._pendientes.pop(chat_id))
+            self._listos.clear()
+            self._cond.notify_all()
+        for mensaje in restantes:
+            self._guardar_spool(mensaje)
+        self._executor.shutdown(wait=False)
+
+    # --- Planificación ---
+    def _encolar(self, mensaje, listo_en=None):
+        chat_id = mensaje["payload"]["chat_id"]
+        with self._cond:
+            cola = self._pendientes.get(chat_id)
+            if cola is None:
+                cola = self._pendientes[chat_id] = deque()
+                if chat_id not in self._en_vuelo:
+                    heapq.heappush(self._listos, (listo_en or time.monotonic(), next(self._seq), chat_id))
+            cola.append(mensaje)
+            self._cond.notify()
+
+    def _planificar(self):
+        while True:
+            with self._cond:
+                if not self._activo:
+                    return
+                ahora = time.monotonic()
+                if not self._listos:
+                    self._cond.wait(1.0)
+                    continue
+                listo_en, _, chat_id = self._listos[0]
+                if listo_en > ahora:
+                    self._cond.wait(listo_en - ahora)
+                    continue
+
+                # Límite global: como máximo `global_rate` envíos por segundo
+                while self._envios_recientes and ahora - self._envios_recientes[0] >= 1.0:
+                    self._envios_recientes.popleft()
+                if len(self._envios_recientes) >= self.global_rate:
+                    self._cond.wait(1.0 - (ahora - self._envios_recientes[0]))
+                    continue
+
+                heapq.heappop(self._listos)
+                mensaje = self._pendientes[chat_id][0]
+                self._en_vuelo.add(chat_id)
+                self._envios_recientes.append(ahora)
+
+            try:
+                self._executor.submit(self._enviar, chat_id, mensaje)
+            except RuntimeError:
+                # detener() cerró el pool entre la elección del chat y el envío
+                with self._cond:
+                    self._en_vuelo.discard(chat_id)
+                    restantes = list(self._pendientes.pop(chat_id, ()))
+                for pendiente in restantes:
+                    self._guardar_spool(pendiente)
+                return
+
+    def _enviar(self, chat_id, mensaje):
+        espera = self.per_chat_interval
+        entregado = False
+        try:
+            with metricas.ETAPAS.labels("telegram").medir():
+                resp = self.session.post(
+                    f"{self.api_url}/bot{self.token}/sendMessage",
+                    json=mensaje["payload"], timeout=self.timeout
+                )
+            metricas.TELEGRAM.labels(resp.status_code).inc()
+            if resp.status_code == 429:
+                espera = max(espera, self._retry_after(resp))
+                log.warning("Telegram limitó el chat %s; reintento en %ss.", chat_id, espera)
+            elif resp.status_code >= 500:
+                mensaje["intentos"] += 1
+                espera = max(espera, min(60, 2 ** mensaje["intentos"]))
+                log.warning("Telegram respondió %s (intento %s).", resp.status_code, mensaje['intentos'])
+            elif not resp.ok:
+                # 4xx distinto de 429: el mensaje no se va a aceptar nunca
+                log.error("Error Telegram %s: %s", resp.status_code, resp.text[:200])
+                mensaje["intentos"] = self.max_intentos
+                mensaje["rechazado"] = f"{resp.status_code} {resp.text[:200]}"
+            else:
+                entregado = True
+                metricas.CORREOS.labels("notificados").inc()
+                if mensaje.get("origen"):
+                    metricas.E2E.observar(max(0.0, time.time() - mensaje["origen"]))
+        except Exception as e:
+            metricas.TELEGRAM.labels("error").inc()
+            mensaje["intentos"] += 1
+            espera = max(espera, min(60, 2 ** mensaje["intentos"]))
+            log.error("Error Telegram: %s", e)
+
+        descartado = not entregado and mensaje["intentos"] >= self.max_intentos
+        al_spool = []
+        with self._cond:
+            self._en_vuelo.discard(chat_id)
+            cola = self._pendientes.get(chat_id)
+            if cola and (entregado or descartado):
+                cola.popleft()
+            if entregado:
+                self.enviados += 1
+            elif descartado:
+                self.fallidos += 1
+                if not mensaje.get("rechazado"):
+                    al_spool.append(mensaje)
+            if cola and not self._activo:
+                # Notificador detenido durante el envío: detener() dejó este chat para aquí
+                al_spool.extend(self._pendientes.pop(chat_id))
+            elif cola:
+                heapq.heappush(self._listos, (time.monotonic() + espera, next(self._seq), chat_id))
+            elif cola is not None:
+                del self._pendientes[chat_id]
+            self._cond.notify_all()
+
+        if descartado and mensaje.get("rechazado"):
+            self._guardar_descartado(mensaje)
+        for pendiente in al_spool:
+            self._guardar_spool(pendiente)
+
+    @staticmethod
+    def _retry_after(resp):
+        try:
+            return float(resp.json().get("parameters", {}).get("retry_after", 1))
+        except Exception:
+            return float(resp.headers.get("Retry-After", 1))
+
+    # --- Spool en disco ---
+    def _guardar_spool(self, mensaje):
+        try:
+            with self._spool_lock:
+                os.makedirs(os.path.dirname(self.spool_path) or ".", exist_ok=True)
+                with open(self.spool_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(mensaje["payload"], ensure_ascii=False) + "\n")
+            log.warning("Mensaje para %s guardado en %s.", mensaje['payload']['chat_id'], self.spool_path)
+        except Exception as e:
+            log.error("No se pudo guardar el mensaje pendiente: %s", e)
+
+    def _guardar_descartado(self, mensaje):
+        """Mensajes que Telegram rechazó para siempre: se conservan, pero no se reenvían."""
+        ruta = self.spool_path + ".descartados"
+        try:
+            with self._spool_lock:
+                os.makedirs(os.path.dirname(ruta) or ".", exist_ok=True)
+                with open(ruta, "a", encoding="utf-8") as f:
+                    f.write(json.dumps({"payload": mensaje["payload"], "error": mensaje["rechazado"],
+                                        "fecha": time.time()}, ensure_ascii=False) + "\n")
+            log.warning("Mensaje para %s rechazado por Telegram, apartado en %s.", mensaje['payload']['chat_id'], ruta)
+        except Exception as e:
+            log.error("No se pudo apartar el mensaje rechazado: %s", e)
+
+    def _reencolar_spool(self):
+        """
+        Mueve el spool a un archivo temporal y reencola su contenido. Si quedó
+        un temporal de una caída anterior (a medio reencolar), se lee también.
+        """
+        procesando = self.spool_path + ".procesando"
+        with self._spool_lock:
+            if os.path.exists(self.spool_path):
+                if os.path.exists(procesando):
+                    with open(self.spool_path, encoding="utf-8") as origen, \
+                            open(procesando, "a", encoding="utf-8") as destino:
+                        destino.write(origen.read())
+                    os.remove(self.spool_path)
+                else:
+                    os.replace(self.spool_path, procesando)
+            elif not os.path.exists(procesando):
+                return
+
+        total = 0
+        with open(procesando, encoding="utf-8") as f:
+            for linea in f:
+                if linea.strip():
+                    self._encolar({"payload": json.loads(linea), "intentos": 0})
+                    total += 1
+        os.remove(procesando)
+        if total:
+            log.info("Reencolados %s mensajes pendientes de Telegram.", total)
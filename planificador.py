@@ -0,0 +1,173 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+
+from logger_helper import AppLogger
+
+log = AppLogger("Planificador")
+
+# Resultados de procesar una cuenta
+CON_CORREO = "correo"      # llegaron correos de bancos
+SIN_CORREO = "vacio"       # revisión normal sin novedades
+ERROR_AUTH = "auth"        # login rechazado (contraseña de aplicación revocada o cambiada)
+ERROR = "error"            # fallo de red/servidor; manda el backoff de la sesión
+EN_ESPERA = "espera"       # la sesión aún está en backoff, no se intentó
+
+
+class _EstadoCuenta:
+    __slots__ = ("password", "intervalo", "ultima_actividad", "fallos_auth", "avisado", "turno")
+
+    def __init__(self, password, intervalo):
+        self.password = password
+        self.intervalo = intervalo
+        self.ultima_actividad = None
+        self.fallos_auth = 0
+        self.avisado = False
+        self.turno = None      # seq de la entrada vigente en el heap (None = en proceso)
+
+
+class PlanificadorCuentas:
+    """
+    Cola de prioridad por próxima revisión de cada cuenta.
+    - Las cuentas con correos de bancos recientes se revisan cada `intervalo_min`.
+    - Las cuentas sin actividad van espaciando sus revisiones hasta `intervalo_max`.
+    - Los fallos de login repetidos esperan cada vez más (hasta `auth_backoff_max`)
+      y al llegar a `avisar_tras` fallos se avisa al usuario una sola vez.
+    - Todas las esperas llevan jitter para que los logins no coincidan.
+    """
+
+    def __init__(self, intervalo_base=45, intervalo_min=15, intervalo_max=300, ventana_actividad=3600,
+                 auth_backoff_base=60, auth_backoff_max=6 * 3600, avisar_tras=3, jitter=0.1, avisar=None):
+        self.intervalo_base = intervalo_base
+        self.intervalo_min = intervalo_min
+        self.intervalo_max = intervalo_max
+        self.ventana_actividad = ventana_actividad
+        self.auth_backoff_base = auth_backoff_base
+        self.auth_backoff_max = auth_backoff_max
+        self.avisar_tras = avisar_tras
+        self.jitter = jitter
+        self.avisar = avisar          # callable(account) para el aviso por Telegram
+
+        self._estados = {}            # email -> _EstadoCuenta
+        self._cuentas = {}            # email -> account
+        self._heap = []               # (vence_en, seq, email)
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    # --- Altas, bajas y cambios de contraseña ---
+    def sincronizar(self, cuentas, agendar=True):
+        """
+        :param agendar: False en modo IDLE; ahí cada hilo espera por su cuenta y
+                        el planificador solo lleva el estado (actividad, fallos de login).
+        """
+        ahora = time.monotonic()
+        with self._lock:
+            activos = {c['email']: c for c in cuentas}
+            for email_addr in [e for e in self._estados if e not in activos]:
+                # Las entradas del heap quedan huérfanas y se descartan al salir
+                del self._estados[email_addr]
+                del self._cuentas[email_addr]
+
+            for email_addr, account in activos.items():
+                self._cuentas[email_addr] = account
+                estado = self._estados.get(email_addr)
+                if estado is None:
+                    estado = self._estados[email_addr] = _EstadoCuenta(account['password'], self.intervalo_base)
+                    if agendar:
+                        # Primera revisión repartida dentro del intervalo base
+                        self._programar(email_addr, estado, ahora + random.uniform(0, self.intervalo_base))
+                elif estado.password != account['password']:
+                    # Contraseña nueva: se olvida el backoff y se revisa ya
+                    estado.password = account['password']
+                    estado.fallos_auth = 0
+                    estado.avisado = False
+                    estado.intervalo = self.intervalo_base
+                    if estado.turno is not None:
+                        self._programar(email_addr, estado, ahora)
+
+    # --- Turnos ---
+    def vencidas(self):
+        """Saca de la cola las cuentas cuya revisión ya venció."""
+        ahora = time.monotonic()
+        listas = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= ahora:
+                _, seq, email_addr = heapq.heappop(self._heap)
+                estado = self._estados.get(email_addr)
+                if estado is None or estado.turno != seq:
+                    continue
+                estado.turno = None
+                listas.append(self._cuentas[email_addr])
+        return listas
+
+    def segundos_para_proxima(self):
+        with self._lock:
+            while self._heap:
+                vence_en, seq, email_addr = self._heap[0]
+                estado = self._estados.get(email_addr)
+                if estado is not None and estado.turno == seq:
+                    return max(0.0, vence_en - time.monotonic())
+                heapq.heappop(self._heap)
+            return None
+
+    def reprogramar(self, account, resultado, espera_sesion=0.0):
+        """
+        Registra el resultado de una revisión y agenda la siguiente (modo sondeo).
+        :param espera_sesion: backoff pendiente de la sesión IMAP (errores de red).
+        :return: segundos hasta la próxima revisión, o None si la cuenta ya no se monitorea.
+        """
+        return self._registrar(account, resultado, espera_sesion, programar=True)
+
+    def espera_tras(self, account, resultado, espera_sesion=0.0):
+        """Como `reprogramar` pero sin agendar: el hilo IDLE de la cuenta espera por su cuenta."""
+        return self._registrar(account, resultado, espera_sesion, programar=False)
+
+    def _registrar(self, account, resultado, espera_sesion, programar):
+        email_addr = account['email']
+        avisar = False
+        with self._lock:
+            estado = self._estados.get(email_addr)
+            if estado is None:
+                return None
+            ahora = time.monotonic()
+
+            if resultado == ERROR_AUTH:
+                estado.fallos_auth += 1
+                espera = min(self.auth_backoff_max, self.auth_backoff_base * 2 ** (estado.fallos_auth - 1))
+                if estado.fallos_auth >= self.avisar_tras and not estado.avisado:
+                    estado.avisado = avisar = True
+            elif resultado in (ERROR, EN_ESPERA):
+                espera = max(espera_sesion, self.intervalo_min)
+            else:
+                estado.fallos_auth = 0
+                estado.avisado = False
+                if resultado == CON_CORREO:
+                    estado.ultima_actividad = ahora
+                if estado.ultima_actividad is not None and ahora - estado.ultima_actividad < self.ventana_actividad:
+                    estado.intervalo = self.intervalo_min
+                else:
+                    # Sin actividad reciente: cada revisión vacía espacia la siguiente
+                    estado.intervalo = min(self.intervalo_max, max(self.intervalo_base, estado.intervalo * 1.5))
+                espera = estado.intervalo
+
+            espera *= random.uniform(1 - self.jitter, 1 + self.jitter)
+            if programar:
+                self._programar(email_addr, estado, ahora + espera)
+            fallos = estado.fallos_auth
+
+        if resultado == ERROR_AUTH:
+            log.warning("Login rechazado %s veces seguidas. Próximo intento en %.0fs.", fallos, espera,
+                        cuenta=email_addr, etapa="login")
+        if avisar and self.avisar:
+            self.avisar(account)
+        return espera
+
+    def _programar(self, email_addr, estado, vence_en):
+        estado.turno = next(self._seq)
+        heapq.heappush(self._heap, (vence_en, estado.turno, email_addr))
+
+    def pendientes(self):
+        with self._lock:
+            return sum(1 for e in self._estados.values() if e.turno is not None)
@@ -0,0 +1,93 @@
+import threading
+import time
+
+from logger_helper import AppLogger
+
+log = AppLogger("Shards")
+
+
+def shard_de(user_id, total_shards):
+    """Shard al que pertenece un AppUser (partición por hash del UserId)."""
+    return int(user_id) % total_shards
+
+
+class ArriendoShards:
+    """
+    Shards de AppUsers que atiende este trabajador, según los arriendos (leases)
+    de dbo.WatcherShardLease.
+    - Un hilo renueva los arriendos cada `latido` segundos; en cada renovación el
+      SP rebalancea (cede sobrantes, toma libres o vencidos de trabajadores caídos).
+    - Si la BD no responde, los shards se conservan solo hasta que venza el último
+      arriendo confirmado: después el trabajador deja de atender cuentas, porque
+      otro ya puede haberlas tomado.
+    """
+
+    def __init__(self, db, worker_id, total_shards=64, duracion=60, latido=20, gracia=90):
+        self.db = db
+        self.worker_id = worker_id
+        self.total_shards = total_shards
+        self.duracion = duracion
+        self.latido = latido
+        self.gracia = gracia
+
+        self._shards = frozenset()
+        self._vence = 0.0           # monotonic: fin del último arriendo confirmado
+        self._lock = threading.Lock()
+        self._detener = threading.Event()
+        self._hilo = None
+
+    def renovar(self):
+        """Un latido. :return: True si la BD confirmó los arriendos."""
+        # El arriendo corre desde antes de la llamada: así el reloj local nunca se pasa del de la BD
+        inicio = time.monotonic()
+        shards = self.db.claim_watcher_shards(self.worker_id, self.total_shards, self.duracion, self.gracia)
+        if shards is None:
+            if self._shards and time.monotonic() >= self._vence:
+                log.warning("Arriendos vencidos sin poder renovarlos; se dejan de atender %d shards.",
+                            len(self._shards), etapa="shards")
+                with self._lock:
+                    self._shards = frozenset()
+            return False
+
+        nuevos = frozenset(shards)
+        with self._lock:
+            anteriores, self._shards = self._shards, nuevos
+            self._vence = inicio + self.duracion
+        if nuevos != anteriores:
+            log.info("Shards asignados: %d de %d (+%d, -%d).", len(nuevos), self.total_shards,
+                     len(nuevos - anteriores), len(anteriores - nuevos), etapa="shards")
+        return True
+
+    def iniciar(self):
+        """Primer latido en línea (para arrancar ya con shards) y el resto en un hilo."""
+        self.renovar()
+
+        def _latir():
+            while not self._detener.wait(self.latido):
+                try:
+                    self.renovar()
+                except Exception as e:
+                    log.error("Error en el latido de shards: %s", e, etapa="shards")
+
+        self._hilo = threading.Thread(target=_latir, name="shards-latido", daemon=True)
+        self._hilo.start()
+
+    def detener(self):
+        """Detiene el latido y libera los shards para que otro trabajador los tome ya."""
+        self._detener.set()
+        with self._lock:
+            self._shards = frozenset()
+        self.db.release_watcher_shards(self.worker_id)
+
+    def vigentes(self):
+        with self._lock:
+            if time.monotonic() >= self._vence:
+                return frozenset()
+            return self._shards
+
+    def propias(self, cuentas):
+        """Filtra las cuentas que pertenecen a los shards vigentes de este trabajador."""
+        shards = self.vigentes()
+        if not shards:
+            return []
+        return [c for c in cuentas if shard_de(c['user_id'], self.total_shards) in shards]
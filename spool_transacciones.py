@@ -0,0 +1,223 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import metricas
+from logger_helper import AppLogger
+
+log = AppLogger("SpoolTransacciones")
+
+
+def _a_json(registro):
+    compra = dict(registro['compra'])
+    if compra.get('message_key') is not None:
+        compra['message_key'] = compra['message_key'].hex()
+    return json.dumps(dict(registro, compra=compra), ensure_ascii=False, default=str)
+
+
+def _de_json(texto):
+    registro = json.loads(texto)
+    compra = registro['compra']
+    if compra.get('message_key') is not None:
+        compra['message_key'] = bytes.fromhex(compra['message_key'])
+    return registro
+
+
+class SpoolTransacciones:
+    """
+    Registro local (SQLite, solo se agrega y se borra) de las compras ya
+    extraídas de los correos. Cada compra se escribe aquí ANTES de enviarla a
+    SQL Server y se borra cuando la BD la confirma; si la BD no está, queda
+    guardada y el drenador la reenvía en lotes cuando vuelve.
+    Registro: {"compra": kwargs de process_transaction, "chat_id", "email", "recibido_en"}.
+    """
+
+    def __init__(self, ruta, lote=100, intervalo=5, antiguedad_min=60, max_intentos=5):
+        """
+        :param antiguedad_min: el drenador solo toma compras con al menos esta edad
+                               (las recientes aún las está registrando el ciclo normal).
+        :param max_intentos: errores de datos (con la BD disponible) antes de apartar la compra.
+        """
+        self.ruta = ruta
+        self.lote = lote
+        self.intervalo = intervalo
+        self.antiguedad_min = antiguedad_min
+        self.max_intentos = max_intentos
+
+        self._conn = None
+        self._lock = threading.Lock()
+        self._detener = threading.Event()
+        self._hilo = None
+
+    def abrir(self):
+        if not self.ruta or self._conn is not None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.ruta) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.ruta, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # FULL: una compra confirmada por el spool sobrevive a un corte de luz
+            conn.execute("PRAGMA synchronous=FULL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS pendientes ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT, registro TEXT NOT NULL,"
+                " intentos INTEGER NOT NULL DEFAULT 0, creado REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS descartados ("
+                " id INTEGER PRIMARY KEY, registro TEXT NOT NULL, error TEXT, creado REAL NOT NULL)"
+            )
+            with self._lock:
+                self._conn = conn
+            total = self.pendientes()
+            if total:
+                log.warning("%s compras pendientes en el spool de una ejecución anterior.", total)
+        except Exception as e:
+            log.error("No se pudo abrir el spool de transacciones (%s): %s", self.ruta, e)
+
+    def agregar(self, registros):
+        """
+        Guarda las compras antes de enviarlas a la BD.
+        :return: ids en el mismo orden, o None si el spool no está disponible.
+        """
+        with self._lock:
+            if self._conn is None:
+                return None
+            try:
+                ahora = time.time()
+                ids = []
+                self._conn.execute("BEGIN")
+                for registro in registros:
+                    cur = self._conn.execute(
+                        "INSERT INTO pendientes (registro, creado) VALUES (?, ?)", (_a_json(registro), ahora)
+                    )
+                    ids.append(cur.lastrowid)
+                self._conn.execute("COMMIT")
+            except Exception as e:
+                self._rollback()
+                log.error("Error escribiendo en el spool de transacciones: %s", e)
+                return None
+        metricas.SPOOL.set(self.pendientes())
+        return ids
+
+    def confirmar(self, ids):
+        """Borra las compras que la BD ya registró."""
+        ids = [i for i in ids if i is not None]
+        if not ids:
+            return
+        with self._lock:
+            if self._conn is None:
+                return
+            try:
+                self._conn.executemany("DELETE FROM pendientes WHERE id = ?", [(i,) for i in ids])
+            except Exception as e:
+                log.error("Error confirmando compras del spool: %s", e)
+        metricas.SPOOL.set(self.pendientes())
+
+    def pendientes(self):
+        with self._lock:
+            if self._conn is None:
+                return 0
+            return self._conn.execute("SELECT COUNT(*) FROM pendientes").fetchone()[0]
+
+    def _tomar(self):
+        with self._lock:
+            filas = self._conn.execute(
+                "SELECT id, registro, intentos FROM pendientes WHERE creado <= ? ORDER BY id LIMIT ?",
+                (time.time() - self.antiguedad_min, self.lote)
+            ).fetchall()
+        return [(i, _de_json(r), n) for i, r, n in filas]
+
+    def _fallo(self, id_, registro, intentos, error):
+        """Cuenta un error de datos; al agotar los intentos la compra se aparta en `descartados`."""
+        with self._lock:
+            if intentos + 1 < self.max_intentos:
+                self._conn.execute("UPDATE pendientes SET intentos = intentos + 1 WHERE id = ?", (id_,))
+                return
+            self._conn.execute("BEGIN")
+            self._conn.execute(
+                "INSERT OR REPLACE INTO descartados (id, registro, error, creado) SELECT id, registro, ?, ? FROM pendientes WHERE id = ?",
+                (error, time.time(), id_)
+            )
+            self._conn.execute("DELETE FROM pendientes WHERE id = ?", (id_,))
+            self._conn.execute("COMMIT")
+        log.error("Compra en %s apartada tras %s intentos: %s", registro['compra'].get('merchant_text'),
+                  self.max_intentos, error, cuenta=registro.get('email'))
+
+    def drenar(self, db, al_registrar):
+        """
+        Reenvía a la BD un lote de compras pendientes.
+        :param al_registrar: callable(registro, resultado) por cada compra registrada.
+        :return: número de compras que la BD confirmó.
+        """
+        if self._conn is None or not db.disponible():
+            return 0
+        lote = self._tomar()
+        if not lote:
+            return 0
+
+        resultados = db.process_transactions_bulk([r['compra'] for _, r, _ in lote])
+        hechos = []
+        if resultados is not None:
+            for item, res in zip(lote, resultados):
+                if res is None:
+                    # La BD respondió pero rechazó esta compra: cuenta como intento
+                    self._fallo(*item, "La BD no registró la transacción")
+                    continue
+                hechos.append((item, res))
+        else:
+            # Con la BD caída se espera al siguiente turno; si responde, se aísla la compra que falla
+            for item in lote:
+                if not db.disponible():
+                    break
+                id_, registro, intentos = item
+                try:
+                    res = db.process_transaction(**registro['compra'], lanzar_conexion=True)
+                except Exception as e:
+                    # Conexión caída o pool agotado: no cuenta como intento, se reintenta en el próximo turno
+                    log.warning("Spool: la BD no respondió (%s); se reintenta después.", e)
+                    break
+                if res is None:
+                    self._fallo(id_, registro, intentos, "La BD no registró la transacción")
+                    continue
+                hechos.append((item, res))
+
+        self.confirmar([id_ for (id_, _, _), _ in hechos])
+        for (_, registro, _), res in hechos:
+            try:
+                al_registrar(registro, res)
+            except Exception as e:
+                log.error("Error notificando compra recuperada del spool: %s", e)
+        if hechos:
+            log.info("Spool: %s compras registradas, %s pendientes.", len(hechos), self.pendientes())
+        return len(hechos)
+
+    def iniciar_drenado(self, db, al_registrar):
+        """Hilo que vacía el spool en lotes mientras la BD esté disponible."""
+        self.abrir()
+        if self._conn is None or self._hilo is not None:
+            return
+
+        def _drenar():
+            while not self._detener.is_set():
+                try:
+                    # Lotes seguidos mientras haya atraso; si no, esperar al siguiente turno
+                    if self.drenar(db, al_registrar) >= self.lote:
+                        continue
+                except Exception as e:
+                    log.error("Error drenando el spool de transacciones: %s", e)
+                self._detener.wait(self.intervalo)
+
+        self._hilo = threading.Thread(target=_drenar, name="spool-transacciones", daemon=True)
+        self._hilo.start()
+
+    def detener(self):
+        self._detener.set()
+
+    def _rollback(self):
+        try:
+            self._conn.execute("ROLLBACK")
+        except Exception:
+            pass
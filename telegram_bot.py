@@ -1,12 +1,18 @@
 import os
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import (
-    ApplicationBuilder, CommandHandler, ContextTypes, 
+    ApplicationBuilder, BaseUpdateProcessor, CommandHandler, ContextTypes, 
     ConversationHandler, MessageHandler, CallbackQueryHandler, filters
 )
 from dotenv import load_dotenv
 from db_client import GlobalPointsDB
 from logger_helper import AppLogger
+import botones
+import metricas
 
 # Cargar configuración
 load_dotenv()
@@ -16,7 +22,105 @@ log = AppLogger("TelegramBot")
 # Estados de la conversación de registro
 ASK_EMAIL, ASK_PASSWORD = range(2)
 
+# Las llamadas a BD (pyodbc, bloqueantes) corren en este pool, nunca en el event loop.
+# Su tamaño es el máximo de consultas simultáneas; conviene que MSSQL_POOL_MAX sea >= a este valor.
+DB_CONCURRENCY = int(os.getenv("BOT_DB_CONCURRENCY", "8"))
+_db_executor = ThreadPoolExecutor(max_workers=DB_CONCURRENCY, thread_name_prefix="bot-db")
+
+def get_db(context: ContextTypes.DEFAULT_TYPE):
+    """Cliente de BD compartido por todos los handlers (creado en main)."""
+    return context.bot_data["db"]
+
+async def run_db(func, *args, **kwargs):
+    """Ejecuta un método bloqueante de GlobalPointsDB en el pool de BD."""
+    loop = asyncio.get_running_loop()
+    with metricas.BOT_BD.labels(func.__name__).medir():
+        return await loop.run_in_executor(_db_executor, functools.partial(func, *args, **kwargs))
+
+# Recepción de updates: "polling" (getUpdates) o "webhook" (Telegram nos hace POST; requiere
+# python-telegram-bot[webhooks] y una URL HTTPS pública, normalmente detrás de un proxy inverso)
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("BOT_WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.getenv("BOT_WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("BOT_WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("BOT_WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("BOT_WEBHOOK_SECRET") or None
+
+# Configuraciones de compra a medio elegir (multiplicador elegido, falta la categoría)
+PENDING_TTL = int(os.getenv("BOT_PENDING_TTL", "86400"))
+PENDING_MAX = int(os.getenv("BOT_PENDING_MAX", "10000"))
+
+# Updates procesados a la vez (de chats distintos); 1 = uno tras otro
+CONCURRENT_UPDATES = int(os.getenv("BOT_CONCURRENT_UPDATES", "32"))
+
+class ProcesadorPorChat(BaseUpdateProcessor):
+    """
+    Procesa updates de chats distintos en paralelo y los de un mismo chat en
+    orden de llegada (el flujo multiplicador -> categoría y la conversación
+    de /registro dependen del paso anterior).
+    - `limite`: handlers corriendo a la vez.
+    - max_concurrent_updates (PTB): updates admitidos, incluidos los que
+      esperan su turno en su chat; los demás esperan en la cola.
+    """
+
+    def __init__(self, limite, max_admitidos=None):
+        super().__init__(max_admitidos or limite * 8)
+        self._en_ejecucion = asyncio.BoundedSemaphore(limite)
+        self._chats = {}    # chat_id -> [Lock, updates admitidos de ese chat]
+
+    @staticmethod
+    def _chat(update):
+        if isinstance(update, Update):
+            if update.effective_chat:
+                return update.effective_chat.id
+            if update.effective_user:
+                return update.effective_user.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        chat_id = self._chat(update)
+        if chat_id is None:
+            async with self._en_ejecucion:
+                await coroutine
+            return
+        # El semáforo de PTB admite en orden de llegada y asyncio.Lock atiende en FIFO:
+        # dentro de un chat los updates corren en el mismo orden en que llegaron
+        entrada = self._chats.get(chat_id)
+        if entrada is None:
+            entrada = self._chats[chat_id] = [asyncio.Lock(), 0]
+        entrada[1] += 1
+        try:
+            async with entrada[0], self._en_ejecucion:
+                await coroutine
+        finally:
+            entrada[1] -= 1
+            if not entrada[1]:
+                del self._chats[chat_id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+# Métricas: endpoint Prometheus local y snapshot periódico en disco
+METRICS_PORT = int(os.getenv("BOT_METRICS_PORT", "9109"))
+METRICS_SNAPSHOT = os.getenv("BOT_METRICS_SNAPSHOT", "data/metricas_bot.json")
+METRICS_SNAPSHOT_INTERVAL = int(os.getenv("METRICS_SNAPSHOT_INTERVAL", "60"))
+
+def medido(handler):
+    """Registra la duración del handler en bot_handler_segundos."""
+    @functools.wraps(handler)
+    async def envoltura(update, context):
+        inicio = time.perf_counter()
+        try:
+            return await handler(update, context)
+        finally:
+            metricas.BOT_HANDLERS.labels(handler.__name__).observar(time.perf_counter() - inicio)
+    return envoltura
+
 # --- COMANDOS BÁSICOS ---
+@medido
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Mensaje de bienvenida."""
     user_name = update.effective_user.first_name
@@ -32,10 +136,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(msg)
 
 # --- FLUJO DE REGISTRO ---
+@medido
 async def registro_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("📧 Por favor, escribe tu dirección de correo (Gmail):")
     return ASK_EMAIL
 
+@medido
 async def receive_email(update: Update, context: ContextTypes.DEFAULT_TYPE):
     email = update.message.text.strip()
     if "@" not in email:
@@ -63,6 +169,7 @@ async def receive_email(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     return ASK_PASSWORD
 
+@medido
 async def receive_password(update: Update, context: ContextTypes.DEFAULT_TYPE):
     password = update.message.text.strip()
     email = context.user_data['email']
@@ -70,8 +177,7 @@ async def receive_password(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await update.message.reply_text("💾 Guardando credenciales...")
 
-    db = GlobalPointsDB()
-    if db.register_user_credentials(chat_id, email, password):
+    if await run_db(get_db(context).register_user_credentials, chat_id, email, password):
         await update.message.reply_text("**¡Registro Exitoso!** Ya puedo leer tus correos.", parse_mode="Markdown")
     else:
         await update.message.reply_text("❌ Error al guardar en BD. Intenta /registro de nuevo.")
@@ -80,37 +186,49 @@ async def receive_password(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 # RECIENTES
+TAMANO_PAGINA = 5
+
+def render_pagina(pagina):
+    """Texto y botones de una página del historial: todo va en un solo mensaje."""
+    items = pagina["items"]
+    lineas = ["**Últimas Transacciones:**"]
+    botones_editar = []
+    for i, tx in enumerate(items, start=1):
+        lineas.append(
+            f"\n{i}. 📅 `{tx['fecha']}`\n"
+            f"🏪 **{tx['comercio']}**\n"
+            f"💵 ${tx['monto']}  ➡️  ⭐ **{tx['puntos']} pts** (x{tx['multiplicador']})"
+        )
+        botones_editar.append(InlineKeyboardButton(f"✏️ {i}", callback_data=f"edit|{tx['id']}"))
+
+    # Los cursores son el Id de la primera/última transacción visible
+    navegacion = []
+    if pagina["has_newer"]:
+        navegacion.append(InlineKeyboardButton("⬅️ Más nuevas", callback_data=f"rec|n|{items[0]['id']}"))
+    if pagina["has_older"]:
+        navegacion.append(InlineKeyboardButton("Más antiguas ➡️", callback_data=f"rec|o|{items[-1]['id']}"))
+
+    filas = [fila for fila in (botones_editar, navegacion) if fila]
+    return "\n".join(lineas), InlineKeyboardMarkup(filas) if filas else None
+
+@medido
 async def recientes(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    db = GlobalPointsDB()
-    txs = db.get_recent_transactions(chat_id,5)
+    pagina = await run_db(get_db(context).get_transactions_page, chat_id, TAMANO_PAGINA)
 
-    if not txs:
+    if not pagina["items"]:
         await update.message.reply_text("No tienes transacciones recientes.")
         return
 
-    await update.message.reply_text("**Últimas Transacciones:**", parse_mode="Markdown")
-
-    for tx in txs:
-        msg = (
-            f"📅 `{tx['fecha']}`\n"
-            f"🏪 **{tx['comercio']}**\n"
-            f"💵 ${tx['monto']}  ➡️  ⭐ **{tx['puntos']} pts** (x{tx['multiplicador']})"
-        )
-        
-        # Botón para Editar
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("✏️ Editar Puntos", callback_data=f"edit|{tx['id']}")]
-        ])
-        
-        await update.message.reply_text(msg, reply_markup=keyboard, parse_mode="Markdown")
+    texto, keyboard = render_pagina(pagina)
+    await update.message.reply_text(texto, reply_markup=keyboard, parse_mode="Markdown")
 
 # Listar Tarjetas
+@medido
 async def tarjetas(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Lista las tarjetas del usuario."""
     chat_id = update.effective_chat.id
-    db = GlobalPointsDB()
-    cards = db.get_user_cards(chat_id)
+    cards = await run_db(get_db(context).get_user_cards, chat_id)
 
     if not cards:
         await update.message.reply_text("No tienes tarjetas registradas aún.")
@@ -122,11 +240,11 @@ async def tarjetas(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await update.message.reply_text(msg, parse_mode="Markdown")
 
+@medido
 async def resumen(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Muestra el resumen del mes actual."""
     chat_id = update.effective_chat.id
-    db = GlobalPointsDB()
-    data = db.get_monthly_summary(chat_id)
+    data = await run_db(get_db(context).get_monthly_summary, chat_id)
 
     if not data or data['count'] == 0:
         await update.message.reply_text("📊 Aún no hay movimientos este mes.")
@@ -142,12 +260,78 @@ async def resumen(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     await update.message.reply_text(msg, parse_mode="Markdown")
 
+@medido
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("🚫 Cancelado.")
     return ConversationHandler.END
 
 
 # --- MANEJO DE BOTONES ---
+def teclado(filas):
+    """Filas de botones.py -> InlineKeyboardMarkup."""
+    return InlineKeyboardMarkup([[InlineKeyboardButton(texto, callback_data=data) for texto, data in fila]
+                                 for fila in filas])
+
+def texto_base(texto_original):
+    """Parte del mensaje con la info de la compra: hasta la primera línea de confirmación o prompt."""
+    base_text_lines = []
+    for line in texto_original.split('\n'):
+        if line.startswith('✅') or line.startswith('❌') or line.startswith('👇'):
+            break
+        base_text_lines.append(line)
+    return '\n'.join(base_text_lines).strip()
+
+async def configurar_compra(query, db, pendientes, eleccion):
+    """
+    Acumula la elección en el estado pendiente de la compra y, cuando ya está
+    todo lo que pedía, lo guarda con una sola llamada a complete_configuration.
+    Mientras falte algo solo se redibuja el teclado (el texto no cambia), así
+    que el texto de la compra se toma del mensaje una vez y queda en el estado.
+    Lo ya elegido también viaja en el callback_data (ver botones.py): si el
+    estado expiró o el bot se reinició, el segundo clic no vuelve a preguntarlo.
+    """
+    tx_id = eleccion["tx_id"]
+    estado = pendientes.obtener(tx_id)
+    if estado is None:
+        estado = {"pendiente": eleccion["pendiente"], "texto": query.message.text_markdown,
+                  "multiplicador": None, "categoria": None, "guardada": False}
+    if estado["guardada"]:
+        return  # Doble clic: la configuración ya se guardó
+    estado["multiplicador"] = eleccion.get("multiplicador", estado["multiplicador"])
+    estado["categoria"] = eleccion.get("categoria", estado["categoria"])
+    pendientes.guardar(tx_id, estado)
+
+    falta_mult = estado["pendiente"] in ("m", "b") and estado["multiplicador"] is None
+    falta_cat = estado["pendiente"] in ("c", "b") and estado["categoria"] is None
+    if falta_mult or falta_cat:
+        filas = botones.filas_configuracion(tx_id, estado["pendiente"], estado["multiplicador"], estado["categoria"])
+        await query.edit_message_reply_markup(reply_markup=teclado(filas))
+        return
+
+    estado["guardada"] = True
+    if not await run_db(db.complete_configuration, transaction_id=tx_id,
+                        multiplier=estado["multiplicador"], category_name=estado["categoria"]):
+        estado["guardada"] = False
+        await query.edit_message_text(
+            text=f"{estado['texto']}\n\n❌ Error al guardar la configuración, intenta de nuevo.",
+            reply_markup=teclado(botones.filas_configuracion(tx_id, estado["pendiente"], estado["multiplicador"],
+                                                             estado["categoria"])),
+            parse_mode="Markdown"
+        )
+        return
+
+    confirmaciones = []
+    if estado["multiplicador"] is not None:
+        confirmaciones.append(f"✅ Regla: **x{estado['multiplicador']}**")
+    if estado["categoria"] is not None:
+        confirmaciones.append(f"✅ Categoría: **{estado['categoria']}**")
+    await query.edit_message_text(
+        text=f"{estado['texto']}\n\n" + "\n".join(confirmaciones),
+        reply_markup=None,  # Configuración completa: sin botones
+        parse_mode="Markdown"
+    )
+
+@medido
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Maneja los clics en los botones."""
     query = update.callback_query
@@ -156,23 +340,32 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     data = query.data.split("|")
     accion = data[0]
 
-    db = GlobalPointsDB()
+    db = get_db(context)
+
+    # --- NAVEGACIÓN DEL HISTORIAL (/recientes) ---
+    if accion == "rec":
+        direccion = data[1]
+        cursor_id = int(data[2]) if len(data) > 2 and data[2] else None
+        pagina = await run_db(
+            db.get_transactions_page, update.effective_chat.id, TAMANO_PAGINA,
+            older_than=cursor_id if direccion == "o" else None,
+            newer_than=cursor_id if direccion == "n" else None,
+        )
+        if not pagina["items"]:
+            await query.edit_message_text("No tienes transacciones recientes.")
+            return
+        texto, keyboard = render_pagina(pagina)
+        await query.edit_message_text(texto, reply_markup=keyboard, parse_mode="Markdown")
+
+    # --- CONFIGURACIÓN DE UNA COMPRA NUEVA (teclado combinado, ver botones.py) ---
+    elif accion == botones.PREFIJO:
+        eleccion = botones.decodificar(query.data)
+        if eleccion is not None:
+            await configurar_compra(query, db, context.bot_data["pendientes"], eleccion)
 
-    # Recuperamos el texto base del mensaje (lo que no cambia, la info de la compra)
-    texto_original = query.message.text_markdown
-    
-    # Intentamos encontrar la parte base de la transacción
-    # La buscamos hasta la primera línea de confirmación o prompt.
-    base_text_lines = []
-    for line in texto_original.split('\n'):
-        if line.startswith('✅') or line.startswith('❌') or line.startswith('👇'):
-            break
-        base_text_lines.append(line)
-    
-    base_text = '\n'.join(base_text_lines).strip()
-    
     # --- A. EDICIÓN MANUAL (Botón "Editar") ---
-    if accion == "edit":
+    elif accion == "edit":
+        texto_original = query.message.text_markdown
         tx_id = data[1]
         keyboard = InlineKeyboardMarkup([
             [
@@ -183,7 +376,8 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             [
                 InlineKeyboardButton("x4", callback_data=f"setmult|{tx_id}|4.0"),
                 InlineKeyboardButton("x5", callback_data=f"setmult|{tx_id}|5.0"),
-            ]
+            ],
+            [InlineKeyboardButton("↩️ Volver", callback_data="rec|p")]
         ])
         await query.edit_message_text(
             text=f"{texto_original}\n\n👇 **Selecciona el nuevo multiplicador:**",
@@ -191,15 +385,16 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode="Markdown"
         )
 
-    # --- B. LÓGICA SECUENCIAL DE CONFIGURACIÓN ---
+    # --- B. LÓGICA SECUENCIAL (formato cfg|...): mensajes enviados antes del teclado combinado ---
     
     # Paso 1: GUARDAR MULTIPLICADOR y PREGUNTAR CATEGORÍA
     elif accion == "cfg" and data[2] == "mult":
+        base_text = texto_base(query.message.text_markdown)
         tx_id = int(data[1])
         valor = float(data[3])
         
         # 1. Guardar el multiplicador
-        if db.complete_configuration(transaction_id=tx_id, multiplier=valor):
+        if await run_db(db.complete_configuration, transaction_id=tx_id, multiplier=valor):
             confirm_mult = f"✅ Regla: **x{valor}**"
             
             # 2. Generar SOLO los botones de Categoría para el siguiente paso
@@ -227,11 +422,13 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Paso 2: GUARDAR CATEGORÍA y FINALIZAR
     elif accion == "cfg" and data[2] == "cat":
+        texto_original = query.message.text_markdown
+        base_text = texto_base(texto_original)
         tx_id = int(data[1])
         nombre_categoria = data[3]
         
         # 1. Guardar la categoría
-        if db.complete_configuration(transaction_id=tx_id, category_name=nombre_categoria):
+        if await run_db(db.complete_configuration, transaction_id=tx_id, category_name=nombre_categoria):
             
             # 2. Recuperar la línea de confirmación del Multiplicador del texto anterior
             mult_confirmation_line = [line for line in texto_original.split('\n') if line.startswith('✅ Regla:')][0]
@@ -252,17 +449,27 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif accion == "setmult":
         tx_id = int(data[1])
         valor = float(data[2])
-        if db.complete_configuration(transaction_id=tx_id, multiplier=valor):
-            await query.edit_message_text(f"✅ **Actualizado:** Ahora es x{valor}", parse_mode="Markdown")
+        if await run_db(db.complete_configuration, transaction_id=tx_id, multiplier=valor):
+            volver = InlineKeyboardMarkup([[InlineKeyboardButton("📋 Ver recientes", callback_data="rec|p")]])
+            await query.edit_message_text(f"✅ **Actualizado:** Ahora es x{valor}", reply_markup=volver, parse_mode="Markdown")
         else:
             await query.edit_message_text("❌ Error al actualizar.")
 
-def main():
-    if not TOKEN:
-        log.error("No hay TELEGRAM_TOKEN en .env")
-        return
-
-    app = ApplicationBuilder().token(TOKEN).build()
+def build_application(db, token=None, request=None, concurrencia=None):
+    """
+    Arma la Application con todos los handlers, sin arrancarla.
+    :param request: BaseRequest para hablar con la Bot API (el harness de carga usa uno local).
+    :param concurrencia: updates en paralelo (por defecto BOT_CONCURRENT_UPDATES).
+    """
+    concurrencia = concurrencia or CONCURRENT_UPDATES
+    builder = ApplicationBuilder().token(token or TOKEN)
+    if concurrencia > 1:
+        builder = builder.concurrent_updates(ProcesadorPorChat(concurrencia))
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    app = builder.build()
+    app.bot_data["db"] = db
+    app.bot_data["pendientes"] = botones.ConfiguracionesPendientes(PENDING_TTL, PENDING_MAX)
 
     # 1. Conversation Handler
     conv_handler = ConversationHandler(
@@ -282,9 +489,39 @@ def main():
     
     app.add_handler(conv_handler)
     app.add_handler(CallbackQueryHandler(button_callback)) # Botones
+    return app
+
+def main():
+    if not TOKEN:
+        log.error("No hay TELEGRAM_TOKEN en .env")
+        return
+
+    try:
+        db = GlobalPointsDB()
+    except Exception as e:
+        log.error("Error crítico conectando a BD: %s", e)
+        return
 
-    log.info("Bot de Telegram iniciado y escuchando...")
-    app.run_polling()
+    if BOT_MODE == "webhook" and not WEBHOOK_URL:
+        log.error("BOT_MODE=webhook requiere BOT_WEBHOOK_URL (URL HTTPS pública del bot).")
+        return
+
+    app = build_application(db)
+    metricas.iniciar(METRICS_PORT, METRICS_SNAPSHOT, METRICS_SNAPSHOT_INTERVAL)
+
+    if BOT_MODE == "webhook":
+        url = f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}"
+        log.info("Bot de Telegram iniciado (webhook en %s:%s, %s updates en paralelo)...",
+                 WEBHOOK_LISTEN, WEBHOOK_PORT, CONCURRENT_UPDATES)
+        # Con secret_token, el servidor del webhook rechaza los POST que no traen ese encabezado
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT, url_path=WEBHOOK_PATH,
+            webhook_url=url, secret_token=WEBHOOK_SECRET
+        )
+    else:
+        log.info("Bot de Telegram iniciado y escuchando (%s updates en paralelo)...", CONCURRENT_UPDATES)
+        # Al pasar de webhook a polling, run_polling borra el webhook registrado
+        app.run_polling()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file